@@ -71,6 +71,12 @@ export async function  getTree(headers: HeadersInit): Promise<Object> {
     }
 }
 
+export async function getChildren(headers: HeadersInit, identifier: string = '/', type: OpenbisObjectTypes = OpenbisObjectTypes.INSTANCE, cursor: number = 0, limit: number = 100, depth: number = 1): Promise<object>{
+    // Gets one page of the children of an openBIS object, pass the returned `next_cursor` to get the next page
+    const params = new URLSearchParams({identifier: identifier, type: type, cursor: cursor.toString(), limit: limit.toString(), depth: depth.toString()});
+    return jsonRequest(new Request(`${apiPath}/openbis/children?` + params.toString(), {method: 'GET', headers: headers}));
+}
+
 export async function  getDatasetTypes(headers: HeadersInit): Promise<string[]>{
         const req =  new Request(`${apiPath}/openbis/dataset_types`, {method: 'GET', headers: headers});
         const response = await fetch(req);
@@ -98,6 +104,49 @@ export async function uploadFile(headers: HeadersInit, file: File): Promise<obje
     }
 }
 
+async function jsonRequest(req: Request): Promise<any>{
+    const response = await fetch(req);
+    const body = await response.json();
+    if (response.ok){
+        return body
+    }else{
+        const error = new Error(response.statusText);
+        throw(error);
+    }
+}
+
+export async function uploadFileResumable(headers: HeadersInit, file: File, partSize: number = 64 * 1024 * 1024, concurrency: number = 4, uploadId?: string, onStarted?: (uploadId: string) => void): Promise<object>{
+    // Start a new upload or resume an existing one, `onStarted` receives the id needed to resume it
+    let status;
+    if (uploadId !== undefined){
+        const response = await fetch(new Request(`${apiPath}/datasets/uploads/${uploadId}`, {method: 'GET', headers: headers}));
+        // An upload which expired or was completed meanwhile is started again
+        if (response.ok){
+            status = await response.json();
+        } else if (response.status !== 404){
+            throw new Error(response.statusText);
+        }
+    }
+    if (status === undefined){
+        const jsonHeaders = new Headers(headers);
+        jsonHeaders.set('Content-Type', 'application/json');
+        const payload = JSON.stringify({filename: file.name, size: file.size, part_size: partSize});
+        status = await jsonRequest(new Request(`${apiPath}/datasets/uploads`, {method: 'POST', headers: jsonHeaders, body: payload}));
+    }
+    onStarted?.(status.upload_id);
+    // Send the missing parts using `concurrency` parallel requests
+    const missing: number[] = [...status.missing];
+    const sendParts = async () => {
+        let part;
+        while ((part = missing.shift()) !== undefined){
+            const blob = file.slice(part * status.part_size, (part + 1) * status.part_size);
+            await jsonRequest(new Request(`${apiPath}/datasets/uploads/${status.upload_id}/${part}`, {method: 'PUT', headers: headers, body: blob}));
+        }
+    };
+    await Promise.all(Array.from({length: concurrency}, sendParts));
+    return jsonRequest(new Request(`${apiPath}/datasets/uploads/${status.upload_id}/complete`, {method: 'POST', headers: headers}));
+}
+
 export async function  getParsers(headers: HeadersInit): Promise<string[]>{
     const req =  new Request(`${apiPath}/datasets/parsers`, {method: 'GET', headers: headers});
     const response = await fetch(req);
@@ -9,7 +9,13 @@ import { ParserParameters } from '../models/ParserParameters'
 
 interface State {
     fileList: FileInfo[],
-    selected: FileInfo | void
+    selected: FileInfo | void,
+    // Ids of the interrupted uploads, by file, so that they can be resumed
+    pendingUploads: Record<string, string>
+}
+
+function uploadKey(file: File): string{
+    return `${file.name}:${file.size}:${file.lastModified}`;
 }
 
 export const useFiles = defineStore(
@@ -19,7 +25,8 @@ export const useFiles = defineStore(
         {
             return {
             fileList: [],
-            selected:  null
+            selected:  null,
+            pendingUploads: {}
         }
     },
     actions:
@@ -34,8 +41,11 @@ export const useFiles = defineStore(
             return names.includes(id);
         },
         async uploadFile(file: File){
+            // Parts are sent concurrently, a failed upload only resends its missing parts when retried
             const tok = await bearerHeaderAuth();
-            await DropBox.uploadFile(tok, file);
+            const key = uploadKey(file);
+            await DropBox.uploadFileResumable(tok, file, undefined, undefined, this.pendingUploads[key], (uploadId: string) => {this.pendingUploads[key] = uploadId});
+            delete this.pendingUploads[key];
             await this.getFileList();
         },
         async transfer(sourceId: string, destination: string, dataSetType: string, level: OpenbisObjectTypes, parser: string, params: ParserParameters){
@@ -6,6 +6,7 @@ from datastore.utils import settings
 import argparse as ap
 import pathlib as pl
 import aiofiles
+import anyio
 
 import os
 from datastore.services.ldap import session
@@ -23,6 +24,18 @@ def create_app():
     
     #Create settings
     app = FastAPI()
+
+    @app.on_event("startup")
+    async def configure_threadpool():
+        #Blocking handlers (LDAP, pybis, redis) run in the anyio worker threads
+        limiter = anyio.to_thread.current_default_thread_limiter()
+        limiter.total_tokens = settings.get_settings().threadpool_size
+
+    @app.on_event("shutdown")
+    async def close_progress_broker():
+        if (broker := getattr(app.state, 'progress_broker', None)) is not None:
+            await broker.close()
+
     app.include_router(login.router)
     app.include_router(data.router)
     app.include_router(openbis.router)
@@ -1,6 +1,6 @@
 from pydantic.dataclasses import dataclass
-from pydantic import BaseModel
-from typing import Iterable, List, Optional, Dict, Union
+from pydantic import BaseModel, Field
+from typing import Iterable, List, Optional, Dict, Union, Tuple
 import datetime as dt
 import pathlib as pl
 
@@ -30,6 +30,69 @@ class FileInfo(BaseModel):
         st = p.stat()
         return FileInfo(name=p.name, path=p.expanduser().absolute(), modified=dt.datetime.fromtimestamp(st.st_mtime), created=dt.datetime.fromtimestamp(st.st_ctime), size=st.st_size)
 
+    @classmethod
+    def from_entry(cls, e: "FileEntry") -> "FileInfo":
+        """
+        Factory function to generate a :obj:`FileInfo` instance
+        from an entry of the file catalog, without accessing the disk
+        :param e: a :obj:`datastore.utils.files.FileEntry`
+        """
+        return FileInfo(name=e.name, path=e.path, modified=dt.datetime.fromtimestamp(e.modified), created=dt.datetime.fromtimestamp(e.created), size=e.size)
+
+
+class UploadResult(BaseModel):
+    """
+    Result of a file upload
+    :ivar message: human readable message
+    :ivar path: final path of the file on the datastore
+    :ivar size: number of bytes written
+    :ivar duration: time taken by the upload (in seconds)
+    :ivar rate: average throughput (in bytes/s)
+    """
+    message: str
+    path: pl.Path
+    size: int
+    duration: float
+    rate: float
+
+
+#Bounds of the part size of resumable uploads, which also bound their number of parts
+MIN_UPLOAD_PART_SIZE = 1024 * 1024
+MAX_UPLOAD_PART_SIZE = 1024 * 1024 * 1024
+
+
+class ResumableUploadRequest(BaseModel):
+    """
+    Request to start a resumable upload
+    :ivar filename: name of the file to upload
+    :ivar size: total size of the file in bytes
+    :ivar part_size: size of each part in bytes, between `MIN_UPLOAD_PART_SIZE` and `MAX_UPLOAD_PART_SIZE`.
+        If not given, the server default is used
+    """
+    filename: str
+    size: int = Field(ge=0)
+    part_size: int | None = Field(None, ge=MIN_UPLOAD_PART_SIZE, le=MAX_UPLOAD_PART_SIZE)
+
+
+class ResumableUploadStatus(BaseModel):
+    """
+    State of a resumable upload
+    :ivar upload_id: id of the upload, to be used for the following requests
+    :ivar filename: name of the file
+    :ivar size: total size of the file in bytes
+    :ivar part_size: size of each part in bytes
+    :ivar parts: total number of parts
+    :ivar received: list of the byte ranges received so far (end exclusive)
+    :ivar missing: list of the parts which still need to be uploaded
+    """
+    upload_id: str
+    filename: str
+    size: int
+    part_size: int
+    parts: int
+    received: List[Tuple[int, int]]
+    missing: List[int]
+
 
 class Response(BaseModel):
     """
@@ -0,0 +1,65 @@
+"""
+Models of the job ledger
+"""
+import enum
+from typing import Dict
+
+from pydantic import BaseModel
+
+
+class JobEvent(str, enum.Enum):
+    ENQUEUED = 'enqueued'
+    STARTED = 'started'
+    PROGRESS = 'progress'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+    STOPPED = 'stopped'
+
+
+class SizeClass(str, enum.Enum):
+    """
+    Scheduling class of a transfer job. Every class has its own queue
+    """
+    SMALL = 'small'
+    MEDIUM = 'medium'
+    LARGE = 'large'
+
+    @property
+    def queue(self) -> str:
+        return f"transfers-{self.value}"
+
+
+class JobRecord(BaseModel):
+    """
+    Summary of a job, updated at every event.
+    Times are UNIX timestamps, durations are in seconds
+    :param status: the last lifecycle event of the job
+    :param queued_seconds: the time between enqueuing and start
+    :param run_seconds: the time between start and end
+    :param stage: the last reported progress stage
+    :param detail: the last progress detail or the error of a failed job
+    """
+    id: str
+    user: str | None = None
+    function: str | None = None
+    description: str | None = None
+    status: JobEvent
+    enqueued_at: float | None = None
+    started_at: float | None = None
+    ended_at: float | None = None
+    queued_seconds: float | None = None
+    run_seconds: float | None = None
+    stage: str | None = None
+    percent: float | None = None
+    detail: str | None = None
+
+
+class JobEventRecord(BaseModel):
+    """
+    One entry of the event stream of a job
+    :param id: the redis stream entry id
+    """
+    id: str
+    event: JobEvent
+    time: float
+    fields: Dict[str, str] = {}
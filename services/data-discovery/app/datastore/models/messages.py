@@ -1,7 +1,51 @@
-from pydantic import BaseModel
 """
 Messages for pub/sub tasks
 """
+import enum
+import time
+
+from pydantic import BaseModel, Field
+
+
+class ProgressStage(str, enum.Enum):
+    QUEUED = 'QUEUED'
+    STARTED = 'STARTED'
+    UPLOADING = 'UPLOADING'
+    PARSING = 'PARSING'
+    FINISHED = 'FINISHED'
+    FAILED = 'FAILED'
+
+    @property
+    def terminal(self) -> bool:
+        return self in (ProgressStage.FINISHED, ProgressStage.FAILED)
+
 
 class BaseMessage(BaseModel):
-    
\ No newline at end of file
+    """
+    Base class of the messages published by the tasks
+    :param job_id: the id of the job sending the message
+    :param time: the time (UNIX timestamp) the message was created
+    """
+    job_id: str
+    time: float = Field(default_factory=time.time)
+
+
+class ProgressMessage(BaseMessage):
+    """
+    Progress of a job. All counters are optional,
+    a job only reports what it can measure
+    :param stage: the current stage of the job
+    :param percent: the overall progress
+    :param bytes_processed: the number of bytes uploaded or parsed so far
+    :param bytes_total: the total number of bytes to process
+    :param items_processed: the number of items (files, samples) processed so far
+    :param items_total: the total number of items
+    :param detail: a human readable description or the error of a failed job
+    """
+    stage: ProgressStage
+    percent: float | None = Field(None, ge=0, le=100)
+    bytes_processed: int | None = None
+    bytes_total: int | None = None
+    items_processed: int | None = None
+    items_total: int | None = None
+    detail: str | None = None
@@ -3,6 +3,7 @@ from typing import Dict, Optional, Tuple, List, Any
 from uuid import UUID, uuid4
 import enum
 from instance_creator.views import OpenbisHierarcy
+from datastore.models.openbis import OpenbisConnection
 
 
 class FunctionParameters(BaseModel):
@@ -17,6 +18,26 @@ class ParserParameters(BaseModel):
     function_parameters: Dict[str, Any]
 
 
+class TransferJob(BaseModel):
+    """
+    Descriptor of a dataset transfer, as enqueued for the workers.
+    It only holds JSON data, the worker resolves it to a connection,
+    files and a parser
+    :param connection: the openBIS server and the session token of the user
+    :param instance: the instance datastore holding the files and the parsers
+    :param files: the paths of the files, relative to the instance datastore
+    :param parser: the registered name of the parser
+    :param parameters: the keyword arguments of the parser
+    """
+    connection: OpenbisConnection
+    instance: str
+    files: List[str]
+    identifier: str
+    type: OpenbisHierarcy
+    parser: str
+    parameters: Dict[str, Any] = {}
+
+
 class ProcessState(enum.Enum):
     STOPPED = 0
     IN_PROGRESS = 1
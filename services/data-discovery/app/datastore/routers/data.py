@@ -2,10 +2,11 @@ from urllib.error import HTTPError
 from xml.dom.minidom import Entity
 from fastapi import APIRouter
 
-from fastapi import FastAPI, File, UploadFile, Depends, HTTPException, Body, BackgroundTasks, status
+from fastapi import FastAPI, File, UploadFile, Depends, HTTPException, Body, BackgroundTasks, status, Request, Response
+from pydantic import ValidationError
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from datastore.utils.redis import get_redis
-from datastore.utils import files, settings
+from datastore.utils import files, http, settings, uploads
 from datastore.models import datasets
 from datastore.services.ldap import auth, ldap, session
 from pybis import Openbis
@@ -18,14 +19,16 @@ from typing import Dict, List
 from datastore.services.ldap import session
 from datastore.services import openbis as openbis_service
 from datastore.services import auth as auth_service
+from datastore.services import jobs as job_service
+from datastore.services import scheduler as scheduler_service
 from datastore.routers.login import get_user, oauth2_scheme, get_credential_context, get_resource_serves, get_credential_store
 from datastore.routers.openbis import  get_openbis
-from datastore.services.parsers.interfaces import OpenbisDatasetParser
-from datastore.services.parsers import icp_ms
+from datastore.services.parsers.interfaces import OpenbisDatasetParser, parser_schema
+from datastore.services.parsers import registry as parser_registry
 
 import datastore.services.parsers.helpers as parser_helper
 from instance_creator.views import OpenbisHierarcy
-from datastore.models.parser import ParserParameters, ParserProcess
+from datastore.models.parser import ParserParameters, ParserProcess, TransferJob
 from fastapi.concurrency import run_in_threadpool
 from fastapi import WebSocket
 
@@ -50,30 +53,27 @@ LOGGER = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/datasets")
 
-async def get_ldap_user(token: str = Depends(oauth2_scheme), store: auth_service.CredentialsStore = Depends(get_credential_store), resource_server: Dict[str, auth_service.ResourceServer] = Depends(get_resource_serves)) -> ldap.LdapUser:
+def get_ldap_user(token: str = Depends(oauth2_scheme), store: auth_service.CredentialsStore = Depends(get_credential_store), resource_server: Dict[str, auth_service.ResourceServer] = Depends(get_resource_serves)) -> ldap.LdapUser:
     """
     Given a token (as a dependence),
     return a LdapUser object containing the user information
     """
     return get_user("ldap", store, resource_server)(token)
 
-async def get_user_instance(user: ldap.LdapUser = Depends(get_ldap_user)) -> files.InstanceDataStore:
+def get_user_instance(user: ldap.LdapUser = Depends(get_ldap_user)) -> files.InstanceDataStore:
     """
     Given an user info (as :obj:`ldap.User`) returns
     the instance data store for that particular user
     """
     set = settings.get_settings()
     group = ldap.decompose_dn(user.group[0])[set.ldap_group_attribute]
-    ds = files.InstanceDataStore(set.base_path, group)
-    #Attach parser
-    ds.register_parser('icp_ms', icp_ms.ICPMsParser)
-    return ds
+    return parser_registry.get_instance_store(group)
 
 
 
 
 @router.get("/find")
-async def find_file(pattern: str, recent: float = float('inf'), inst: files.InstanceDataStore = Depends(get_user_instance)):
+def find_file(pattern: str, recent: float = float('inf'), inst: files.InstanceDataStore = Depends(get_user_instance)):
     """
     Find all datasets in instance `instance` with
     the pattern `pattern`
@@ -81,57 +81,142 @@ async def find_file(pattern: str, recent: float = float('inf'), inst: files.Inst
     :params pattern: a glob pattern
     :params recent: the last modified duration
     """
-    fs = inst.list_files(pattern)
-    if recent:
-        fs_filt = [f for f in fs if files.get_modification_delay(f) < recent]
-    else:
-        fs_filt = fs
-    info = [datasets.FileInfo.from_path(f).dict() for f in fs_filt]
+    fs = inst.list_entries(pattern, recent=recent if recent else None)
+    info = [datasets.FileInfo.from_entry(f).dict() for f in fs]
     return {"files": info}
 
 @router.get("/")
-async def list_files(inst: files.InstanceDataStore = Depends(get_user_instance)):
+def list_files(inst: files.InstanceDataStore = Depends(get_user_instance)):
     """
     Find all datasets in instance`
     :param user_info: user information
     """
-    fs = inst.list_files("*")
-    info = [datasets.FileInfo.from_path(f).dict() for f in fs]
-    print(inst)
-    print(info)
+    fs = inst.list_entries("*")
+    info = [datasets.FileInfo.from_entry(f).dict() for f in fs]
     return {"files": info}
 
 
-@router.post("/")
-async def upload_file(file: UploadFile, inst: files.InstanceDataStore = Depends(get_user_instance)) -> Dict:
+@router.post("/", openapi_extra={"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+    "type": "object", "required": ["file"], "properties": {"file": {"type": "string", "format": "binary"}}}}}}})
+async def upload_file(request: Request, inst: files.InstanceDataStore = Depends(get_user_instance)) -> Dict:
     """
-    Upload a new file to the instance
+    Upload a new file, sent as the field `file` of a multipart form, to the instance.
+    The form is parsed while it is received and the file is written to the
+    instance in chunks of `upload_chunk_size` bytes, without a temporary copy
     """
-    out_path = inst.path / pl.Path(file.filename).name
     try:
-        contents = await file.read()
-        async with aiofiles.open(out_path, 'wb') as f:
-            await f.write(contents)
-    except Exception:
+        reader = uploads.MultipartFileReader(request.headers.get('content-type', ''), chunk_size=settings.get_settings().upload_chunk_size)
+        content = await reader.open(request.stream())
+        name = files.stored_name(reader.filename)
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+    try:
+        result = await inst.write_stream(name, content)
+    except Exception as e:
+        LOGGER.error(f"Error uploading {reader.filename}: {e}")
         return {"message": "There was an error uploading the file"}
-    finally:
-        await file.close()
-    return {"message": f"Successfuly uploaded {file.filename} to {out_path}"}
+    LOGGER.info(f"Uploaded {result.size} bytes to {result.path} in {result.duration:.2f} s ({result.rate / 1e6:.2f} MB/s)")
+    return result
+
+def get_upload(upload_id: str, inst: files.InstanceDataStore = Depends(get_user_instance)) -> uploads.ResumableUpload:
+    """
+    Given an upload id, returns the corresponding
+    resumable upload in the instance of the user
+    """
+    try:
+        return uploads.ResumableUpload.load(inst.path, upload_id)
+    except FileNotFoundError as e:
+        raise HTTPException(404, detail=str(e))
+
+def upload_status(upload: uploads.ResumableUpload) -> datasets.ResumableUploadStatus:
+    return datasets.ResumableUploadStatus(**upload.manifest.dict(exclude={'received_parts'}), parts=upload.part_count, received=upload.received(), missing=upload.missing())
+
+@router.post("/uploads", status_code=status.HTTP_201_CREATED, response_model=datasets.ResumableUploadStatus)
+def start_upload(req: datasets.ResumableUploadRequest, inst: files.InstanceDataStore = Depends(get_user_instance)):
+    """
+    Starts a resumable upload. The file is then sent in numbered parts
+    of `part_size` bytes using `PUT /uploads/{upload_id}/{part}`
+    """
+    st = settings.get_settings()
+    part_size = req.part_size or st.upload_part_size
+    #Free the space of the abandoned uploads before preallocating a new one
+    for upload_id in uploads.expire_uploads(inst.path, st.upload_ttl):
+        LOGGER.info(f"Removed the expired upload {upload_id}")
+    try:
+        upload = uploads.ResumableUpload.create(inst.path, req.filename, req.size, part_size, max_size=st.max_upload_size)
+    except uploads.UploadTooLargeError as e:
+        raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+    except OSError as e:
+        LOGGER.error(f"Cannot allocate {req.size} bytes for {req.filename}: {e}")
+        raise HTTPException(status.HTTP_507_INSUFFICIENT_STORAGE, detail="There is not enough space to store the file")
+    return upload_status(upload)
+
+@router.get("/uploads/{upload_id}", response_model=datasets.ResumableUploadStatus)
+def get_upload_status(upload: uploads.ResumableUpload = Depends(get_upload)):
+    """
+    Returns the received ranges and the missing parts of an upload
+    """
+    return upload_status(upload)
+
+@router.put("/uploads/{upload_id}/{part}")
+async def upload_part(part: int, request: Request, upload: uploads.ResumableUpload = Depends(get_upload)) -> Dict:
+    """
+    Uploads the part `part` of an upload. The request body is the raw content of the part.
+    Parts can be sent in any order and concurrently
+    """
+    try:
+        await upload.write_part(part, request.stream())
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+    except FileNotFoundError:
+        #The upload was completed, aborted or expired meanwhile
+        raise HTTPException(404, detail=f"No upload with id {upload.upload_id}")
+    return {"upload_id": upload.upload_id, "part": part}
+
+@router.post("/uploads/{upload_id}/complete")
+def complete_upload(upload: uploads.ResumableUpload = Depends(get_upload), inst: files.InstanceDataStore = Depends(get_user_instance)) -> Dict:
+    """
+    Completes an upload once all parts are received
+    """
+    try:
+        out_path = upload.complete()
+    except ValueError as e:
+        raise HTTPException(409, detail=str(e))
+    except FileNotFoundError:
+        #The upload was completed or aborted by another request
+        raise HTTPException(404, detail=f"No upload with id {upload.upload_id}")
+    inst.catalog.add(out_path)
+    return {"message": f"Successfuly uploaded {out_path.name} to {out_path}"}
+
+@router.delete("/uploads/{upload_id}")
+def abort_upload(upload: uploads.ResumableUpload = Depends(get_upload)) -> Dict:
+    """
+    Aborts an upload, removing the data received so far
+    """
+    upload.abort()
+    return {"message": f"Aborted upload {upload.upload_id}"}
 
 @router.delete("/")
-async def delete_file(instance: str, name: str) -> Dict:
+def delete_file(name: str, inst: files.InstanceDataStore = Depends(get_user_instance)) -> Dict:
     """
     Delete a file by name
     """
-    inst = ds.get_instance(instance)
-    os_file = inst.path / name
+    os_file = inst.path / pl.Path(name).name
     try:
         os_file.unlink(missing_ok=False)
     except FileNotFoundError as e:
         return {"message": f"File {os_file} does not exist"}
+    finally:
+        inst.catalog.remove(os_file.name)
+    #The hidden caches and previews of the file would otherwise never be removed
+    for derived in files.derived_files(os_file):
+        derived.unlink(missing_ok=True)
+    return {"message": f"Deleted {os_file}"}
 
 @router.get("/parsers")
-async def get_registered_dataset_parsers(inst: files.InstanceDataStore = Depends(get_user_instance)) -> List[str]:
+def get_registered_dataset_parsers(inst: files.InstanceDataStore = Depends(get_user_instance)) -> List[str]:
     """
     Gets the list of all registered dataset parsers
     """
@@ -142,20 +227,27 @@ async def get_registered_dataset_parsers(inst: files.InstanceDataStore = Depends
         raise HTTPException(204)
 
 @router.get("/parser_info", response_model=Dict)
-async def get_parser_parameters(parser: str, inst: files.InstanceDataStore = Depends(get_user_instance)) -> Dict:
+def get_parser_parameters(parser: str, request: Request, response: Response, inst: files.InstanceDataStore = Depends(get_user_instance)) -> Dict:
     """
-    Gets the schema for the parameters for the choosen parser
+    Gets the schema for the parameters for the choosen parser.
+    The schema is sent with an ETag, a request with a matching
+    If-None-Match header gets an empty 304 response
     """
-    if len(inst.parsers) > 0:
-        parser_model = inst.parsers[parser]()._generate_basemodel()
-        return parser_model.schema()
-    else:
+    if len(inst.parsers) == 0:
         raise HTTPException(204)
+    if parser not in inst.parsers:
+        raise HTTPException(404, detail=f"The parser {parser} is not registered")
+    cached = parser_schema(inst.parsers[parser])
+    headers = {'ETag': cached.etag, 'Cache-Control': 'no-cache'}
+    if http.etag_matches(request.headers.get('if-none-match'), cached.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return cached.schema
 
 
 
 @router.put("/transfer", status_code=status.HTTP_202_ACCEPTED, response_model=ParserProcess)
-def transfer_file(params: ParserParameters, background_tasks: BackgroundTasks, user: ldap.LdapUser = Depends(get_ldap_user), queue: Queue = Depends(rq_utils.get_queue), inst: files.InstanceDataStore = Depends(get_user_instance), ob: Openbis = Depends(get_openbis), jobs: parser_helper.ProcessingJobRegistry = Depends(parser_helper.get_registry)):
+def transfer_file(params: ParserParameters, background_tasks: BackgroundTasks, user: ldap.LdapUser = Depends(get_ldap_user), scheduler: scheduler_service.TransferScheduler = Depends(scheduler_service.get_transfer_scheduler), inst: files.InstanceDataStore = Depends(get_user_instance), ob: Openbis = Depends(get_openbis), ledger: job_service.JobLedger = Depends(job_service.get_job_ledger)):
     """
     Transfers a file from the datastore
     to the openbis server by using one of
@@ -166,14 +258,29 @@ def transfer_file(params: ParserParameters, background_tasks: BackgroundTasks, u
     #Get files
 
     try:
-        files_to_attach = inst.get_file(params.source)
+        entry = inst.get_entry(params.source)
     except FileNotFoundError:
         raise HTTPException(401, detail="The file {params.source} cannot be found")
-    #Get the parser
-    current_parser = inst.parsers[params.parser]()
-    ob_m = openbis_models.OpenbisConnection.from_ob(ob)
-    job = rq_utils.create_job(queue.connection, user, ob_tasks.process,[ob, files_to_attach, params.identifier, params.type.value,   current_parser, params.function_parameters], timeout=36000)
-    enqueued_job = queue.enqueue_job(job)
+    if params.parser not in inst.parsers:
+        raise HTTPException(404, detail=f"The parser {params.parser} is not registered")
+    #Reject invalid parameters before any job is created
+    try:
+        parameters = parser_schema(inst.parsers[params.parser]).model.parse_obj(params.function_parameters)
+    except ValidationError as e:
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, detail=e.errors())
+    #The job only carries references, the worker connects and loads the parser itself
+    descriptor = TransferJob(
+        connection=openbis_models.OpenbisConnection.from_ob(ob),
+        instance=inst.instance,
+        files=[str(entry.path.relative_to(inst.path))],
+        identifier=params.identifier,
+        type=params.type,
+        parser=params.parser,
+        parameters=parameters.dict())
+    #Small transfers get their own queue, so that they do not wait behind large ones
+    job = rq_utils.create_job(scheduler.connection, user, ob_tasks.transfer, [rq_utils.job_payload(descriptor)], timeout=36000, serializer=scheduler.serializer,
+        on_success=scheduler_service.on_job_success, on_failure=scheduler_service.on_job_failure, on_stopped=scheduler_service.on_job_stopped)
+    scheduler.submit(job, scheduler_service.classify(entry.size, params.parser), ledger)
     return {'taskid': job.id}
     # if ob.is_session_active():
     #     pass
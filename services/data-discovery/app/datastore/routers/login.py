@@ -45,18 +45,18 @@ def get_credential_store(cred_context: auth_service.CredentialsContext = Depends
     
 
 def get_resource_serves(cred_context: auth_service.CredentialsContext = Depends(get_credential_context)) -> Dict[str, auth_service.ResourceServer]:        
-    #Bind LDAP principal
-    ldap_principal_conn = ldap_session.get_ldap_connection() 
+    #Pool of connections bound with the LDAP principal
+    ldap_principal_pool = ldap_session.get_ldap_pool()
     #Initalise register of resource servers
     resource_servers: Dict[str, auth_service.ResourceServer] = {
-        'ldap': auth_service.ResourceServerLdap(cred_context, "ldap", ldap_principal_conn),
+        'ldap': auth_service.ResourceServerLdap(cred_context, "ldap", ldap_principal_pool),
         'openbis': auth_service.ResourceServerOpenBis(cred_context, "openbis", openbis_service.get_openbis())
     }
     return resource_servers
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-async def login_all(form_data: OAuth2PasswordRequestForm, cred_store:auth_service.CredentialsStore, cred_context: auth_service.CredentialsContext, resource_servers: Dict[str, auth_service.ResourceServer]):
+def login_all(form_data: OAuth2PasswordRequestForm, cred_store:auth_service.CredentialsStore, cred_context: auth_service.CredentialsContext, resource_servers: Dict[str, auth_service.ResourceServer]):
     """
     Using a single login, create a JWT token with audiences for all services
     """
@@ -73,7 +73,7 @@ async def login_all(form_data: OAuth2PasswordRequestForm, cred_store:auth_servic
         raise HTTPException(401)
 
 
-async def login_single(form_data: OAuth2PasswordRequestForm, service: str, cred_store:auth_service.CredentialsStore, resource_servers: Dict[str, auth_service.ResourceServer]):
+def login_single(form_data: OAuth2PasswordRequestForm, service: str, cred_store:auth_service.CredentialsStore, resource_servers: Dict[str, auth_service.ResourceServer]):
     rs = resource_servers[service]
     token, cred = rs.login(form_data.username, form_data.password)
     cred_store.store(token, service, cred)
@@ -81,24 +81,24 @@ async def login_single(form_data: OAuth2PasswordRequestForm, service: str, cred_
 
 
 @router.post("/{service}/token", response_model=auth_models.Token)
-async def login(service: str, form_data: OAuth2PasswordRequestForm = Depends(), cred_context: auth_service.CredentialsContext = Depends(get_credential_context), cred_store:auth_service.CredentialsStore = Depends(get_credential_store),  resource_servers: Dict[str, auth_service.ResourceServer] = Depends(get_resource_serves) ):
+def login(service: str, form_data: OAuth2PasswordRequestForm = Depends(), cred_context: auth_service.CredentialsContext = Depends(get_credential_context), cred_store:auth_service.CredentialsStore = Depends(get_credential_store),  resource_servers: Dict[str, auth_service.ResourceServer] = Depends(get_resource_serves) ):
     logger.logger.info(form_data)
     if service != 'all':
-        return await login_single(form_data, service, cred_store, resource_servers)
+        return login_single(form_data, service, cred_store, resource_servers)
     else:
-        return await login_all(form_data, cred_store, cred_context, resource_servers)
+        return login_all(form_data, cred_store, cred_context, resource_servers)
 
 
 
 
-async def check_single_token(service: str, token, cred_store:auth_service.CredentialsStore,  resource_servers: Dict[str, auth_service.ResourceServer]) -> bool:
+def check_single_token(service: str, token, cred_store:auth_service.CredentialsStore,  resource_servers: Dict[str, auth_service.ResourceServer]) -> bool:
     rs = resource_servers[service]
     if not cred_store.is_invalidated(token):
        return rs.verify(token)
     else:
         return False
 
-async def check_all_token(token: str, cred_store:auth_service.CredentialsStore, resource_servers: Dict[str, auth_service.ResourceServer])  -> bool:
+def check_all_token(token: str, cred_store:auth_service.CredentialsStore, resource_servers: Dict[str, auth_service.ResourceServer])  -> bool:
     if not cred_store.is_invalidated(token):
         valid = [rs.id for rs in resource_servers.values() if rs.verify(token)]
         return valid == list(resource_servers.keys())
@@ -107,24 +107,23 @@ async def check_all_token(token: str, cred_store:auth_service.CredentialsStore,
    
 
 @router.get("/{service}/check", response_model=auth_models.TokenValidity)
-async def check_token(service: str, token: str, cred_store:auth_service.CredentialsStore = Depends(get_credential_store), resource_servers: Dict[str, auth_service.ResourceServer] = Depends(get_resource_serves)) -> Dict:
+def check_token(service: str, token: str, cred_store:auth_service.CredentialsStore = Depends(get_credential_store), resource_servers: Dict[str, auth_service.ResourceServer] = Depends(get_resource_serves)) -> Dict:
     if service != 'all':
-        val = await check_single_token(service, token, cred_store, resource_servers)
+        val = check_single_token(service, token, cred_store, resource_servers)
     else:
-        val = await check_all_token(token, cred_store, resource_servers)
+        val = check_all_token(token, cred_store, resource_servers)
     return {'token': token, 'valid': val}
 
 
 @router.get("/all/logout")
-async def logout_all(token: str =  Depends(oauth2_scheme),  resource_servers: Dict[str, auth_service.ResourceServer] = Depends(get_resource_serves), cred_store:auth_service.CredentialsStore = Depends(get_credential_store)):
+def logout_all(token: str =  Depends(oauth2_scheme),  resource_servers: Dict[str, auth_service.ResourceServer] = Depends(get_resource_serves), cred_store:auth_service.CredentialsStore = Depends(get_credential_store)):
     for serv_name, serv in resource_servers.items():
         serv.logout(token)
         cred_store.remove(token, serv_name)
     return  {"logged out": token}
 
 @router.get("/{service}/logout")
-async def logout_single(service: str, token: str =  Depends(oauth2_scheme), cred_store:auth_service.CredentialsStore = Depends(get_credential_store), resource_servers: Dict[str, auth_service.ResourceServer] = Depends(get_resource_serves)):
-    import pytest; pytest.set_trace()
+def logout_single(service: str, token: str =  Depends(oauth2_scheme), cred_store:auth_service.CredentialsStore = Depends(get_credential_store), resource_servers: Dict[str, auth_service.ResourceServer] = Depends(get_resource_serves)):
     rs = resource_servers[service]
     rs.logout(token)
     cred_store.remove(token, service)
@@ -152,7 +151,7 @@ def get_openbis(token: str =  Depends(oauth2_scheme), resource_servers: Dict[str
 
 
 @router.get("/{service}/me", response_model= Union[openbis_service.OpenbisUser,  ldap.LdapUser])
-async def read_users_me(service: str, token: str = Depends(oauth2_scheme), cred_store:auth_service.CredentialsStore = Depends(get_credential_store), resource_servers: Dict[str, auth_service.ResourceServer] = Depends(get_resource_serves)):
+def read_users_me(service: str, token: str = Depends(oauth2_scheme), cred_store:auth_service.CredentialsStore = Depends(get_credential_store), resource_servers: Dict[str, auth_service.ResourceServer] = Depends(get_resource_serves)):
     return get_user(service, cred_store, resource_servers)(token)
 
 
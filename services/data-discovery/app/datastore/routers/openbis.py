@@ -1,7 +1,8 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
 from datastore.routers.login import get_openbis, get_user
 from datastore.services.openbis import OpenbisUser
-import pytest
+from datastore.services import tree as tree_service
+from datastore.utils import http
 from pybis import Openbis
 
 from datastore.models.openbis import JRPCRequest, JRPCResponse, OpenbisJRPCEndpoints
@@ -22,19 +23,40 @@ OpenbisTreeObject.update_forward_refs()
 
 
 @router.get("/tree", response_model=ic_views.TreeElement)
-async def get_tree(ob: Openbis = Depends(get_openbis)):
-    return ic_views.build_sample_tree_from_list(ob)
+def get_tree(request: Request, ob: Openbis = Depends(get_openbis), trees: tree_service.TreeCache = Depends(tree_service.get_tree_cache)):
+    """
+    Returns the sample tree of the instance from the tree cache.
+    Returns 304 if the tree did not change since the version in `If-None-Match`
+    """
+    body, etag = trees.get(ob).serialised
+    if http.etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    return Response(body, media_type='application/json', headers={'ETag': etag})
+
+
+@router.get("/children", response_model=ic_views.TreePage)
+def get_children(identifier: str = '/', type: OpenbisHierarcy = OpenbisHierarcy.INSTANCE, cursor: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=1000), depth: int = Query(1, ge=1, le=3), ob: Openbis = Depends(get_openbis)):
+    """
+    Returns one page of the children of the object `identifier`.
+    Pass the returned `next_cursor` as `cursor` to get the next page.
+    With `depth` > 1 the first `limit` children of each child are nested in the result,
+    as long as this needs at most `MAX_NESTED_FETCHES` requests (400 otherwise)
+    """
+    try:
+        return ic_views.get_children_page(ob, identifier, type, cursor, limit, depth)
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
 
 
 @router.get('/dataset_types')
-async def get_dataset_types(ob: Openbis = Depends(get_openbis)):
+def get_dataset_types(ob: Openbis = Depends(get_openbis)):
     return ob.get_dataset_types().df.permId.to_list()
 
 # Methods to handle openbis objects
 
 
 @router.get('/', response_model=OpenbisTreeObject)
-async def get_object_info(identifier: str, type: OpenbisHierarcy, ob: Openbis = Depends(get_openbis)) -> OpenbisTreeObject:
+def get_object_info(identifier: str, type: OpenbisHierarcy, ob: Openbis = Depends(get_openbis)) -> OpenbisTreeObject:
     match type:
         case OpenbisHierarcy.PROJECT:
             return OpenbisProject.from_openbis(ob, identifier)
@@ -49,7 +71,7 @@ async def get_object_info(identifier: str, type: OpenbisHierarcy, ob: Openbis =
 
 
 @router.put('/', response_model=OpenbisTreeObject)
-async def update_object(identifier: str, type: OpenbisHierarcy, properties: Dict, ob: Openbis = Depends(get_openbis)):
+def update_object(identifier: str, type: OpenbisHierarcy, properties: Dict, ob: Openbis = Depends(get_openbis)):
     """
     Update object properties
     """
@@ -67,14 +89,9 @@ async def update_object(identifier: str, type: OpenbisHierarcy, properties: Dict
 
 
 
-@functools.lru_cache
-def get_tree(ob: Openbis) -> ic_views.TreeElement:
-    return ic_views.build_sample_tree_from_list(ob)
-
-
 @router.delete('/')
-async def delete(identifier: str, ob: Openbis = Depends(get_openbis)):
-    obj = get_tree(ob).find(identifier)
+def delete(identifier: str, ob: Openbis = Depends(get_openbis), trees: tree_service.TreeCache = Depends(tree_service.get_tree_cache)):
+    obj = trees.get(ob).find(identifier)
     getters = {
         'SPACE': ob.get_space,
         'OBJECT': ob.get_object,
@@ -84,6 +101,7 @@ async def delete(identifier: str, ob: Openbis = Depends(get_openbis)):
         try:
             ob_obj = getters[obj.type.value](identifier)
             ob_obj.delete("User requested")
+            trees.remove(ob, identifier)
         except Exception as e:
             raise HTTPException(401, detail=e)
     else:
@@ -95,7 +113,7 @@ async def delete(identifier: str, ob: Openbis = Depends(get_openbis)):
 
 
 @router.post('/{endpoint}', response_model=JRPCResponse)
-async def json_endpoint(endpoint: str, body: JRPCRequest, ob: Openbis = Depends(get_openbis)):
+def json_endpoint(endpoint: str, body: JRPCRequest, ob: Openbis = Depends(get_openbis)):
     """
     Passthrough endpoint that simply connects to the  JSON-RPC 
     API endpoints of the openbis AS / DSS
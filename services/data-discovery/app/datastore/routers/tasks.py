@@ -1,17 +1,19 @@
-from multiprocessing import connection
-from fastapi import APIRouter, Depends, HTTPException, WebSocket
+import asyncio
+import contextlib
+from fastapi import APIRouter, Depends, HTTPException, Query, WebSocket, WebSocketDisconnect
+from starlette.websockets import WebSocketState
 from datastore.utils.redis import get_redis
 from datastore.routers.login import get_openbis, get_user, oauth2_scheme
-from datastore.routers.data import get_user_instance
+from datastore.routers.data import get_user_instance, get_ldap_user
+from datastore.services.ldap import ldap
 from datastore.services.openbis import OpenbisUser
 from datastore.utils.rq import get_queue
-import pytest
 from pybis import Openbis
-import async_timeout
 from rq import Queue
-from redis.asyncio import Redis
+from datastore.services import messages as message_service, jobs as job_service
+from datastore.models.jobs import JobRecord, JobEventRecord
 
-from typing import Dict
+from typing import Dict, List
 
 from instance_creator.models import OpenbisTreeObject, OpenbisProject, OpenbisSample, OpenbisCollection, OpenbisInstance, OpenbisSpace
 import instance_creator.views as ic_views
@@ -27,29 +29,64 @@ logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/tasks")
 
 
-async def get_messages(redis: Redis, id: str):
-    pubsub = redis.pubsub()
-    await pubsub.subscribe(id)
-    while True:
-        async with async_timeout.timeout(1):
-            m = await pubsub.get_message()
-            if m is not None:
-                yield m
+def get_progress_broker(websocket: WebSocket) -> message_service.ProgressBroker:
+    """
+    Returns the progress broker of the app, which is shared by all sockets
+    """
+    state = websocket.app.state
+    if getattr(state, 'progress_broker', None) is None:
+        state.progress_broker = message_service.ProgressBroker(get_redis(sync=False))
+    return state.progress_broker
+
 
 @router.websocket("/tasks/log")
-async def parser_status(websocket: WebSocket, id:str):
-    logger.info("opened socket")
-    redis = get_redis(sync=False)
+async def parser_status(websocket: WebSocket, id: str, broker: message_service.ProgressBroker = Depends(get_progress_broker)):
+    """
+    Streams the progress messages of the job `id` until the job finishes or fails.
+    A client reading slowly receives the latest state instead of every update
+    """
     await websocket.accept()
-    async for m in get_messages(redis, id):
-        print(m)
-        await websocket.send_text(str(m))
-    await connection.close()
-    await websocket.close()
+    #Completes when the client sends a message or disconnects
+    receiver = asyncio.create_task(websocket.receive())
+    getter = None
+    try:
+        async with broker.subscribe(id) as mailbox:
+            while True:
+                getter = asyncio.create_task(mailbox.get())
+                done, _ = await asyncio.wait({getter, receiver}, return_when=asyncio.FIRST_COMPLETED)
+                if getter not in done:
+                    break
+                message = getter.result()
+                await websocket.send_text(message.json())
+                if message.stage.terminal:
+                    break
+    except WebSocketDisconnect:
+        pass
+    finally:
+        pending = [task for task in (getter, receiver) if task is not None]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if websocket.client_state == WebSocketState.CONNECTED:
+            with contextlib.suppress(RuntimeError, WebSocketDisconnect):
+                await websocket.close()
 
 
-@router.get("/task_list", response_model=Dict)
-async def get_parser_parameters(inst: str = Depends(get_user_instance), user = Depends(get_user), queue:Queue = Depends(get_queue)) -> Dict:
+@router.get("/task_list", response_model=List[JobRecord])
+def get_task_list(start: int = Query(0, ge=0), count: int = Query(50, ge=1, le=500), user: ldap.LdapUser = Depends(get_ldap_user), ledger: job_service.JobLedger = Depends(job_service.get_job_ledger)) -> List[JobRecord]:
+    """
+    Gets the tasks of the user, most recent first
+    """
+    return ledger.user_jobs(user.username, start, count)
+
+
+@router.get("/history", response_model=List[JobEventRecord])
+def get_task_history(id: str, start: str = '-', count: int | None = Query(None, ge=1), user: ldap.LdapUser = Depends(get_ldap_user), ledger: job_service.JobLedger = Depends(job_service.get_job_ledger)) -> List[JobEventRecord]:
+    """
+    Gets the lifecycle and progress events of the task `id`.
+    Pass the id of the last received event as `start` to continue reading
     """
-    Gets a list of tasks
-    """
\ No newline at end of file
+    job = ledger.get(id)
+    if job is None or job.user != user.username:
+        raise HTTPException(404, detail=f"No task with id {id}")
+    return ledger.events(id, start, count)
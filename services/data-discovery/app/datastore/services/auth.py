@@ -7,9 +7,9 @@ from venv import create
 from wsgiref import validate
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm, OAuth2
-from datastore.utils import settings
+from datastore.utils import settings, cache as cache_utils
 from datastore.models import  auth as auth_models
-from datastore.services.ldap import  ldap
+from datastore.services.ldap import  ldap, session as ldap_session
 from datastore.services import openbis as openbis_service
 
 from datetime import datetime, timedelta
@@ -247,33 +247,53 @@ class ResourceServer(ABC):
 class ResourceServerLdap(ResourceServer):
 
     id: str
-    principal_connection: ldap.Connection
+    principal_pool: ldap_session.LdapConnectionPool
+    user_cache: cache_utils.TTLCache = dataclasses.field(default_factory=cache_utils.get_user_cache)
 
     def login(self, username: str, password:str) -> Tuple[str, Credentials]:
-        with self.principal_connection as pc:
+        with self.principal_pool.connection() as pc:
             with ldap.auth.authenticate(pc, username, password) as con:
                 token = self.context.create_access_token(auth_models.TokenData(aud=[self.id], sub=username))
                 cd = Credentials(sub=username, aud=self.id, secret=password)
                 return token, cd
 
+    def _lookup_user(self, uid: str) -> ldap.LdapUser | None:
+        """
+        Returns the LDAP record of `uid`, searching LDAP only
+        if the user is not in the user cache
+        """
+        def load() -> ldap.LdapUser | None:
+            with self.principal_pool.connection() as pc:
+                return ldap.get_user_info(pc, uid)
+        return self.user_cache.get_or_load(uid, load)
+
+    def _verified_user(self, token: str) -> ldap.LdapUser | None:
+        token_data = self.context.decode_access_token(token, self.id)
+        user = self._lookup_user(token_data.sub)
+        if user is not None and user.username == token_data.sub and self.id in token_data.aud:
+            return user
+
     def logout(self, token: str) -> None:
-        pass
+        try:
+            token_data = self.context.decode_access_token(token, self.id)
+        except Exception as e:
+            return
+        self.user_cache.invalidate(token_data.sub)
 
     def verify(self, token: str) -> bool:
         try:
-            token_data = self.context.decode_access_token(token, self.id)
-            with self.principal_connection as pc:
-                user = ldap.get_user_info(pc, token_data.sub)
-            return user.username == token_data.sub and self.id in token_data.aud
+            return self._verified_user(token) is not None
         except Exception as e:
             return False
 
     
     def get_user_info(self, token: str) -> ldap.LdapUser:
-        if self.verify(token):
-            with self.principal_connection as pc:
-                token_content = self.context.decode_access_token(token, self.id)
-                return ldap.get_user_info(pc, token_content.sub)
+        try:
+            user = self._verified_user(token)
+        except Exception as e:
+            user = None
+        if user is not None:
+            return user
         else:
             raise JWTError("Cannot verify token")
 
@@ -0,0 +1,171 @@
+"""
+Job ledger.
+Every job created with `rq_utils.create_job` leaves a persistent trace in redis:
+- `jobs:<id>:events`, a stream with all lifecycle and progress events of the job
+- `jobs:<id>`, a hash with the current summary of the job
+- `jobs:user:<user>`, a sorted set of the job ids of a user, scored by enqueue time
+The keys of a job expire `job_ledger_ttl` seconds after its last event
+and only the `job_ledger_user_limit` most recent jobs of a user are indexed,
+so listing the jobs of a user is a range read on the sorted set.
+The lifecycle events are recorded when enqueuing and by rq callbacks,
+the progress events by :obj:`datastore.services.messages.ProgressReporter`.
+"""
+import time
+import traceback
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+
+import redis
+from rq.job import Job
+
+from datastore.models.jobs import JobEvent, JobEventRecord, JobRecord
+from datastore.models.messages import ProgressMessage, ProgressStage
+from datastore.utils import settings
+from datastore.utils.redis import get_redis
+
+
+def job_key(job_id: str) -> str:
+    return f"jobs:{job_id}"
+
+
+def events_key(job_id: str) -> str:
+    return f"jobs:{job_id}:events"
+
+
+def user_key(user: str) -> str:
+    return f"jobs:user:{user}"
+
+
+def _timestamp(value: datetime | None) -> float | None:
+    if value is None:
+        return None
+    #rq stores naive UTC datetimes
+    return value.replace(tzinfo=timezone.utc).timestamp() if value.tzinfo is None else value.timestamp()
+
+
+def _decode(value: bytes | str) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class JobLedger:
+    """
+    Records and queries the events of the jobs
+    """
+
+    def __init__(self, connection: redis.Redis, ttl: int | None = None, user_limit: int | None = None, max_events: int | None = None) -> None:
+        st = settings.get_settings()
+        self.connection = connection
+        self.ttl = ttl or st.job_ledger_ttl
+        self.user_limit = user_limit or st.job_ledger_user_limit
+        self.max_events = max_events or st.job_ledger_max_events
+
+    def record(self, job_id: str, event: JobEvent, summary: Dict[str, Any] | None = None, pipe: redis.client.Pipeline | None = None, **fields) -> None:
+        """
+        Appends an event to the stream of the job and updates its summary.
+        If `pipe` is given, the commands are only queued on it
+        """
+        now = time.time()
+        own_pipe = pipe is None
+        pipe = self.connection.pipeline(transaction=False) if own_pipe else pipe
+        entry = {'event': event.value, 'time': now, **{k: v for k, v in fields.items() if v is not None}}
+        pipe.xadd(events_key(job_id), {k: str(v) for k, v in entry.items()}, maxlen=self.max_events, approximate=True)
+        #Progress events do not change the lifecycle status
+        status = {} if event == JobEvent.PROGRESS else {'status': event.value}
+        values = {k: str(v) for k, v in {'id': job_id, **status, **(summary or {})}.items() if v is not None}
+        pipe.hset(job_key(job_id), mapping=values)
+        pipe.expire(job_key(job_id), self.ttl)
+        pipe.expire(events_key(job_id), self.ttl)
+        if own_pipe:
+            pipe.execute()
+
+    def enqueued(self, job: Job) -> None:
+        user = job.meta.get('user')
+        enqueued_at = _timestamp(job.enqueued_at) or time.time()
+        pipe = self.connection.pipeline(transaction=False)
+        self.record(job.id, JobEvent.ENQUEUED, {'user': user, 'function': job.func_name, 'description': job.description, 'enqueued_at': enqueued_at}, pipe=pipe, user=user)
+        if user is not None:
+            pipe.zadd(user_key(user), {job.id: enqueued_at})
+            #Only keep the most recent jobs
+            pipe.zremrangebyrank(user_key(user), 0, -self.user_limit - 1)
+            pipe.expire(user_key(user), self.ttl)
+        pipe.execute()
+
+    def ended(self, job: Job, event: JobEvent, detail: str | None = None) -> None:
+        enqueued_at, started_at = _timestamp(job.enqueued_at), _timestamp(job.started_at)
+        ended_at = _timestamp(job.ended_at) or time.time()
+        summary = {
+            'started_at': started_at,
+            'ended_at': ended_at,
+            'queued_seconds': started_at - enqueued_at if started_at and enqueued_at else None,
+            'run_seconds': ended_at - started_at if started_at else None,
+            'detail': detail}
+        self.record(job.id, event, summary, detail=detail, run_seconds=summary['run_seconds'])
+
+    def progress(self, message: ProgressMessage, pipe: redis.client.Pipeline | None = None) -> None:
+        """
+        Records a progress message. The first STARTED message marks the start of the job
+        """
+        summary = {'stage': message.stage.value, 'percent': message.percent, 'detail': message.detail}
+        event = JobEvent.STARTED if message.stage == ProgressStage.STARTED else JobEvent.PROGRESS
+        if event == JobEvent.STARTED:
+            summary['started_at'] = message.time
+        counters = message.dict(exclude={'job_id', 'time', 'stage', 'percent', 'detail'})
+        self.record(message.job_id, event, summary, pipe=pipe, stage=message.stage.value, percent=message.percent, **counters)
+
+    def get(self, job_id: str) -> JobRecord | None:
+        values = self.connection.hgetall(job_key(job_id))
+        if not values:
+            return None
+        return JobRecord.parse_obj({_decode(k): _decode(v) for k, v in values.items()})
+
+    def events(self, job_id: str, start: str = '-', count: int | None = None) -> List[JobEventRecord]:
+        """
+        Returns the events of a job, oldest first, starting at the stream id `start`
+        """
+        entries = self.connection.xrange(events_key(job_id), min=start, count=count)
+        records = []
+        for entry_id, fields in entries:
+            fields = {_decode(k): _decode(v) for k, v in fields.items()}
+            records.append(JobEventRecord(id=_decode(entry_id), event=fields.pop('event'), time=fields.pop('time'), fields=fields))
+        return records
+
+    def user_jobs(self, user: str, start: int = 0, count: int = 50) -> List[JobRecord]:
+        """
+        Returns the jobs of `user`, most recent first
+        """
+        ids = self.connection.zrevrange(user_key(user), start, start + count - 1)
+        pipe = self.connection.pipeline(transaction=False)
+        for job_id in ids:
+            pipe.hgetall(job_key(_decode(job_id)))
+        jobs = []
+        for values in pipe.execute() if ids else []:
+            #The summary may have expired before the index entry
+            if values:
+                jobs.append(JobRecord.parse_obj({_decode(k): _decode(v) for k, v in values.items()}))
+        return jobs
+
+
+def get_job_ledger() -> JobLedger:
+    return JobLedger(get_redis())
+
+
+def on_job_success(job: Job, connection: redis.Redis, result: Any, *args, **kwargs) -> None:
+    """
+    rq callback recording the end of a successful job
+    """
+    JobLedger(connection).ended(job, JobEvent.FINISHED)
+
+
+def on_job_failure(job: Job, connection: redis.Redis, type, value, tb) -> None:
+    """
+    rq callback recording the failure of a job
+    """
+    detail = ''.join(traceback.format_exception_only(type, value)).strip()
+    JobLedger(connection).ended(job, JobEvent.FAILED, detail)
+
+
+def on_job_stopped(job: Job, connection: redis.Redis) -> None:
+    """
+    rq callback recording a job stopped on request
+    """
+    JobLedger(connection).ended(job, JobEvent.STOPPED)
@@ -21,7 +21,11 @@ def authenticate(principal_con: Connection, username: str, password: str):
     set = settings.get_settings()
     user_info = ldap.get_user_info(principal_con, username)
     try:
-        con = Connection(server, user=user_info.dn, password=password, auto_bind=True, authentication=set.ldap_authentication)
+        #Bind without reading the server info again, it is already cached on the server object
+        con = Connection(server, user=user_info.dn, password=password, authentication=set.ldap_authentication)
+        con.open(read_server_info=False)
+        if not con.bind(read_server_info=False):
+            raise LDAPException(f"Cannot bind as {user_info.dn}")
     except LDAPException as e:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail=f"Invalid authentication credentials {username}, {password}"
@@ -1,16 +1,137 @@
 from asyncio.log import logger
-from ldap3 import Connection, Server, ALL, SAFE_SYNC
+from ldap3 import Connection, Server, ALL, SAFE_SYNC, BASE
+from ldap3.core.exceptions import LDAPException
 from ...utils import settings
 import contextlib
 from fastapi import logger
+import functools
+from functools import cache
+from typing import Callable, Generator, List, Tuple
+import threading
+import time
 
+
+@cache
 def get_server() -> Server:
+    """
+    Returns the LDAP server. The server information (DSE and schema)
+    is only read by the first connection which binds to it
+    """
     st = settings.get_settings()
-    print(st)
     ldap_server = Server(st.ldap_server, st.ldap_port, get_info=ALL)
     return ldap_server
 
 def get_ldap_connection() -> Connection:
+    """
+    Returns a new connection bound with the principal user
+    """
     st = settings.get_settings()
     ldap_server = get_server()
-    return Connection(ldap_server, st.ldap_principal_name, st.ldap_principal_password, client_strategy=SAFE_SYNC)
+    con = Connection(ldap_server, st.ldap_principal_name, st.ldap_principal_password, client_strategy=SAFE_SYNC)
+    con.open(read_server_info=False)
+    #With SAFE_SYNC, bind returns a (status, result, response, request) tuple
+    con.bind(read_server_info=ldap_server.info is None)
+    if not con.bound:
+        con.unbind()
+        raise LDAPException(f"Cannot bind to {ldap_server} as {st.ldap_principal_name}: {con.last_error}")
+    return con
+
+def check_connection(con: Connection, base: str = '') -> bool:
+    """
+    Health check for a connection, by reading the entry `base`
+    (by default the root DSE) without requesting any attribute
+    """
+    if con.closed or not con.bound:
+        return False
+    try:
+        status, *_ = con.search(base, '(objectClass=*)', search_scope=BASE, attributes=['1.1'])
+        return status and not con.closed
+    except LDAPException:
+        return False
+
+
+class LdapConnectionPool:
+    """
+    A pool of at most `size` bound connections created with `factory`.
+    Idle connections which were not used for more than `health_interval` seconds
+    are checked with `check` before being handed out and replaced
+    if they are broken.
+    """
+
+    def __init__(self, factory: Callable[[], Connection], size: int = 5, health_interval: float = 30.0, timeout: float | None = None, check: Callable[[Connection], bool] = check_connection) -> None:
+        self.factory = factory
+        self.check = check
+        self.size = size
+        self.health_interval = health_interval
+        self.timeout = timeout
+        self._idle: List[Tuple[Connection, float]] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _checkout(self) -> Connection:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                con, last_used = self._idle.pop()
+            if time.monotonic() - last_used < self.health_interval or self.check(con):
+                return con
+            logger.logger.info(f"Discarding unhealthy LDAP connection {con}")
+            self._discard(con)
+        return self.factory()
+
+    def _discard(self, con: Connection) -> None:
+        try:
+            con.unbind()
+        except LDAPException:
+            pass
+
+    @contextlib.contextmanager
+    def connection(self) -> Generator[Connection, None, None]:
+        """
+        Context manager to borrow a connection from the pool.
+        Connections raising an LDAP error or interrupted by a non-`Exception`
+        are discarded instead of being returned to the pool.
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise LDAPException(f"No LDAP connection available after {self.timeout} s")
+        try:
+            con = self._checkout()
+            try:
+                yield con
+            except LDAPException:
+                self._discard(con)
+                raise
+            except Exception:
+                #Errors of the caller (e.g. a wrong password) leave the connection usable
+                self._release(con)
+                raise
+            except BaseException:
+                self._discard(con)
+                raise
+            else:
+                self._release(con)
+        finally:
+            self._slots.release()
+
+    def _release(self, con: Connection) -> None:
+        with self._lock:
+            self._idle.append((con, time.monotonic()))
+
+    def close(self) -> None:
+        """
+        Unbinds all idle connections
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for con, _ in idle:
+            self._discard(con)
+
+
+@cache
+def get_ldap_pool() -> LdapConnectionPool:
+    """
+    Returns the process-wide pool of principal connections
+    """
+    st = settings.get_settings()
+    return LdapConnectionPool(get_ldap_connection, st.ldap_pool_size, st.ldap_pool_health_interval, st.ldap_pool_timeout, functools.partial(check_connection, base=st.ldap_base))
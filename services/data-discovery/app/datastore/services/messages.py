@@ -0,0 +1,213 @@
+"""
+Job progress events.
+Workers publish :obj:`ProgressMessage` on a redis channel per job
+and keep the last message of every job for late subscribers.
+In the API, a single :obj:`ProgressBroker` per process listens to all
+progress channels with one redis connection and fans the messages out
+to the subscribed websockets. Every subscriber has a mailbox which only
+keeps the latest message, so a slow consumer skips intermediate updates
+instead of buffering them.
+"""
+import asyncio
+import contextlib
+import logging
+import time
+from typing import AsyncIterator, Dict, Set
+
+import redis
+import redis.asyncio as redis_async
+from rq import get_current_job
+
+from datastore.models.messages import ProgressMessage, ProgressStage
+from datastore.services.jobs import JobLedger
+from datastore.utils import settings
+from datastore.utils.redis import get_redis
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_PREFIX = 'progress:'
+LAST_PREFIX = 'progress-last:'
+
+
+def progress_channel(job_id: str) -> str:
+    return f"{PROGRESS_PREFIX}{job_id}"
+
+
+def last_key(job_id: str) -> str:
+    return f"{LAST_PREFIX}{job_id}"
+
+
+def publish_progress(connection: redis.Redis, message: ProgressMessage, ttl: int | None = None) -> None:
+    """
+    Publishes a progress message, stores it as the last state of the job
+    and records it in the job ledger
+    """
+    ttl = ttl or settings.get_settings().progress_ttl
+    body = message.json()
+    pipe = connection.pipeline(transaction=False)
+    pipe.set(last_key(message.job_id), body, ex=ttl)
+    pipe.publish(progress_channel(message.job_id), body)
+    JobLedger(connection).progress(message, pipe=pipe)
+    pipe.execute()
+
+
+class ProgressReporter:
+    """
+    Publishes the progress of one job. Updates sent less than `min_interval`
+    seconds after the previous one are dropped, changes of stage
+    are always published
+    """
+
+    def __init__(self, connection: redis.Redis, job_id: str, min_interval: float | None = None, clock=time.monotonic) -> None:
+        self.connection = connection
+        self.job_id = job_id
+        self.min_interval = settings.get_settings().progress_min_interval if min_interval is None else min_interval
+        self.clock = clock
+        self._last: ProgressMessage | None = None
+        self._sent = float('-inf')
+
+    def update(self, stage: ProgressStage | None = None, **counters) -> bool:
+        """
+        Reports the progress, keeping the stage and counters of the
+        previous update which are not given. Returns True if the update was published
+        """
+        previous = self._last.dict(exclude={'job_id', 'time', 'percent'}) if self._last else {}
+        stage = stage or previous.get('stage', ProgressStage.STARTED)
+        message = ProgressMessage(job_id=self.job_id, **{**previous, **counters, 'stage': stage})
+        if message.percent is None and message.bytes_total:
+            message.percent = min(100.0, 100.0 * (message.bytes_processed or 0) / message.bytes_total)
+        elif message.percent is None and message.items_total:
+            message.percent = min(100.0, 100.0 * (message.items_processed or 0) / message.items_total)
+        stage_changed = self._last is None or self._last.stage != stage
+        self._last = message
+        if not stage_changed and self.clock() - self._sent < self.min_interval:
+            return False
+        publish_progress(self.connection, message)
+        self._sent = self.clock()
+        return True
+
+
+def current_reporter() -> ProgressReporter | None:
+    """
+    Returns a reporter for the rq job running in this process, if any
+    """
+    connection = get_redis()
+    job = get_current_job(connection=connection)
+    return ProgressReporter(connection, job.id) if job is not None else None
+
+
+class Mailbox:
+    """
+    Holds the latest undelivered message of a subscription
+    """
+
+    def __init__(self) -> None:
+        self._message: ProgressMessage | None = None
+        self._newest = float('-inf')
+        self._event = asyncio.Event()
+        self.coalesced = 0
+
+    def put(self, message: ProgressMessage) -> None:
+        #Messages older than the newest one (e.g. the stored last state) are ignored
+        if message.time < self._newest:
+            return
+        if self._message is not None:
+            self.coalesced += 1
+        self._newest = message.time
+        self._message = message
+        self._event.set()
+
+    async def get(self) -> ProgressMessage:
+        """
+        Waits for and returns the latest message
+        """
+        await self._event.wait()
+        self._event.clear()
+        message, self._message = self._message, None
+        return message
+
+
+class ProgressBroker:
+    """
+    Dispatches the progress messages of all jobs to the subscribed mailboxes
+    using a single redis subscription. The subscription is opened on the
+    first `subscribe` and reopened after any error, waiting `retry_interval`
+    seconds, doubled after every consecutive failure up to `max_retry_interval`.
+    """
+
+    def __init__(self, connection: redis_async.Redis, retry_interval: float = 1.0, max_retry_interval: float = 30.0) -> None:
+        self.connection = connection
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.mailboxes: Dict[str, Set[Mailbox]] = {}
+        self._task: asyncio.Task | None = None
+        self._subscribed: asyncio.Event | None = None
+
+    async def _listen(self) -> None:
+        delay = self.retry_interval
+        while True:
+            pubsub = self.connection.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.psubscribe(f"{PROGRESS_PREFIX}*")
+                self._subscribed.set()
+                delay = self.retry_interval
+                async for raw in pubsub.listen():
+                    self.dispatch(raw)
+            except (redis.ConnectionError, redis.TimeoutError, OSError) as e:
+                logger.warning(f"Progress subscription lost: {e}")
+            except Exception:
+                #Any other error would otherwise stop the progress of all subscribers
+                logger.exception("Progress subscription failed")
+            finally:
+                with contextlib.suppress(Exception):
+                    await pubsub.close()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_retry_interval)
+
+    def dispatch(self, raw: Dict) -> None:
+        if raw.get('type') != 'pmessage':
+            return
+        channel = raw['channel'].decode() if isinstance(raw['channel'], bytes) else raw['channel']
+        #Messages are parsed once, and only if someone listens
+        if not (mailboxes := self.mailboxes.get(channel.removeprefix(PROGRESS_PREFIX))):
+            return
+        try:
+            message = ProgressMessage.parse_raw(raw['data'])
+        except ValueError:
+            logger.warning(f"Invalid progress message on {channel}")
+            return
+        for mailbox in mailboxes:
+            mailbox.put(message)
+
+    async def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._subscribed = asyncio.Event()
+            self._task = asyncio.create_task(self._listen())
+        await self._subscribed.wait()
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.connection.close()
+
+    @contextlib.asynccontextmanager
+    async def subscribe(self, job_id: str) -> AsyncIterator[Mailbox]:
+        """
+        Subscribes to the progress of `job_id`. The mailbox
+        initially holds the last published state of the job, if any
+        """
+        await self.start()
+        mailbox = Mailbox()
+        self.mailboxes.setdefault(job_id, set()).add(mailbox)
+        try:
+            if (last := await self.connection.get(last_key(job_id))) is not None:
+                mailbox.put(ProgressMessage.parse_raw(last))
+            yield mailbox
+        finally:
+            subscribers = self.mailboxes.get(job_id, set())
+            subscribers.discard(mailbox)
+            if not subscribers:
+                self.mailboxes.pop(job_id, None)
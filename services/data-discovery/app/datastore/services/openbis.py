@@ -11,7 +11,8 @@ from datastore.models import openbis as openbis_models
 import pathlib as pl
 from instance_creator import views as openbis_views
 from fastapi import Form
-from functools import cache
+from functools import cache, lru_cache
+import json
 import requests
 
 @dataclass
@@ -27,6 +28,48 @@ def get_openbis() -> pybis.Openbis:
     return pybis.Openbis(config.openbis_server, verify_certificates=False, token=False, allow_http_but_do_not_use_this_in_production_and_only_within_safe_networks=True, use_cache=True)
 
 
+class KeepAliveOpenbis(pybis.Openbis):
+    """
+    :obj:`pybis.Openbis` sending its JSON-RPC requests through one :obj:`requests.Session`,
+    so that consecutive calls reuse the same HTTP connection
+    instead of opening a new one each time
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        self.session = requests.Session()
+        super().__init__(*args, **kwargs)
+
+    def _post_request_full_url(self, full_url, request):
+        request.setdefault("id", "2")
+        request.setdefault("jsonrpc", "2.0")
+        if request["params"][0] is None:
+            raise ValueError("Your session expired, please log in again")
+        resp = self.session.post(full_url, json.dumps(request), verify=self.verify_certificates)
+        if not resp.ok:
+            raise ValueError("general error while performing post request")
+        resp = resp.json()
+        if "error" in resp:
+            raise ValueError(resp["error"]["message"])
+        elif "result" in resp:
+            return resp["result"]
+        else:
+            raise ValueError("request did not return either result nor error")
+
+
+@lru_cache(maxsize=64)
+def get_openbis_connection(url: str, token: str) -> pybis.Openbis:
+    """
+    Returns the connection to `url` for the session `token`.
+    Connections are cached per process, so all the jobs of a session
+    run by a worker share one connection and its pybis cache.
+    The token is not checked here, an expired session fails on the first request
+    """
+    ob = KeepAliveOpenbis(url, verify_certificates=False, token=False, allow_http_but_do_not_use_this_in_production_and_only_within_safe_networks=True, use_cache=True)
+    #The token setter would validate the token with a request and save it to disk
+    ob.__dict__["token"] = token
+    return ob
+
+
 
 @contextlib.contextmanager
 def openbis_login(username: str, password: str) -> str:
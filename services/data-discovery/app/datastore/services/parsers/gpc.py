@@ -1,10 +1,13 @@
 from datastore.services.parsers.interfaces import OpenbisDatasetParser
+from datastore.services.parsers import previews
+from datastore.utils import files
+import itertools
+import logging
 import pathlib as pl
-from tkinter.ttk import Separator
+from typing import TYPE_CHECKING, Any, Iterable, Iterator, List, Tuple
+import numpy as np
 import pandas as pd
 import argparse as ap
-import matplotlib as mpl
-import matplotlib.figure as mpf
 import dataclasses
 from pydantic import BaseModel, fields
 import datetime as dt
@@ -12,6 +15,14 @@ from pybis import Openbis
 from pybis.openbis_object import Transaction
 from pybis.dataset import DataSet
 
+if TYPE_CHECKING:
+    import matplotlib.figure as mpf
+
+LOGGER = logging.getLogger(__name__)
+
+CHANNELS_HEADER = "Sample Channel Information"
+RAW_DATA_HEADER = "Raw Data"
+
 class AdministrativeInformation(BaseModel):
     exported: dt.datetime = fields.Field(alias='Export Date')
     locale: str = fields.Field(alias='Culture')
@@ -37,21 +48,98 @@ def find_metadata(header: str, data: pd.DataFrame) -> pd.DataFrame:
 
 
 
-def import_gcp_data(path: pl.Path) -> pd.DataFrame:
-    raw_data = pd.read_excel(path, sheet_name=1, header=None)
-    detector_metadata = find_metadata("Sample Channel Information", raw_data)
-    start_row = (raw_data.iloc[:, 0] == 'Raw Data').idxmax() + 1
-    raw_data_plot = raw_data.iloc[start_row:, :]
-    raw_data_names = raw_data_plot.iloc[0, :]
-    raw_data_values = raw_data_plot.iloc[1:, :]
-    return raw_data_values.rename(columns=lambda x:  detector_metadata.iloc[x-1, 1] if x > 0 else 'RT')
+def iter_sheet_rows(path: pl.Path, sheet: int = 1) -> Iterator[Tuple[Any, ...]]:
+    """
+    Streams the values of the rows of the sheet number `sheet`,
+    without loading the whole workbook in memory
+    """
+    import openpyxl
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        yield from wb.worksheets[sheet].iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def _block(rows: Iterator[Tuple[Any, ...]]) -> Iterator[Tuple[Any, ...]]:
+    #A block ends at the first row with an empty first cell
+    return itertools.takewhile(lambda row: bool(row) and row[0] is not None, rows)
+
+
+def read_gcp_sheet(rows: Iterable[Tuple[Any, ...]]) -> Tuple[List[str], np.ndarray]:
+    """
+    Reads the column names and the raw data of a GPC export from its rows.
+    The rows are only scanned until the channel block and the raw data are found,
+    and the raw data is read until its first empty row.
+    Returns the column names (`RT` and the channel names) and the data as floats
+    """
+    rows = iter(rows)
+    if not any(row and row[0] == CHANNELS_HEADER for row in rows):
+        raise ValueError(f"The sheet has no {CHANNELS_HEADER} block")
+    #The first row of the block contains the names of its columns
+    _, *channels = _block(rows)
+    names = ['RT', *(str(row[1]) for row in channels)]
+    if not any(row and row[0] == RAW_DATA_HEADER for row in rows):
+        raise ValueError(f"The sheet has no {RAW_DATA_HEADER} block")
+    #Skip the header of the raw data
+    next(rows, None)
+    values = pd.DataFrame.from_records([row[:len(names)] for row in _block(rows)], columns=range(len(names)))
+    return names, values.to_numpy(dtype=float)
+
+
+def cache_path(path: pl.Path) -> pl.Path:
+    """
+    Returns the path of the columnar cache of the GPC export `path`,
+    which changes when the export is modified
+    """
+    st = path.stat()
+    return path.with_name(f".{path.name}.{st.st_mtime_ns}-{st.st_size}{files.CACHE_SUFFIX}")
 
 
-def plot_gcp_data(fig: mpf.Figure, dt: pd.DataFrame) -> mpf.Figure:
+def write_cache(path: pl.Path, names: List[str], values: np.ndarray) -> None:
+    """
+    Stores the data read from `path` next to it, replacing the caches of older versions
+    """
+    cached = cache_path(path)
+    partial = cached.with_name(cached.name + files.PARTIAL_SUFFIX)
+    try:
+        with open(partial, 'wb') as f:
+            np.savez(f, names=np.array(names, dtype=str), values=values)
+        partial.replace(cached)
+        for stale in path.parent.glob(f".{path.name}.*{files.CACHE_SUFFIX}"):
+            if stale != cached:
+                stale.unlink(missing_ok=True)
+    except OSError as e:
+        LOGGER.warning(f"Cannot cache the data of {path}: {e}")
+        partial.unlink(missing_ok=True)
+
+
+def import_gcp_data(path: pl.Path, use_cache: bool = True) -> pd.DataFrame:
+    """
+    Imports the raw data of a GPC export, with one column per channel
+    named after the channel and the retention time in the column `RT`.
+    The data is cached next to the export and the cache is used until the export changes
+    """
+    cached = cache_path(path)
+    if use_cache and cached.exists():
+        with np.load(cached, allow_pickle=False) as npz:
+            return pd.DataFrame(npz['values'], columns=npz['names'].tolist())
+    names, values = read_gcp_sheet(iter_sheet_rows(path))
+    if use_cache:
+        write_cache(path, names, values)
+    return pd.DataFrame(values, columns=names)
+
+
+def plot_gcp_data(fig: "mpf.Figure", dt: pd.DataFrame, max_points: int = 4000) -> "mpf.Figure":
+    """
+    Plots the first four channels against the retention time,
+    with each channel reduced to at most `max_points` points
+    """
     gs = fig.add_gridspec(2, 2)
+    rt = dt.iloc[:, 0].to_numpy()
     for i in range(1, 5):
         ax = fig.add_subplot(gs[i-1])
-        ax.plot(dt['RT'], dt.iloc[:, i])
+        ax.plot(*previews.minmax_downsample(rt, dt.iloc[:, i].to_numpy(), max_points // 2))
         ax.set_ylabel(dt.columns[i])
         ax.set_xlabel(dt.columns[0])
     return fig
@@ -62,8 +150,12 @@ class GCPParser(OpenbisDatasetParser):
     """
     This parser extract plots from GCP data
     """
-    def process(self, ob: Openbis, transaction: Transaction, dataset: DataSet, *args, **kwargs) -> Transaction:
-        return super().process(ob, transaction, dataset, *args, **kwargs)
-
-
+    def previews(self, dataset: DataSet) -> List[pl.Path]:
+        source = pl.Path(dataset.file_list[0])
+        return [previews.cached_preview(source, lambda fig: plot_gcp_data(fig, import_gcp_data(source)), 'gpc')]
 
+    def process(self, ob: Openbis, transaction: Transaction, dataset: DataSet, *args, **kwargs) -> Transaction:
+        """
+        Uploads the GPC export with a plot of its channels
+        """
+        return transaction
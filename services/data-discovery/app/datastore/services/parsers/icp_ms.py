@@ -2,6 +2,7 @@ from difflib import restore
 from hmac import trans_36
 from xml.sax.handler import DTDHandler
 from datastore.services.parsers.interfaces import OpenbisDatasetParser
+from datastore.services.messages import current_reporter
 from abc import ABC, abstractmethod
 from pybis import Openbis 
 from pybis.openbis_object import Transaction
@@ -12,11 +13,13 @@ from pydantic.main import ModelMetaclass
 import zipfile 
 import tempfile
 import pathlib as pl
+import hashlib
 import logging
+import re
 
 LOGGER = logging.getLogger(__name__)
 
-from typing import List, Callable
+from typing import Any, Dict, List, Callable
 import pandas as pd
         
 def match_files(zf: pl.Path, predicate: Callable[[pl.Path], bool]) -> List[pl.PurePath]:
@@ -26,12 +29,168 @@ def clean_names(df: pd.DataFrame) -> pd.DataFrame:
     df_out = df.copy()
     return df_out.rename(lambda c: c.strip().replace(" ", "").lower().replace('-', '_').replace('.', '_'), axis="columns")  
 
+def find_members(zf: zipfile.ZipFile, name: str) -> List[zipfile.ZipInfo]:
+    """
+    Returns the members of the archive called `name`, in archive order.
+    Only the central directory is read
+    """
+    return [info for info in zf.infolist() if not info.is_dir() and pl.PurePosixPath(info.filename).name == name]
+
+def batch_log_member(zf: zipfile.ZipFile) -> zipfile.ZipInfo:
+    """
+    Returns the first `BatchLog.csv` of the archive
+    """
+    match find_members(zf, "BatchLog.csv"):
+        case [batch_log, *_]:
+            return batch_log
+        case _:
+            raise ValueError(f"The archive {zf.filename} does not contain a BatchLog.csv")
+
+def read_batch_log(zf: zipfile.ZipFile, encoding: str) -> pd.DataFrame:
+    """
+    Reads the first `BatchLog.csv` of the archive, streaming it
+    from the archive without extracting it
+    """
+    with zf.open(batch_log_member(zf)) as f:
+        return clean_names(pd.read_csv(f, encoding=encoding))
+
+def batch_log_digest(zf: zipfile.ZipFile) -> str:
+    """
+    Returns a short hash of the content of the first `BatchLog.csv` of the archive,
+    which identifies the run independently of the name of the archive
+    """
+    digest = hashlib.sha256()
+    with zf.open(batch_log_member(zf)) as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()[:8].upper()
+
+def index_folders(zf: zipfile.ZipFile) -> Dict[str, List[zipfile.ZipInfo]]:
+    """
+    Maps the name of every folder of the archive to the files it contains (recursively)
+    """
+    folders: Dict[str, List[zipfile.ZipInfo]] = {}
+    for info in zf.infolist():
+        if not info.is_dir():
+            for folder in pl.PurePosixPath(info.filename).parent.parts:
+                folders.setdefault(folder, []).append(info)
+    return folders
+
+#Sample properties and the batch log columns they are taken from
+PROPERTY_COLUMNS = {
+    'ICPMS.SAMPLE_NAME': 'samplename',
+    'ICPMS.ACQ_TIMESTAMP': 'acq_date_time',
+    'ICPMS.SAMPLE_TYPE': 'sampletype',
+    'ICPMS.ACQUISTION_RESULT': 'acquisitionresult',
+    'ICPMS.OPERATOR': 'operator'}
+
+def measured_rows(batch_log: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns the rows of the batch log which were measured (not skipped)
+    """
+    return batch_log[batch_log.acquisitionresult != 'Skip']
+
+def sample_properties(batch_log: pd.DataFrame) -> List[Dict[str, Any]]:
+    """
+    Converts the measured rows of the batch log
+    to the properties of their samples, column by column
+    """
+    measured = measured_rows(batch_log)
+    props = pd.DataFrame({code: measured[column] for code, column in PROPERTY_COLUMNS.items()}).astype(object)
+    return props.where(props.notna(), None).to_dict('records')
+
+def sample_codes(batch_log: pd.DataFrame, run: str, digest: str, prefix: str) -> List[str]:
+    """
+    Returns the codes of the samples of the measured rows of the batch log.
+    The codes only depend on the name of the run, the `digest` of its batch log
+    (see :obj:`batch_log_digest`) and the position of the row in the batch log,
+    so processing the same run again gives the same codes while different runs
+    with the same name do not
+    """
+    run_code = re.sub(r"[^A-Z0-9_]+", "_", run.upper()).strip("_")[:30]
+    return [f"{prefix}-{run_code}-{digest}-{row + 1:04d}" for row in measured_rows(batch_log).index]
+
+def sample_creations(props: List[Dict[str, Any]], codes: List[str], experiment: str, sample_type: str) -> List[Dict[str, Any]]:
+    """
+    Returns the v3 creations of the samples with properties `props`
+    and codes `codes` in the collection `experiment`
+    """
+    space, project, _ = experiment.strip('/').split('/')
+    ids = {
+        "spaceId": {"@type": "as.dto.space.id.SpacePermId", "permId": space},
+        "projectId": {"@type": "as.dto.project.id.ProjectIdentifier", "identifier": f"/{space}/{project}"},
+        "experimentId": {"@type": "as.dto.experiment.id.ExperimentIdentifier", "identifier": experiment}}
+    type_id = {"@type": "as.dto.entitytype.id.EntityTypePermId", "permId": sample_type, "entityKind": "SAMPLE"}
+    return [{"@type": "as.dto.sample.create.SampleCreation", "code": code, "typeId": type_id, "properties": p, **ids} for code, p in zip(codes, props)]
+
+def extract_members(zf: zipfile.ZipFile, members: List[zipfile.ZipInfo], path: pl.Path) -> List[pl.Path]:
+    """
+    Extracts only `members` to `path` and returns the paths of the extracted files
+    """
+    return [pl.Path(zf.extract(info, path=path)) for info in members]
+
 
 class ICPMsParser(OpenbisDatasetParser):
     """
     This is the core part of the dataset metadata extractor. To implement another extra
     """
     encoding= 'iso-8859-1'
+    sample_type = 'ICPMS'
+    chunk_size = 500
+
+    def existing_samples(self, ob: Openbis, codes: List[str], experiment: str) -> Dict[str, str]:
+        """
+        Returns the permIds of the samples of `experiment` with one of the `codes`, by code
+        """
+        existing = {}
+        for start in range(0, len(codes), self.chunk_size):
+            criteria = {"@type": "as.dto.sample.search.SampleSearchCriteria", "operator": "AND", "criteria": [
+                {"@type": "as.dto.common.search.CodesSearchCriteria", "fieldValue": codes[start:start + self.chunk_size]},
+                {"@type": "as.dto.experiment.search.ExperimentSearchCriteria", "operator": "AND", "criteria": [
+                    {"@type": "as.dto.common.search.IdentifierSearchCriteria", "fieldValue": {"@type": "as.dto.common.search.StringEqualToValue", "value": experiment}}]}]}
+            found = ob._post_request(ob.as_v3, {"method": "searchSamples", "params": [ob.token, criteria, {"@type": "as.dto.sample.fetchoptions.SampleFetchOptions"}]})
+            existing.update({s["code"]: s["permId"]["permId"] for s in found["objects"]})
+        return existing
+
+    def delete_samples(self, ob: Openbis, perm_ids: List[str]) -> None:
+        """
+        Permanently deletes the samples `perm_ids`
+        """
+        ids = [{"@type": "as.dto.sample.id.SamplePermId", "permId": perm_id} for perm_id in perm_ids]
+        options = {"@type": "as.dto.sample.delete.SampleDeletionOptions", "reason": "Rollback of a failed ICP-MS import"}
+        deletion = ob._post_request(ob.as_v3, {"method": "deleteSamples", "params": [ob.token, ids, options]})
+        ob._post_request(ob.as_v3, {"method": "confirmDeletions", "params": [ob.token, [deletion]]})
+
+    def create_samples(self, ob: Openbis, props: List[Dict[str, Any]], codes: List[str], experiment: str) -> List[str]:
+        """
+        Creates one sample per property dictionary in `experiment` with the given `codes`,
+        sending `chunk_size` samples per request and reporting the progress after each one.
+        Samples which already exist (from an earlier attempt at the same run) are reused,
+        and the samples created by this call are deleted again if a request fails.
+        Returns the sample permIds in the order of `codes`
+        """
+        if not props:
+            return []
+        perm_ids = self.existing_samples(ob, codes, experiment)
+        missing = [(code, p) for code, p in zip(codes, props) if code not in perm_ids]
+        creations = sample_creations([p for _, p in missing], [code for code, _ in missing], experiment, self.sample_type)
+        reporter = current_reporter()
+        created = []
+        try:
+            for start in range(0, len(creations), self.chunk_size):
+                chunk = creations[start:start + self.chunk_size]
+                response = ob._post_request(ob.as_v3, {"method": "createSamples", "params": [ob.token, chunk]})
+                created.extend(c["permId"] for c in response)
+                LOGGER.info(f"Created {len(created)} of {len(creations)} samples")
+                if reporter is not None:
+                    reporter.update(items_processed=len(created), items_total=len(creations), detail=f"Created {len(created)} of {len(creations)} samples")
+        except Exception:
+            if created:
+                LOGGER.warning(f"Deleting the {len(created)} samples created before the failure")
+                self.delete_samples(ob, created)
+            raise
+        perm_ids.update({creation["code"]: perm_id for creation, perm_id in zip(creations, created)})
+        return [perm_ids[code] for code in codes]
 
     def process(self, ob: Openbis, transaction: Transaction, dataset: DataSet, loader_name: str, description: str) -> Transaction:
         """
@@ -49,50 +208,24 @@ class ICPMsParser(OpenbisDatasetParser):
             is_sample = False
         else:
             raise ValueError()
-        #Extract file temporarily
-        with  tempfile.TemporaryDirectory() as td:
-            with zipfile.ZipFile(dataset.file_list[0], 'r') as zf:
-                zf.extractall(path=td)
-            LOGGER.info("Extracting all contents")
-            td_path = pl.Path(td)
-            #Extract the batch log of all measurements
-            batch_log, *rest = td_path.glob("**/BatchLog.csv")
-            if batch_log:
-                #Iterate over the row of the log
-                batch_log_dt = clean_names(pd.read_csv(batch_log, encoding=self.encoding))
-                for row in batch_log_dt.itertuples():
-                    LOGGER.info('Adding properties')
-                    #Create metadata for each sample in the measurement log
-                    props = {
-                    "icpms.sample_name": row.samplename, 
-                    'icpms.acq_timestamp': row.acq_date_time, 
-                    'icpms.sample_type': row.sampletype,
-                    'icpms.acquistion_result': row.acquisitionresult,
-                    'icpms.operator': row.operator}
-                    if row.acquisitionresult != 'Skip':
-                        new_exp = f"{proj}/ICP_MS_MEASUREMENTS"
-                        LOGGER.info('Creating sample')
-                        sample = ob.new_object(type='ICPMS', props=props, experiment= new_exp)
-                        LOGGER.info(f"saved sample {sample.identifier}")
-                        # if is_sample:
-                        #     sample.set_parents(ids)
-                        transaction.add(sample)
-                        
-                        #Add a dataset for each sample
-                        #Because the transaction is not finished, generate sample code here
-                        #import pytest; pytest.set_trace()
-                                            #Find the dataset for the sample
-                        # subdataset_name = pl.PureWindowsPath(row.filename).name
-                        # mts = td_path.glob("**/{subdataset_name}")
-                        # if mts:
-                        #     zf_iter = zipfile.Path(zf, at=str(mts[0]) + '/' )
-                        #     subdataset_extract = [zf.extract(f.at, path=td)  for f in zf_iter.iterdir()]
-                        #     if len(subdataset_extract) > 0:
-                        #         LOGGER.info(subdataset_extract)
-                        #         subdataset = ob.new_dataset(type='RAW_DATA', code=sample.code, sample=sample.identifier, files=subdataset_extract)
-                        #         LOGGER.info(f"Attaching dataset to {sample.identifier}")
-                        #         transaction.add(subdataset)
-                                #subdataset.save()
-                    #print(a)
+        #Read the central directory and stream the batch log, nothing is extracted
+        with zipfile.ZipFile(dataset.file_list[0], 'r') as zf:
+            batch_log_dt = read_batch_log(zf, self.encoding)
+            #Create the samples of all measurements in bulk, with codes derived from the run
+            new_exp = f"{proj}/ICP_MS_MEASUREMENTS"
+            codes = sample_codes(batch_log_dt, pl.Path(dataset.file_list[0]).stem, batch_log_digest(zf), self.sample_type)
+            perm_ids = self.create_samples(ob, sample_properties(batch_log_dt), codes, new_exp)
+            LOGGER.info(f"Created {len(perm_ids)} samples in {new_exp}")
+            # if is_sample:
+            #     parent the samples to ids
+            #Add a dataset for each sample
+            #Find the dataset for the sample, only its folder is extracted
+            # folders = index_folders(zf)
+            # subdataset_name = pl.PureWindowsPath(row.filename).name
+            # if members := folders.get(subdataset_name):
+            #     with tempfile.TemporaryDirectory() as td:
+            #         subdataset_extract = extract_members(zf, members, pl.Path(td))
+            #         subdataset = ob.new_dataset(type='RAW_DATA', sample=perm_id, files=subdataset_extract)
+            #         transaction.add(subdataset)
         #Comit the transaction with the new openbis objects (samples / collections / etc)
         return transaction
\ No newline at end of file
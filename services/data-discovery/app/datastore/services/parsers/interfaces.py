@@ -5,8 +5,14 @@ from pybis.dataset import DataSet
 from pydantic import create_model, BaseModel
 from pydantic.main import ModelMetaclass
 
+import hashlib
 import inspect
-from typing import NewType
+import json
+import pathlib as pl
+import tempfile
+from dataclasses import dataclass
+from functools import cache
+from typing import Any, Dict, List, NewType, Type
 from datastore.models.parser import FunctionParameters
 import logging
 LOGGER = logging.getLogger(__name__)
@@ -42,40 +48,84 @@ class OpenbisDatasetParser(ABC):
         """
         pass
 
+    def previews(self, dataset: DataSet) -> List[pl.Path]:
+        """
+        Returns preview images of the files of `dataset`, which are uploaded with it.
+        Parsers without previews do not need to override this method, see
+        :obj:`datastore.services.parsers.previews` to draw and cache them
+        """
+        return []
+
     def run(self, ob: Openbis, dataset: DataSet, *args, **kwargs):
+        #previews depends on the datastore, which depends on this module
+        from datastore.services.parsers import previews
         trans = ob.new_transaction()
         LOGGER.info("Started work")
-        try:
-            self.process(ob, trans, dataset, *args, **kwargs)
-            LOGGER.info("Committing transaction")
-            trans.commit()
-            LOGGER.info("Finished work")
-        except Exception as e:
-            raise ValueError('Processing failed')
+        with tempfile.TemporaryDirectory() as staging:
+            #Previews are best-effort, the dataset is registered without them if they cannot be made
+            try:
+                for preview in self.previews(dataset):
+                    previews.attach_preview(dataset, preview, pl.Path(staging))
+            except Exception as e:
+                LOGGER.warning(f"Cannot attach the previews of {dataset.files}: {e}")
+            try:
+                self.process(ob, trans, dataset, *args, **kwargs)
+                LOGGER.info("Committing transaction")
+                trans.commit()
+                #A transaction does not upload files, the dataset is saved with its files and previews
+                if dataset.is_new:
+                    LOGGER.info("Saving dataset")
+                    dataset.save()
+                LOGGER.info("Finished work")
+            except Exception as e:
+                raise ValueError(f"Processing failed: {e}") from e
         
 
-    def _generate_basemodel(self) -> ModelMetaclass:
+    @classmethod
+    def _parameters_model(cls) -> Type[BaseModel]:
         """
         Generates a :obj:`pydantic.BaseModel`
         from the annotations of the `process` function of
-        the derived class.
-        """
-        excluded_names = ['transaction', 'dataset', 'ob']
-        sig = inspect.signature(self.process)
-        model = {par.name:(par.annotation, (... if par.default == inspect._empty else par.default)) for _, par in sig.parameters.items() if par.name not in excluded_names}
-        model_name = f"{self.__class__.__name__}"
-        full_model = {'arguments':model, 'description': self.process.__doc__}
-        p1 = FunctionParameters
-        p1.__doc__ =\
-        f"""
-        Class: 
-        {self.__doc__}
-        Process Function:
-        {self.process.__doc__}
+        the derived class, described by the docstrings of the class and of `process`
         """
-        pydantic_model = create_model(model_name, **model)
+        excluded_names = ['self', 'transaction', 'dataset', 'ob']
+        sig = inspect.signature(cls.process)
+        model = {par.name:(par.annotation, (... if par.default == inspect._empty else par.default)) for _, par in sig.parameters.items() if par.name not in excluded_names and par.kind not in (par.VAR_POSITIONAL, par.VAR_KEYWORD)}
+        pydantic_model = create_model(cls.__name__, **model)
+        pydantic_model.__doc__ = "\n\n".join(inspect.cleandoc(doc) for doc in (cls.__doc__, cls.process.__doc__) if doc)
         return pydantic_model
 
+    def _generate_basemodel(self) -> ModelMetaclass:
+        """
+        Returns the (cached) model of the parameters of the `process` function
+        """
+        return parser_schema(type(self)).model
+
+
+@dataclass(frozen=True)
+class ParserSchema:
+    """
+    Parameters of a parser class
+    :param model: the model validating the keyword arguments of `process`
+    :param schema: the JSON schema of `model`
+    :param etag: an HTTP entity tag identifying `schema`
+    """
+    model: Type[BaseModel]
+    schema: Dict[str, Any]
+    etag: str
+
+
+@cache
+def parser_schema(parser: Type[OpenbisDatasetParser]) -> ParserSchema:
+    """
+    Returns the parameters of `parser`, generated only once per class.
+    A reloaded parser module defines new classes, which get a new schema
+    """
+    model = parser._parameters_model()
+    schema = model.schema()
+    digest = hashlib.sha256(json.dumps(schema, sort_keys=True, default=str).encode()).hexdigest()
+    return ParserSchema(model, schema, f'"{digest[:32]}"')
+
 Parent = NewType('Parser', OpenbisDatasetParser)
 
 def process(obj: Parent, tran: Transaction):
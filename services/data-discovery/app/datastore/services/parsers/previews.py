@@ -0,0 +1,122 @@
+"""
+Preview images of the parsed data.
+Previews are drawn headless with the Agg canvas on downsampled data
+and cached next to their source under the hash of its content,
+so a file is only drawn once. matplotlib is only imported when a preview is drawn.
+The cached previews are hidden, they are uploaded under a readable name (see :obj:`upload_name`).
+"""
+import hashlib
+import pathlib as pl
+import re
+import shutil
+from typing import TYPE_CHECKING, Callable, Tuple
+
+import numpy as np
+
+from datastore.utils import files
+
+if TYPE_CHECKING:
+    from matplotlib.figure import Figure
+    from pybis.dataset import DataSet
+
+
+def minmax_downsample(x: np.ndarray, y: np.ndarray, bins: int = 1000) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reduces a series to at most `2 * bins` points by keeping, in each of `bins`
+    consecutive slices, its minimum and maximum in their original order.
+    Unlike decimation, the peaks of the series are kept
+    """
+    n = len(y)
+    if n <= 2 * bins:
+        return x, y
+    size = -(-n // bins)
+    padded = np.full(size * bins, np.nan)
+    padded[:n] = y
+    slices = padded.reshape(bins, size)
+    #Missing values and padding are only selected in slices without any value
+    low = np.where(np.isnan(slices), np.inf, slices).argmin(axis=1)
+    high = np.where(np.isnan(slices), -np.inf, slices).argmax(axis=1)
+    offsets = np.arange(bins) * size
+    keep = np.unique(np.concatenate([offsets + low, offsets + high]))
+    keep = keep[keep < n]
+    return x[keep], y[keep]
+
+
+def source_hash(path: pl.Path, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Returns the SHA-256 of the content of `path`
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def preview_path(source: pl.Path, name: str = 'plot') -> pl.Path:
+    """
+    Returns the path of the preview `name` for the current content of `source`
+    """
+    return source.with_name(f".{source.name}.{source_hash(source)[:16]}.{name}{files.PREVIEW_SUFFIX}")
+
+
+_PREVIEW_PATTERN = re.compile(r"\.(?P<source>.+)\.[0-9a-f]{16}\.(?P<name>[^.]+)" + re.escape(files.PREVIEW_SUFFIX))
+
+
+def upload_name(preview: pl.Path) -> str:
+    """
+    Returns the name under which the cached `preview` is uploaded,
+    e.g. `run.xlsx.gpc.preview.png` for `.run.xlsx.<hash>.gpc.preview.png`
+    """
+    if not (match := _PREVIEW_PATTERN.fullmatch(preview.name)):
+        return preview.name
+    return f"{match['source']}.{match['name']}{files.PREVIEW_SUFFIX}"
+
+
+def render_preview(draw: Callable[["Figure"], None], path: pl.Path, size: Tuple[float, float] = (10, 8), dpi: int = 100) -> pl.Path:
+    """
+    Draws a figure with `draw` and saves it as PNG to `path`,
+    without any GUI backend
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=size, dpi=dpi)
+    FigureCanvasAgg(fig)
+    draw(fig)
+    partial = path.with_name(path.name + files.PARTIAL_SUFFIX)
+    with open(partial, 'wb') as f:
+        fig.savefig(f, format='png')
+    partial.replace(path)
+    return path
+
+
+def cached_preview(source: pl.Path, draw: Callable[["Figure"], None], name: str = 'plot') -> pl.Path:
+    """
+    Returns the preview `name` of `source`, drawing it with `draw`
+    only if there is no preview for the current content of `source`
+    """
+    path = preview_path(source, name)
+    if not path.exists():
+        render_preview(draw, path)
+        #Previews of older versions of the source
+        for stale in source.parent.glob(f".{source.name}.*.{name}{files.PREVIEW_SUFFIX}"):
+            if stale != path:
+                stale.unlink(missing_ok=True)
+    return path
+
+
+def attach_preview(dataset: "DataSet", preview: pl.Path, directory: pl.Path) -> pl.Path:
+    """
+    Adds `preview` to the files uploaded with `dataset`, which must not be registered yet.
+    The preview is copied under its :obj:`upload_name` into `directory`, which must exist
+    until the dataset is saved. Returns the path of the copy
+    """
+    if not dataset.is_new:
+        raise ValueError(f"Cannot attach a preview to the registered dataset {dataset.permId}")
+    staged = directory / upload_name(preview)
+    uploaded = dataset.files or []
+    if str(staged) not in uploaded:
+        shutil.copyfile(preview, staged)
+        #pybis keeps the files of a new dataset in its __dict__
+        dataset.__dict__["files"] = [*uploaded, str(staged)]
+    return staged
@@ -0,0 +1,30 @@
+"""
+Lookup of the dataset parsers of an instance, shared by the API and the workers
+"""
+from typing import Dict, Type
+
+from datastore.services.parsers import icp_ms
+from datastore.services.parsers.interfaces import OpenbisDatasetParser
+from datastore.utils import files, settings
+
+#Parsers available to every instance in addition to the ones in its parsers directory
+BUILTIN_PARSERS: Dict[str, Type[OpenbisDatasetParser]] = {'icp_ms': icp_ms.ICPMsParser}
+
+
+def get_instance_store(instance: str) -> files.InstanceDataStore:
+    """
+    Returns the datastore of `instance` with the built-in parsers registered
+    """
+    ds = files.get_instance_store(settings.get_settings().base_path, instance)
+    for name, parser in BUILTIN_PARSERS.items():
+        ds.register_parser(name, parser)
+    return ds
+
+
+def get_parser(ds: files.InstanceDataStore, name: str) -> OpenbisDatasetParser:
+    """
+    Returns a new instance of the parser registered as `name` in `ds`
+    """
+    if (parser := ds.parsers.get(name)) is None:
+        raise ValueError(f"The parser {name} is not registered for the instance {ds.instance}")
+    return parser()
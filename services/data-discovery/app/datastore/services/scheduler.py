@@ -0,0 +1,175 @@
+"""
+Scheduling of the dataset transfers.
+Transfers are classified by the size of their input and by their parser
+into :obj:`SizeClass` es, each with its own rq queue, so that small
+transfers do not wait behind large ones. Workers listen to the small queue first.
+Within a class, jobs wait in one pending list per user and are moved to the
+rq queue in round-robin order between the users, only keeping
+`transfer_queue_window` jobs in the rq queue. A user submitting
+many transfers therefore does not delay the transfers of the others.
+The pending lists are refilled when a job is submitted, when a job of the class ends
+and by the workers before they take a job (see :obj:`dispatch_all`), because rq only runs
+the failure callback of a job whose worker was killed once the job is found abandoned.
+"""
+from typing import Any, Type
+
+import redis
+from rq import Queue
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+from rq.serializers import DefaultSerializer
+
+from datastore.models.jobs import SizeClass
+from datastore.services import jobs as job_service
+from datastore.utils import rq as rq_utils, settings
+from datastore.utils.redis import get_redis
+
+#Appends a job to the pending list of a user and adds the user to the round-robin ring if needed
+SUBMIT_SCRIPT = """
+local ring, members, pending = KEYS[1], KEYS[2], KEYS[3]
+local user, job = ARGV[1], ARGV[2]
+redis.call('RPUSH', pending, job)
+if redis.call('SADD', members, user) == 1 then
+    redis.call('RPUSH', ring, user)
+end
+return redis.call('LLEN', pending)
+"""
+
+#Pops the next job of the user at the head of the ring, which moves to the tail
+#if it still has pending jobs and leaves the ring otherwise
+NEXT_SCRIPT = """
+local ring, members, prefix = KEYS[1], KEYS[2], ARGV[1]
+for i = 1, redis.call('LLEN', ring) do
+    local user = redis.call('LPOP', ring)
+    local job = redis.call('LPOP', prefix .. user)
+    if job and redis.call('LLEN', prefix .. user) > 0 then
+        redis.call('RPUSH', ring, user)
+    else
+        redis.call('SREM', members, user)
+    end
+    if job then
+        return job
+    end
+end
+return false
+"""
+
+
+def ring_key(size_class: SizeClass) -> str:
+    return f"scheduler:{size_class.value}:users"
+
+
+def members_key(size_class: SizeClass) -> str:
+    return f"scheduler:{size_class.value}:members"
+
+
+def pending_prefix(size_class: SizeClass) -> str:
+    return f"scheduler:{size_class.value}:pending:"
+
+
+ORDER = list(SizeClass)
+
+
+def classify(size: int, parser: str) -> SizeClass:
+    """
+    Returns the class of a transfer of `size` bytes using `parser`.
+    Parsers listed in `transfer_parser_classes` are at least in the given class
+    """
+    st = settings.get_settings()
+    if size < st.transfer_small_limit:
+        by_size = SizeClass.SMALL
+    elif size < st.transfer_large_limit:
+        by_size = SizeClass.MEDIUM
+    else:
+        by_size = SizeClass.LARGE
+    by_parser = SizeClass(st.transfer_parser_classes.get(parser, SizeClass.SMALL.value))
+    return max(by_size, by_parser, key=ORDER.index)
+
+
+class TransferScheduler:
+    """
+    Submits transfer jobs to the per-user pending lists and
+    moves them fairly to the rq queue of their class
+    """
+
+    def __init__(self, connection: redis.Redis, serializer: Type[DefaultSerializer] | None = None, window: int | None = None) -> None:
+        self.connection = connection
+        self.serializer = serializer
+        self.window = window or settings.get_settings().transfer_queue_window
+        self._submit = connection.register_script(SUBMIT_SCRIPT)
+        self._next = connection.register_script(NEXT_SCRIPT)
+
+    def queue(self, size_class: SizeClass) -> Queue:
+        return Queue(size_class.queue, connection=self.connection, serializer=self.serializer)
+
+    def submit(self, job: Job, size_class: SizeClass, ledger: job_service.JobLedger | None = None) -> Job:
+        """
+        Saves `job` and appends it to the pending list of its user in `size_class`
+        """
+        user = job.meta['user']
+        job.meta['size_class'] = size_class.value
+        job.origin = size_class.queue
+        job.save()
+        self._submit(keys=[ring_key(size_class), members_key(size_class), pending_prefix(size_class) + user], args=[user, job.id])
+        (ledger or job_service.JobLedger(self.connection)).enqueued(job)
+        self.dispatch(size_class)
+        return job
+
+    def dispatch(self, size_class: SizeClass) -> int:
+        """
+        Moves pending jobs to the rq queue of `size_class` until it holds `window` jobs.
+        Returns the number of jobs moved
+        """
+        queue = self.queue(size_class)
+        moved = 0
+        while queue.count < self.window:
+            if (job_id := self._next(keys=[ring_key(size_class), members_key(size_class)], args=[pending_prefix(size_class)])) is None:
+                break
+            try:
+                job = Job.fetch(job_id.decode() if isinstance(job_id, bytes) else job_id, connection=self.connection, serializer=self.serializer)
+            except NoSuchJobError:
+                #The job expired or was deleted while pending
+                continue
+            queue.enqueue_job(job)
+            moved += 1
+        return moved
+
+    def pending(self, size_class: SizeClass, user: str) -> int:
+        return self.connection.llen(pending_prefix(size_class) + user)
+
+
+def get_transfer_scheduler() -> TransferScheduler:
+    return TransferScheduler(get_redis(), serializer=rq_utils.get_serializer(settings.get_settings().task_serialiser))
+
+
+def _dispatch_after(job: Job, connection: redis.Redis) -> None:
+    if (size_class := job.meta.get('size_class')) is not None:
+        TransferScheduler(connection, serializer=job.serializer).dispatch(SizeClass(size_class))
+
+
+def on_job_success(job: Job, connection: redis.Redis, result: Any, *args, **kwargs) -> None:
+    """
+    rq callback recording the end of a transfer and scheduling the next one of its class
+    """
+    job_service.on_job_success(job, connection, result, *args, **kwargs)
+    _dispatch_after(job, connection)
+
+
+def on_job_failure(job: Job, connection: redis.Redis, type, value, tb) -> None:
+    job_service.on_job_failure(job, connection, type, value, tb)
+    _dispatch_after(job, connection)
+
+
+def on_job_stopped(job: Job, connection: redis.Redis) -> None:
+    job_service.on_job_stopped(job, connection)
+    _dispatch_after(job, connection)
+
+
+def dispatch_all(connection: redis.Redis, serializer: Type[DefaultSerializer] | None = None) -> int:
+    """
+    Refills the rq queues of all classes from the pending lists.
+    Returns the number of jobs moved
+    """
+    scheduler = TransferScheduler(connection, serializer=serializer)
+    return sum(scheduler.dispatch(size_class) for size_class in SizeClass)
+
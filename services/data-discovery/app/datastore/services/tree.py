@@ -0,0 +1,236 @@
+"""
+This module keeps an in-memory copy of the openBIS sample tree
+(the tree served by `/openbis/tree`) for every openBIS session.
+The tree is built once and then refreshed incrementally by only
+fetching the collections and objects modified since the last refresh.
+Because deletions cannot be detected from modification timestamps,
+the tree is fully rebuilt every `tree_rebuild_interval` seconds.
+If a refresh fails, the last version of the tree is served.
+"""
+import hashlib
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import cache
+from typing import Dict, Iterable, Tuple
+
+import pandas as pd
+import pybis
+from instance_creator import utils as ic_utils
+from instance_creator import views as ic_views
+from instance_creator.views import OpenbisHierarcy, TreeElement
+
+from datastore.utils import settings
+from datastore.utils.cache import TTLCache
+
+LOGGER = logging.getLogger(__name__)
+
+COLLECTION_ATTRS = [*ic_views.COLLECTION_ATTRS, 'modificationDate']
+OBJECT_ATTRS = [*ic_views.OBJECT_ATTRS, 'modificationDate']
+
+
+def _value(row, name: str) -> str | None:
+    val = getattr(row, name, None)
+    if val is None or (not isinstance(val, list) and pd.isnull(val)) or val == '':
+        return None
+    return val
+
+
+@dataclass
+class TreeSnapshot:
+    """
+    The cached tree of one openBIS session
+    :ivar tree: the root of the tree, which indexes all nodes by identifier
+    :ivar modified: the last modification date of every collection and object
+    :ivar watermark: the latest modification date seen in openBIS
+    :ivar refreshed: the (monotonic) time of the last refresh
+    :ivar serialised: the JSON serialisation of the tree and its ETag
+    """
+    tree: TreeElement
+    modified: Dict[str, str] = field(default_factory=dict)
+    watermark: str | None = None
+    refreshed: float = 0.0
+    serialised: Tuple[bytes, str] = (b'', '')
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @classmethod
+    def empty(cls) -> 'TreeSnapshot':
+        return cls(tree=TreeElement(identifier='/', code='/', type=OpenbisHierarcy.INSTANCE))
+
+    def find(self, identifier: str) -> TreeElement | None:
+        return self.tree.find(identifier)
+
+    def attach(self, node: TreeElement, parent_id: str) -> bool:
+        """
+        Inserts or updates `node` under the node `parent_id`.
+        An existing node keeps its children and is moved if its parent changed.
+        Returns False if the parent is not in the tree
+        """
+        parent = self.tree.find(parent_id)
+        if parent is None:
+            return False
+        match self.tree.find(node.identifier):
+            case None:
+                parent.push(node)
+            case TreeElement() as current:
+                for name in node.__fields_set__ - {'children'}:
+                    setattr(current, name, getattr(node, name))
+                if current.parent() is not parent:
+                    current.parent().remove(current.identifier)
+                    parent.push(current)
+        return True
+
+    def detach(self, identifier: str) -> None:
+        """
+        Removes the node `identifier` and its descendants from the tree
+        """
+        node = self.tree.find(identifier)
+        if node is not None and node.parent() is not None:
+            removed = node.parent().remove(identifier)
+            for key in [identifier, *removed._descendants_index]:
+                self.modified.pop(key, None)
+
+    def serialise(self) -> None:
+        """
+        Serialises the tree and computes its ETag
+        """
+        body = self.tree.json().encode()
+        self.serialised = (body, f'"{hashlib.sha1(body).hexdigest()}"')
+
+
+def space_nodes(ob: pybis.Openbis) -> Iterable[TreeElement]:
+    for space in ob.get_spaces().df.itertuples():
+        yield ic_views.space_element(space)
+
+
+def project_nodes(ob: pybis.Openbis) -> Iterable[tuple[str, TreeElement]]:
+    for proj in ob.get_projects().df.itertuples():
+        yield ic_utils.split_identifier(proj.identifier)[0], ic_views.project_element(proj)
+
+
+def update_collections(snapshot: TreeSnapshot, collections: pd.DataFrame) -> int:
+    changed = 0
+    for coll in collections.itertuples():
+        mod = _value(coll, 'modificationDate')
+        if mod is not None and snapshot.modified.get(coll.identifier) == mod:
+            continue
+        node = ic_views.collection_element(coll)
+        if snapshot.attach(node, coll.project):
+            snapshot.modified[coll.identifier] = mod
+            changed += 1
+    return changed
+
+
+def update_objects(snapshot: TreeSnapshot, objects: pd.DataFrame) -> int:
+    changed = 0
+    for samp in objects.itertuples():
+        mod = _value(samp, 'modificationDate')
+        if mod is not None and snapshot.modified.get(samp.identifier) == mod:
+            continue
+        project = _value(samp, 'project')
+        if project is None:
+            continue
+        node = ic_views.object_element(samp)
+        if snapshot.attach(node, project):
+            snapshot.modified[samp.identifier] = mod
+            changed += 1
+    return changed
+
+
+def _advance_watermark(snapshot: TreeSnapshot, *frames: pd.DataFrame) -> None:
+    dates = [d for df in frames if 'modificationDate' in df for d in df['modificationDate'].dropna() if d]
+    if dates:
+        snapshot.watermark = max([snapshot.watermark or '', *dates])
+
+
+def build_snapshot(ob: pybis.Openbis) -> TreeSnapshot:
+    """
+    Builds the complete tree of the openBIS instance
+    """
+    snapshot = TreeSnapshot.empty()
+    for space in space_nodes(ob):
+        snapshot.attach(space, '/')
+    for space, proj in project_nodes(ob):
+        snapshot.attach(proj, space)
+    collections = ob.get_collections(attrs=COLLECTION_ATTRS).df
+    objects = ob.get_objects(attrs=OBJECT_ATTRS).df
+    update_collections(snapshot, collections)
+    update_objects(snapshot, objects)
+    _advance_watermark(snapshot, collections, objects)
+    snapshot.refreshed = time.monotonic()
+    snapshot.serialise()
+    return snapshot
+
+
+def refresh_snapshot(ob: pybis.Openbis, snapshot: TreeSnapshot) -> int:
+    """
+    Updates the tree with the spaces and projects and the collections and objects
+    modified since the last refresh. openBIS only filters
+    modification dates by day, so the rows which did not change since
+    the last refresh are skipped locally. Returns the number of updated nodes
+    """
+    changed = 0
+    for space in space_nodes(ob):
+        changed += snapshot.find(space.identifier) is None
+        snapshot.attach(space, '/')
+    for space, proj in project_nodes(ob):
+        changed += snapshot.find(proj.identifier) is None
+        snapshot.attach(proj, space)
+    since = {} if snapshot.watermark is None else {'modificationDate': f'>={snapshot.watermark[:10]}'}
+    collections = ob.get_collections(attrs=COLLECTION_ATTRS, **since).df
+    objects = ob.get_objects(attrs=OBJECT_ATTRS, **since).df
+    changed += update_collections(snapshot, collections)
+    changed += update_objects(snapshot, objects)
+    _advance_watermark(snapshot, collections, objects)
+    snapshot.refreshed = time.monotonic()
+    if changed:
+        snapshot.serialise()
+    return changed
+
+
+class TreeCache:
+    """
+    Cache of the trees of all openBIS sessions, keyed by session token.
+    Trees older than `refresh_interval` seconds are refreshed incrementally
+    when requested, trees older than `rebuild_interval` are rebuilt.
+    """
+
+    def __init__(self, size: int = 16, refresh_interval: float = 30.0, rebuild_interval: float = 900.0) -> None:
+        self.refresh_interval = refresh_interval
+        self.snapshots: TTLCache[str, TreeSnapshot] = TTLCache(size, rebuild_interval)
+
+    def get(self, ob: pybis.Openbis) -> TreeSnapshot:
+        snapshot = self.snapshots.get_or_load(ob.token, lambda: build_snapshot(ob))
+        if time.monotonic() - snapshot.refreshed > self.refresh_interval:
+            #Only one request refreshes, the others serve the current version
+            if snapshot.lock.acquire(blocking=False):
+                try:
+                    refresh_snapshot(ob, snapshot)
+                except Exception:
+                    #The serialised tree is only replaced by a successful refresh, the next request retries
+                    LOGGER.exception("Cannot refresh the tree, serving the cached version")
+                finally:
+                    snapshot.lock.release()
+        return snapshot
+
+    def remove(self, ob: pybis.Openbis, identifier: str) -> None:
+        """
+        Removes a deleted object from the cached tree
+        """
+        if (snapshot := self.snapshots.get(ob.token)) is not None:
+            with snapshot.lock:
+                snapshot.detach(identifier)
+                snapshot.serialise()
+
+    def invalidate(self, ob: pybis.Openbis) -> None:
+        self.snapshots.invalidate(ob.token)
+
+
+@cache
+def get_tree_cache() -> TreeCache:
+    """
+    Returns the process-wide tree cache
+    """
+    st = settings.get_settings()
+    return TreeCache(st.tree_cache_size, st.tree_refresh_interval, st.tree_rebuild_interval)
@@ -1,16 +1,21 @@
 from datastore.utils.redis import get_redis
 from datastore.models import openbis as openbis_models
+from datastore.models.parser import TransferJob
+from datastore.services import openbis as openbis_service
+from datastore.services.parsers import registry as parser_registry
+from datastore.models.messages import ProgressStage
+from datastore.services.messages import ProgressReporter
+from datastore.utils.semaphore import openbis_semaphore
 import pathlib as pl
 from typing import Any, List, Dict
 from pybis import Openbis
 from datastore.services.parsers import interfaces as parser_interfaces
 from rq import get_current_job
 from logging import getLogger
-import time
 logger = getLogger(__name__)
 
 
-def process(ob: Openbis, data: pl.Path | List[pl.Path], identifier: str, type: str, parser: parser_interfaces.OpenbisDatasetParser, parser_args: List[Any] | None = [], parser_kwargs: Dict[str, Any] | None = {}):
+def process(ob: Openbis, data: pl.Path | List[pl.Path], identifier: str, type: str, parser: parser_interfaces.OpenbisDatasetParser, parser_args: List[Any] | Dict[str, Any] | None = [], parser_kwargs: Dict[str, Any] | None = {}):
     match type:
         case "COLLECTION" | "EXPERIMENT":
             nd = ob.new_dataset(type='RAW_DATA', experiment=identifier, files=data)
@@ -18,16 +23,41 @@ def process(ob: Openbis, data: pl.Path | List[pl.Path], identifier: str, type: s
             nd = ob.new_dataset(type='RAW_DATA', sample=identifier, files=data)
         case _:
             raise ValueError("Can only process object or collection")
+    #The parser parameters are enqueued as a dictionary of keyword arguments
+    if isinstance(parser_args, dict):
+        parser_args, parser_kwargs = [], {**parser_args, **(parser_kwargs or {})}
     #Get the back channel
     redis = get_redis()
-    logger.info(redis)
     job_id = get_current_job(connection=redis).id
-    for i in range(1000):
-        #logger.info('Working')
-        redis.publish(job_id, 'started')
-        time.sleep(2)
-        redis.publish(job_id, 'finished')
-    #parser.run(ob, nd, *parser_args, **parser_kwargs)
+    files = data if isinstance(data, list) else [data]
+    reporter = ProgressReporter(redis, job_id)
+    total = sum(pl.Path(f).stat().st_size for f in files)
+    reporter.update(ProgressStage.STARTED, bytes_total=total, items_total=len(files), items_processed=0)
+    #Limit the number of jobs running against the same openBIS server
+    slot = openbis_semaphore(redis, ob.url)
+    if not slot.acquire(blocking=False):
+        reporter.update(ProgressStage.QUEUED, detail=f"Waiting for a free slot on {ob.url}")
+        slot.acquire()
+    try:
+        reporter.update(ProgressStage.PARSING, detail=None)
+        parser.run(ob, nd, *parser_args, **parser_kwargs)
+    except Exception as e:
+        reporter.update(ProgressStage.FAILED, detail=str(e))
+        raise
+    finally:
+        slot.release()
+    reporter.update(ProgressStage.FINISHED, items_processed=len(files), bytes_processed=total, percent=100.0)
 
-    return
 
+def transfer(job: Dict[str, Any]):
+    """
+    Runs the dataset transfer described by a :obj:`TransferJob`
+    """
+    descriptor = TransferJob.parse_obj(job)
+    ob = openbis_service.get_openbis_connection(descriptor.connection.openbis, descriptor.connection.token)
+    ds = parser_registry.get_instance_store(descriptor.instance)
+    files = [(ds.path / f).resolve() for f in descriptor.files]
+    if not all(f.is_relative_to(ds.path) for f in files):
+        raise ValueError(f"The files of the job must be in the datastore of {descriptor.instance}")
+    parser = parser_registry.get_parser(ds, descriptor.parser)
+    return process(ob, files, descriptor.identifier, descriptor.type.value, parser, descriptor.parameters)
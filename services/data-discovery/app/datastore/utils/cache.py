@@ -0,0 +1,125 @@
+"""
+A small thread-safe LRU cache with time-to-live, used to avoid
+repeating lookups in external services (LDAP) for data that rarely changes
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from functools import cache
+from typing import Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+from . import settings
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    loads: int = 0
+
+
+class TTLCache(Generic[K, V]):
+    """
+    LRU cache holding at most `maxsize` entries, each one valid for `ttl` seconds.
+    Concurrent loads of the same missing key are deduplicated: only the first
+    caller runs the loader, the others wait for its result.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0, clock: Callable[[], float] = time.monotonic) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.stats = CacheStats()
+        self._entries: OrderedDict[K, Tuple[float, V]] = OrderedDict()
+        self._pending: Dict[K, Future] = {}
+        self._lock = threading.Lock()
+
+    def _get_valid(self, key: K) -> Tuple[bool, Optional[V]]:
+        match self._entries.get(key):
+            case (expires, value) if expires > self.clock():
+                self._entries.move_to_end(key)
+                return True, value
+            case (_, _):
+                del self._entries[key]
+        return False, None
+
+    def get(self, key: K) -> Optional[V]:
+        """
+        Returns the cached value for `key` or None if missing or expired
+        """
+        with self._lock:
+            return self._get_valid(key)[1]
+
+    def set(self, key: K, value: V) -> None:
+        with self._lock:
+            self._set(key, value)
+
+    def _set(self, key: K, value: V) -> None:
+        self._entries[key] = (self.clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get_or_load(self, key: K, loader: Callable[[], Optional[V]]) -> Optional[V]:
+        """
+        Returns the cached value for `key`, calling `loader` if it is missing.
+        Results equal to None are returned but not cached.
+        """
+        with self._lock:
+            found, value = self._get_valid(key)
+            if found:
+                self.stats.hits += 1
+                return value
+            self.stats.misses += 1
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                future = self._pending[key] = Future()
+                self.stats.loads += 1
+        if not owner:
+            return future.result()
+        try:
+            value = loader()
+        except BaseException as e:
+            with self._lock:
+                if self._pending.get(key) is future:
+                    del self._pending[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            #Do not store the value if the key was invalidated while loading
+            if self._pending.get(key) is future:
+                del self._pending[key]
+                if value is not None:
+                    self._set(key, value)
+        future.set_result(value)
+        return value
+
+    def invalidate(self, key: K) -> None:
+        """
+        Removes `key` from the cache
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._pending.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+@cache
+def get_user_cache() -> TTLCache:
+    """
+    Returns the process-wide cache of LDAP users, keyed by uid
+    """
+    st = settings.get_settings()
+    return TTLCache(st.ldap_user_cache_size, st.ldap_user_cache_ttl)
@@ -3,22 +3,22 @@ This module is used to manage datasets
 for a specific instance of the data uploader
 """
 from asyncore import file_dispatcher
-from dataclasses import field
-from functools import reduce
+from dataclasses import dataclass, field
+from functools import reduce, cache
 import inspect
 import pathlib as pl
-from pydantic.dataclasses import dataclass
 from pydantic import BaseModel
-from typing import Iterable, List, Optional, Dict, Union, TypeVar, Type
+from typing import Iterable, List, Optional, Dict, Union, TypeVar, Type, AsyncIterator
 import datetime as dt
 
 from re import Pattern
 from venv import create
 
 from . import settings
+from ..models.datasets import UploadResult
 
 from ..services.ldap import ldap
-from ..services.parsers.interfaces import OpenbisDatasetParser
+from ..services.parsers.interfaces import OpenbisDatasetParser, parser_schema
 
 
 import importlib
@@ -30,6 +30,15 @@ import sys
 
 from collections import ChainMap
 
+import fnmatch
+import glob
+import os
+import threading
+import time
+import uuid
+import hashlib
+import aiofiles
+
 def get_modification_delay(f: pl.Path) -> float:
     """
     Get the time delay from the current time to the last modification
@@ -62,6 +71,230 @@ def load_classes(loc: pl.Path, which: T) -> Dict[str, T] | None:
             raise FileNotFoundError("Cannot load classes in {loc}")
 
 
+@dataclass
+class LoadedModule:
+    """
+    A module loaded by :func:`load_classes_cached`,
+    with the modification time and the hash of its source
+    """
+    mtime: int
+    digest: str
+    classes: Dict[str, type] | None
+
+
+_loaded_modules: Dict[tuple[pl.Path, type], LoadedModule] = {}
+_loaded_modules_lock = threading.Lock()
+
+def load_classes_cached(loc: pl.Path, which: T) -> Dict[str, T] | None:
+    """
+    Same as :func:`load_classes`, but the module is only executed again
+    if its modification time and the hash of its content changed since the last load
+    """
+    key = (loc.resolve(), which)
+    mtime = loc.stat().st_mtime_ns
+    with _loaded_modules_lock:
+        cached = _loaded_modules.get(key)
+        if cached is not None and cached.mtime == mtime:
+            return cached.classes
+        digest = hashlib.sha256(loc.read_bytes()).hexdigest()
+        if cached is not None and cached.digest == digest:
+            cached.mtime = mtime
+            return cached.classes
+        classes = load_classes(loc, which)
+        _loaded_modules[key] = LoadedModule(mtime, digest, classes)
+        return classes
+
+
+#Files modified more recently than this (in seconds) are still
+#being written to and are re-checked on every catalog refresh
+SETTLE_TIME = 60.0
+#Suffix of the files which are still being uploaded
+PARTIAL_SUFFIX = '.upload-part'
+CACHE_SUFFIX = '.cache.npz'
+PREVIEW_SUFFIX = '.preview.png'
+#Worst-case resolution of directory modification times (in ns)
+MTIME_RESOLUTION = 1_000_000_000
+
+
+@dataclass
+class FileEntry:
+    """
+    Stat information of a single file in a :obj:`FileCatalog`
+    :ivar name: file name
+    :ivar path: full path of the file
+    :ivar size: size of the file in bytes
+    :ivar modified: modification timestamp
+    :ivar created: creation (ctime) timestamp
+    """
+    name: str
+    path: pl.Path
+    size: int
+    modified: float
+    created: float
+
+    @classmethod
+    def from_stat(cls, path: pl.Path, st: os.stat_result) -> "FileEntry":
+        return cls(name=path.name, path=path, size=st.st_size, modified=st.st_mtime, created=st.st_ctime)
+
+    def modification_delay(self) -> float:
+        """
+        Same as :func:`get_modification_delay` but using the indexed modification time
+        """
+        return (time.time() - self.modified) / 60
+
+
+class FileCatalog:
+    """
+    In-memory index of the files contained in a directory, mapping each
+    file name to its :obj:`FileEntry`.
+    The index is built once and then kept current incrementally: the directory
+    is only scanned again when its modification time changes (i.e. when an entry
+    is created, deleted or renamed) and only new or recently modified entries are
+    stat'ed during a rescan.
+    """
+
+    def __init__(self, path: pl.Path) -> None:
+        self.path = path
+        self.entries: Dict[str, FileEntry] = {}
+        self.directory_mtime: int | None = None
+        self._unsettled: set[str] = set()
+        self._lock = threading.RLock()
+
+    def _index(self, name: str) -> FileEntry | None:
+        """
+        Stats a single entry and updates the index accordingly
+        """
+        path = self.path / name
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            self.entries.pop(name, None)
+            self._unsettled.discard(name)
+            return None
+        entry = FileEntry.from_stat(path, st)
+        self.entries[name] = entry
+        if time.time() - st.st_mtime < SETTLE_TIME:
+            self._unsettled.add(name)
+        else:
+            self._unsettled.discard(name)
+        return entry
+
+    def refresh(self) -> None:
+        """
+        Brings the index up to date. If the directory modification time changed, the
+        directory is listed again and only the entries which were not yet indexed
+        are stat'ed. Otherwise, only the files which were still being written to are checked.
+        """
+        with self._lock:
+            mtime = self.path.stat().st_mtime_ns
+            if mtime != self.directory_mtime:
+                with os.scandir(self.path) as it:
+                    names = {de.name for de in it if not is_internal_file(de.name)}
+                for removed in self.entries.keys() - names:
+                    self.entries.pop(removed)
+                    self._unsettled.discard(removed)
+                for name in names:
+                    if name not in self.entries or name in self._unsettled:
+                        self._index(name)
+                #Changes happening within the timestamp resolution of the filesystem
+                #would not change the modification time: only trust it once it is old enough
+                self.directory_mtime = mtime if (time.time_ns() - mtime) > MTIME_RESOLUTION else None
+            else:
+                for name in list(self._unsettled):
+                    self._index(name)
+
+    def get(self, name: str) -> FileEntry | None:
+        """
+        Exact name lookup. The file is stat'ed again so that the
+        returned information is always current.
+        """
+        if is_internal_file(name) or pl.PurePath(name).name != name:
+            return None
+        with self._lock:
+            return self._index(name)
+
+    def add(self, path: pl.Path) -> FileEntry | None:
+        """
+        Adds (or updates) a file to the index without rescanning the directory
+        """
+        with self._lock:
+            return self._index(path.name)
+
+    def remove(self, name: str) -> None:
+        """
+        Removes a file from the index without rescanning the directory
+        """
+        with self._lock:
+            self.entries.pop(name, None)
+            self._unsettled.discard(name)
+
+    def list(self, pattern: str | Pattern | None = None) -> List[FileEntry]:
+        """
+        List all the entries whose name matches the glob or regex `pattern`
+        """
+        self.refresh()
+        with self._lock:
+            entries = list(self.entries.values())
+        match pattern:
+            case None:
+                return entries
+            case str(x):
+                return [e for e in entries if fnmatch.fnmatchcase(e.name, x)]
+            case Pattern() as pt:
+                return [e for e in entries if pt.search(e.name)]
+
+    def recent(self, last_changed: float) -> List[FileEntry]:
+        """
+        List all the entries modified within the last `last_changed` minutes
+        """
+        return [e for e in self.list() if e.modification_delay() < last_changed]
+
+
+def is_partial_file(name: str) -> bool:
+    """
+    Returns true for the temporary files used while uploading
+    """
+    return name.endswith(PARTIAL_SUFFIX)
+
+
+def is_internal_file(name: str) -> bool:
+    """
+    Returns true for the files which are not shown in the datastore:
+    partial uploads and the intermediates and previews cached by the parsers
+    """
+    return is_partial_file(name) or (name.startswith('.') and name.endswith((CACHE_SUFFIX, PREVIEW_SUFFIX)))
+
+
+def stored_name(name: str) -> str:
+    """
+    Returns the name under which a file uploaded as `name` is stored in an instance.
+    Raises a ValueError for empty names and for the names of internal files,
+    which could overwrite a partial upload or its manifest
+    """
+    stored = pl.PurePath(name).name
+    if stored in ('', '.', '..'):
+        raise ValueError(f"Invalid file name {name!r}")
+    if is_internal_file(stored):
+        raise ValueError(f"The file name {name!r} is reserved")
+    return stored
+
+
+def derived_files(path: pl.Path) -> List[pl.Path]:
+    """
+    Returns the intermediates and previews cached by the parsers for the file `path`
+    """
+    source = glob.escape(path.name)
+    return [p for suffix in (CACHE_SUFFIX, PREVIEW_SUFFIX) for p in path.parent.glob(f".{source}.*{suffix}")]
+
+
+@cache
+def get_catalog(path: pl.Path) -> FileCatalog:
+    """
+    Returns the process-wide catalog for the directory `path`
+    """
+    return FileCatalog(path)
+
+
 @dataclass
 class InstanceDataStore:
     """
@@ -88,6 +321,7 @@ class InstanceDataStore:
         if not self.parser_path.exists():
             self.parser_path.mkdir()
         self.instance = instance
+        self._registered_parsers: Dict[str, Type[OpenbisDatasetParser]] = {}
         self.parsers = dict() | p if (p:= self.find_parsers()) else dict()
 
 
@@ -101,42 +335,101 @@ class InstanceDataStore:
         """
         return (self.path).expanduser().resolve()
         
+    @property
+    def catalog(self) -> FileCatalog:
+        """
+        The index of the files in this instance
+        """
+        return get_catalog(self.path)
+
+    def list_entries(self, pattern: str | Pattern, recent: float | None = None) -> List[FileEntry]:
+        """
+        List the catalog entries for the current instance with the given pattern
+        :param pattern: a glob pattern or a compiled regex
+        :param recent: if given, only return entries modified in the last `recent` minutes
+        :return a list of :obj:`FileEntry`
+        """
+        match pattern:
+            case str(x) if '/' in x or '**' in x:
+                #Recursive patterns cannot be answered from the (flat) index
+                entries = [FileEntry.from_stat(f, f.stat()) for f in self.path.glob(x) if not is_internal_file(f.name)]
+            case _:
+                entries = self.catalog.list(pattern)
+        if recent is not None:
+            entries = [e for e in entries if e.modification_delay() < recent]
+        return entries
+
     def list_files(self, pattern: str | Pattern) -> Optional[Iterable[pl.Path]]:
         """
         List all files available for the current instance with the given pattern
         :param pattern: the pattern of the file to search for
-        :return a list of files or none 
+        :return a list of files or none
         """
-        match pattern:
-            case str(x) as pt:
-                files = self.path.glob(x)
-            case Pattern(p) as pt:
-                files = (f for f in self.path.iterdir() if pt.search(str(p)))
-        return files
-    
+        return [e.path for e in self.list_entries(pattern)]
+
     def list_recent_files(self, last_changed: int = 10) -> Optional[Iterable[pl.Path]]:
         """
         List all files that changed within a specified time
         :param last_changed, the time in minute where the change should be considered
         :return a list of recently changed files
         """
-        return [f for f in self.path.iterdir() if get_modification_delay(f) < last_changed]
+        return [e.path for e in self.catalog.recent(last_changed)]
+
+    def partial_path(self, name: str) -> pl.Path:
+        """
+        Returns a unique temporary path for the upload of `name`
+        """
+        return self.path / f".{name}.{uuid.uuid4().hex}{PARTIAL_SUFFIX}"
+
+    async def write_stream(self, name: str, chunks: AsyncIterator[bytes]) -> UploadResult:
+        """
+        Writes the file `name` from a stream of chunks. The data is written
+        to a temporary file in the instance directory, which is atomically renamed
+        once the stream is exhausted. Memory use is bounded by the size of one chunk.
+        :param name: the name of the file to write, see :obj:`stored_name`
+        :param chunks: an asynchronous iterator of byte chunks
+        :return an :obj:`UploadResult` with the size and throughput of the upload
+        """
+        out_path = self.path / stored_name(name)
+        temp_path = self.partial_path(out_path.name)
+        size = 0
+        start = time.perf_counter()
+        try:
+            async with aiofiles.open(temp_path, 'wb') as f:
+                async for chunk in chunks:
+                    await f.write(chunk)
+                    size += len(chunk)
+            os.replace(temp_path, out_path)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+        duration = time.perf_counter() - start
+        self.catalog.add(out_path)
+        return UploadResult(message=f"Successfuly uploaded {out_path.name} to {out_path}", path=out_path, size=size, duration=duration, rate=(size / duration if duration > 0 else 0.0))
+
+    def get_entry(self, name: str) -> FileEntry:
+        """
+        Returns the catalog entry for the file with the exact name if this exists
+        """
+        entry = self.catalog.get(name)
+        if entry is None:
+            raise FileNotFoundError(f"Cannot find the file with path {self.path / name}")
+        return entry
 
     def get_file(self, name: str) -> List[pl.Path]:
         """
         Finds the file with the exact name if this exists
         """
-        files = [f for f in self.path.iterdir() if f.name == name]
-        if len(files) == 0:
-            raise FileNotFoundError(f"Cannot find the file with path {self.path / name}")
-        else:
-            return files
+        return [self.get_entry(name).path]
     
     def register_parser(self, name:str, new_parser: Type[OpenbisDatasetParser]):
         """
         Given a class, registers it as a  dataset parser (as long as it is a subclass of the :obj:`OpenbisDatasetParser` ABC)
         """
         if issubclass(new_parser, OpenbisDatasetParser):
+            #The parameter schema is generated once, when the parser is registered
+            parser_schema(new_parser)
+            self._registered_parsers.update({name: new_parser})
             self.parsers.update({name: new_parser})
         else:
             raise TypeError(f"Class {new_parser} is not  a subclass of {OpenbisDatasetParser}")
@@ -146,11 +439,20 @@ class InstanceDataStore:
         Find and load alll of the dataset parsers
         """
         py_files = self.parser_path.glob("*.py")
-        res = [f for f in [load_classes(file, OpenbisDatasetParser) for file in py_files] if f is not None]
+        res = [f for f in [load_classes_cached(file, OpenbisDatasetParser) for file in py_files] if f is not None]
         if res:
             classes_per_file = reduce(lambda x,y: x | y, res)
+            for parser in classes_per_file.values():
+                parser_schema(parser)
             return classes_per_file
-            
+
+    def refresh_parsers(self) -> None:
+        """
+        Updates the dataset parsers with the content of the parsers directory.
+        Only the files which changed since the last call are loaded again
+        """
+        found = self.find_parsers() or {}
+        self.parsers = found | self._registered_parsers
 
 
 
@@ -161,6 +463,7 @@ class DataStore:
     """
     base_path: pl.Path
     instances: Dict[str, InstanceDataStore]
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
 
     def get_instance(self, instance: str) -> Optional[InstanceDataStore]:
         """
@@ -196,3 +499,32 @@ class DataStore:
         ni = InstanceDataStore(self.base_path, instance)
         self.instances.update({instance: ni})
 
+    def get_or_add_instance(self, instance: str) -> InstanceDataStore:
+        """
+        Get the datastore for the instance :obj:`instance`,
+        creating it the first time it is requested
+        :param instance: the id of the datastore
+        """
+        with self._lock:
+            if instance not in self.instances:
+                self.add_instance(instance)
+            return self.instances[instance]
+
+
+@cache
+def get_datastore(base_path: pl.Path) -> DataStore:
+    """
+    Returns the process-wide :obj:`DataStore` for the base path `base_path`
+    """
+    return DataStore(base_path, {})
+
+
+def get_instance_store(base_path: pl.Path, instance: str) -> InstanceDataStore:
+    """
+    Returns the (cached) datastore for the instance `instance`,
+    with its dataset parsers brought up to date
+    """
+    ds = get_datastore(base_path).get_or_add_instance(instance)
+    ds.refresh_parsers()
+    return ds
+
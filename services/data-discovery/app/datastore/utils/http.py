@@ -0,0 +1,13 @@
+"""
+Helpers for HTTP conditional requests
+"""
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """
+    Checks an If-None-Match header against `etag`, using the weak comparison
+    """
+    if not if_none_match:
+        return False
+    tags = [t.strip().removeprefix('W/') for t in if_none_match.split(',')]
+    return '*' in tags or etag.removeprefix('W/') in tags
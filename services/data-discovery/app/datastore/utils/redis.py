@@ -1,13 +1,26 @@
 import redis
 from datastore.utils import settings
 import redis.asyncio as redis_async
+from functools import cache
 
-def get_redis(sync=True) -> redis.Redis | redis_async.Redis:
+
+def get_redis_params() -> dict:
     config = settings.get_settings()
-    params = dict(host=config.redis_host, port=config.redis_port, db=config.redis_db, password=config.redis_password)
+    return dict(host=config.redis_host, port=config.redis_port, db=config.redis_db, password=config.redis_password)
+
+@cache
+def get_redis_pool() -> redis.ConnectionPool:
+    """
+    Returns the process-wide pool of synchronous redis connections,
+    which is shared by the threads serving the requests
+    """
+    return redis.ConnectionPool(**get_redis_params())
+
+def get_redis(sync=True) -> redis.Redis | redis_async.Redis:
     if sync:
-        return redis.Redis(**params)
+        return redis.Redis(connection_pool=get_redis_pool())
     else:
-        pool = redis_async.ConnectionPool(**params)
+        #Async connections are bound to the running event loop, so their pool is not shared
+        pool = redis_async.ConnectionPool(**get_redis_params())
         return redis_async.Redis(connection_pool=pool)
 
@@ -2,11 +2,14 @@ from distutils.command.config import config
 
 from datastore.services.ldap.ldap import LdapUser
 from datastore.utils  import redis as redis_utils
+import json
 from rq import Connection, Queue
-from rq.job import Job
+from rq.job import Job, Callback
+from rq.serializers import DefaultSerializer, JSONSerializer
+from datastore.services import jobs as job_service
 from datastore.utils import settings
-from pydantic import BaseSettings
-from typing import Any, List,  Callable, Dict
+from pydantic import BaseModel, BaseSettings
+from typing import Any, List,  Callable, Dict, Type
 
 import redis
 
@@ -16,17 +19,43 @@ class RqSettings(BaseSettings):
     redis_port:int = 6379
     redis_db:int = 0
     redis_password:str = ''
+    task_serialiser: str = 'json'
     class Config:
         env_file = ".env"
 
 
+SERIALISERS = {'pickle': DefaultSerializer, 'json': JSONSerializer}
+
+
 def get_rq_settings() -> RqSettings:
     return RqSettings()
 
+def get_serializer(name: str) -> Type[DefaultSerializer]:
+    """
+    Returns the rq serializer called `name` (`json` or `pickle`).
+    The API and the workers must use the same one
+    """
+    try:
+        return SERIALISERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown task serialiser {name}, use one of {list(SERIALISERS)}")
+
 def get_queue() -> Queue:
     redis = redis_utils.get_redis()
-    q = Queue(connection=redis, is_async=True)
+    q = Queue(connection=redis, is_async=True, serializer=get_serializer(settings.get_settings().task_serialiser))
     return q
 
-def create_job(connection: redis.Redis, user: LdapUser, func: Callable, args: List[Any], kwargs: Dict[str, Any] | None = None,  timeout:int=360):
-    return Job.create(func, args=args, connection=connection, timeout=timeout,  meta={'user': user.username}, kwargs=kwargs)
\ No newline at end of file
+def job_payload(model: BaseModel) -> Dict[str, Any]:
+    """
+    Converts a job descriptor to plain JSON types
+    """
+    return json.loads(model.json())
+
+def create_job(connection: redis.Redis, user: LdapUser, func: Callable, args: List[Any], kwargs: Dict[str, Any] | None = None,  timeout:int=360, serializer: Type[DefaultSerializer] | None = None,
+               on_success: Callable = job_service.on_job_success, on_failure: Callable = job_service.on_job_failure, on_stopped: Callable = job_service.on_job_stopped):
+    """
+    Creates a job for `user`. The default callbacks record its end in the job ledger
+    """
+    serializer = serializer or get_serializer(settings.get_settings().task_serialiser)
+    return Job.create(func, args=args, connection=connection, timeout=timeout,  meta={'user': user.username}, kwargs=kwargs, serializer=serializer,
+        on_success=Callback(on_success), on_failure=Callback(on_failure), on_stopped=Callback(on_stopped))
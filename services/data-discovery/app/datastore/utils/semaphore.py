@@ -0,0 +1,100 @@
+"""
+Counting semaphore shared by all workers through redis.
+The holders of a semaphore are the members of a sorted set scored
+by the expiry of their lease. Holders renew their lease while they
+hold the semaphore, so the slots of a crashed worker are freed when
+its lease expires instead of being lost.
+"""
+import contextlib
+import logging
+import threading
+import time
+import uuid
+from typing import Generator
+
+import redis
+
+from datastore.utils import settings
+
+logger = logging.getLogger(__name__)
+
+#Atomically drops the expired holders, then takes or renews a slot if the holder already has one
+#or if one is free. The redis clock is used so that the workers clocks do not matter
+ACQUIRE_SCRIPT = """
+local key, token, limit, lease = KEYS[1], ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', key, '-inf', now)
+if redis.call('ZSCORE', key, token) or redis.call('ZCARD', key) < limit then
+    redis.call('ZADD', key, now + lease, token)
+    redis.call('PEXPIRE', key, math.ceil(lease * 1000))
+    return 1
+end
+return 0
+"""
+
+
+class RedisSemaphore:
+    """
+    Semaphore allowing at most `limit` holders of `name` at once,
+    across processes and hosts.
+    :param lease: the number of seconds a slot is kept without renewal
+    :param poll_interval: the number of seconds between attempts to take a slot
+    """
+
+    def __init__(self, connection: redis.Redis, name: str, limit: int, lease: float = 60.0, poll_interval: float = 1.0) -> None:
+        self.connection = connection
+        self.key = f"semaphore:{name}"
+        self.limit = limit
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.token = str(uuid.uuid4())
+        self._script = connection.register_script(ACQUIRE_SCRIPT)
+        self._stop_renewal: threading.Event | None = None
+
+    def _try_acquire(self) -> bool:
+        return bool(self._script(keys=[self.key], args=[self.token, self.limit, self.lease]))
+
+    def acquire(self, blocking: bool = True, timeout: float | None = None) -> bool:
+        """
+        Takes a slot, waiting at most `timeout` seconds if `blocking`.
+        Returns True if a slot was taken. The lease is renewed until :obj:`release`
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._try_acquire():
+            if not blocking or (deadline is not None and time.monotonic() >= deadline):
+                return False
+            time.sleep(self.poll_interval if deadline is None else max(0.0, min(self.poll_interval, deadline - time.monotonic())))
+        self._stop_renewal = threading.Event()
+        threading.Thread(target=self._renew, args=(self._stop_renewal,), daemon=True).start()
+        return True
+
+    def _renew(self, stop: threading.Event) -> None:
+        while not stop.wait(self.lease / 3):
+            try:
+                if not self._try_acquire():
+                    logger.warning(f"Lost the lease on {self.key}")
+            except redis.RedisError as e:
+                logger.warning(f"Cannot renew the lease on {self.key}: {e}")
+
+    def release(self) -> None:
+        if self._stop_renewal is not None:
+            self._stop_renewal.set()
+            self._stop_renewal = None
+        self.connection.zrem(self.key, self.token)
+
+    def __enter__(self) -> "RedisSemaphore":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+def openbis_semaphore(connection: redis.Redis, url: str) -> RedisSemaphore:
+    """
+    Returns the semaphore limiting the number of jobs
+    running against the openBIS server at `url`
+    """
+    st = settings.get_settings()
+    return RedisSemaphore(connection, f"openbis:{url}", st.openbis_max_concurrent_jobs, lease=st.openbis_slot_lease)
@@ -27,6 +27,11 @@ class DataStoreSettings(BaseSettings):
     ldap_principal_name: str
     ldap_principal_password: str
     ldap_base: str
+    ldap_pool_size: int = 5
+    ldap_pool_health_interval: float = 30.0
+    ldap_pool_timeout: float | None = 10.0
+    ldap_user_cache_size: int = 1024
+    ldap_user_cache_ttl: float = 300.0
     redis_host: str 
     redis_port: int = 6379
     redis_db: int = 0
@@ -40,7 +45,26 @@ class DataStoreSettings(BaseSettings):
     credentials_storage_key: str = None 
     port: int = 8080
     host: str = "localhost"
-    task_serialiser: str = 'pickle'
+    task_serialiser: str = 'json'
+    upload_chunk_size: int = 1024 * 1024
+    upload_part_size: int = 64 * 1024 * 1024
+    max_upload_size: int = 50 * 1024 * 1024 * 1024
+    upload_ttl: float = 2 * 86400
+    threadpool_size: int = 40
+    tree_cache_size: int = 16
+    tree_refresh_interval: float = 30.0
+    tree_rebuild_interval: float = 900.0
+    progress_ttl: int = 86400
+    progress_min_interval: float = 0.5
+    job_ledger_ttl: int = 30 * 86400
+    job_ledger_user_limit: int = 1000
+    job_ledger_max_events: int = 1000
+    openbis_max_concurrent_jobs: int = 4
+    openbis_slot_lease: float = 60.0
+    transfer_small_limit: int = 100 * 1024 * 1024
+    transfer_large_limit: int = 5 * 1024 * 1024 * 1024
+    transfer_parser_classes: Dict[str, str] = {}
+    transfer_queue_window: int = 4
     class Config:
         env_prefix = ""
         case_sensitive = False
@@ -0,0 +1,351 @@
+"""
+This module implements resumable uploads: a file is uploaded
+as a number of numbered parts, which can be sent in any order (and in parallel)
+and are written at their offset into a preallocated file.
+A manifest of the received parts is kept next to the data so that
+an interrupted upload can be resumed by only sending the missing parts.
+Uploads whose manifest was not touched for a while are considered abandoned
+and removed by :obj:`expire_uploads`.
+Single-request uploads are parsed while they are received by :obj:`MultipartFileReader`.
+"""
+import asyncio
+import contextlib
+import fcntl
+import os
+import pathlib as pl
+import re
+import time
+import uuid
+from collections import deque
+from typing import AsyncIterator, Deque, Iterator, List, Tuple
+
+import aiofiles
+import multipart
+from multipart.multipart import parse_options_header
+from pydantic import BaseModel
+
+from .files import PARTIAL_SUFFIX, stored_name
+
+_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+_MANIFEST_PATTERN = re.compile(r"\.([0-9a-f]{32})\.manifest" + re.escape(PARTIAL_SUFFIX))
+
+
+class UploadTooLargeError(ValueError):
+    """
+    Raised when an upload is larger than the allowed maximum
+    """
+
+
+class UploadManifest(BaseModel):
+    """
+    Persistent state of a resumable upload
+    :ivar upload_id: the id of the upload
+    :ivar filename: the name of the file once the upload is complete
+    :ivar size: the total size of the file in bytes
+    :ivar part_size: the size of every part (except the last one) in bytes
+    :ivar received_parts: the sorted list of the parts written so far
+    """
+    upload_id: str
+    filename: str
+    size: int
+    part_size: int
+    received_parts: List[int] = []
+
+
+def merge_ranges(parts: List[int], part_size: int, size: int) -> List[Tuple[int, int]]:
+    """
+    Given a sorted list of part numbers, returns the list of
+    received byte ranges as (start, end) tuples, with `end` exclusive
+    """
+    ranges: List[Tuple[int, int]] = []
+    for p in parts:
+        start, end = p * part_size, min((p + 1) * part_size, size)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+class ResumableUpload:
+    """
+    Class representing a resumable upload in the directory `directory`
+    """
+
+    def __init__(self, directory: pl.Path, manifest: UploadManifest) -> None:
+        self.directory = directory
+        self.manifest = manifest
+
+    @property
+    def upload_id(self) -> str:
+        return self.manifest.upload_id
+
+    @property
+    def data_path(self) -> pl.Path:
+        return self.directory / f".{self.upload_id}{PARTIAL_SUFFIX}"
+
+    @property
+    def manifest_path(self) -> pl.Path:
+        return self.directory / f".{self.upload_id}.manifest{PARTIAL_SUFFIX}"
+
+    @property
+    def part_count(self) -> int:
+        return max(1, -(-self.manifest.size // self.manifest.part_size))
+
+    @classmethod
+    def create(cls, directory: pl.Path, filename: str, size: int, part_size: int, max_size: int | None = None) -> 'ResumableUpload':
+        """
+        Starts a new upload, preallocating the data file
+        :param directory: the directory where the file is uploaded
+        :param filename: the final name of the file, see :obj:`files.stored_name`
+        :param size: the total size of the file
+        :param part_size: the size of each part
+        :param max_size: the largest allowed size, raises :obj:`UploadTooLargeError` above it
+        """
+        if size < 0 or part_size <= 0:
+            raise ValueError(f"Invalid size {size} or part size {part_size}")
+        if max_size is not None and size > max_size:
+            raise UploadTooLargeError(f"The file is {size} bytes, uploads are limited to {max_size} bytes")
+        manifest = UploadManifest(upload_id=uuid.uuid4().hex, filename=stored_name(filename), size=size, part_size=part_size)
+        upload = cls(directory, manifest)
+        try:
+            with open(upload.data_path, 'wb') as f:
+                if size > 0 and hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(f.fileno(), 0, size)
+                else:
+                    f.truncate(size)
+            upload.save()
+        except OSError:
+            #Do not keep the space of a file which will never be written
+            upload.abort()
+            raise
+        return upload
+
+    @classmethod
+    def load(cls, directory: pl.Path, upload_id: str) -> 'ResumableUpload':
+        """
+        Loads the upload `upload_id` from its manifest
+        """
+        if not _ID_PATTERN.fullmatch(upload_id):
+            raise FileNotFoundError(f"No upload with id {upload_id}")
+        path = directory / f".{upload_id}.manifest{PARTIAL_SUFFIX}"
+        if not path.exists():
+            raise FileNotFoundError(f"No upload with id {upload_id}")
+        return cls(directory, UploadManifest.parse_file(path))
+
+    def save(self) -> None:
+        """
+        Atomically writes the manifest to disk
+        """
+        temp_path = self.manifest_path.with_name(f"{self.manifest_path.name}.{uuid.uuid4().hex}")
+        temp_path.write_text(self.manifest.json())
+        os.replace(temp_path, self.manifest_path)
+
+    @contextlib.contextmanager
+    def lock(self, shared: bool = False) -> Iterator[None]:
+        """
+        Locks the manifest of this upload across processes.
+        The manifest is replaced on every save, so the lock is taken
+        on the data file, which keeps its inode for the whole upload.
+        Parts are written under a `shared` lock, so that they are
+        written concurrently but never while the upload is completed.
+        Raises FileNotFoundError if the upload was completed or aborted
+        """
+        with open(self.data_path, 'rb') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                #The data file may have been moved while waiting for the lock
+                if not self.manifest_path.exists():
+                    raise FileNotFoundError(f"No upload with id {self.upload_id}")
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def part_range(self, part: int) -> Tuple[int, int]:
+        """
+        Returns the offset and the length of the part `part`
+        """
+        if not 0 <= part < self.part_count:
+            raise ValueError(f"Part {part} is out of range, the upload has {self.part_count} parts")
+        offset = part * self.manifest.part_size
+        return offset, min(self.manifest.part_size, self.manifest.size - offset)
+
+    def missing(self) -> List[int]:
+        """
+        Returns the list of the parts which were not yet received
+        """
+        received = set(self.manifest.received_parts)
+        return [p for p in range(self.part_count) if p not in received]
+
+    def received(self) -> List[Tuple[int, int]]:
+        """
+        Returns the list of received byte ranges
+        """
+        return merge_ranges(self.manifest.received_parts, self.manifest.part_size, self.manifest.size)
+
+    async def write_part(self, part: int, chunks: AsyncIterator[bytes]) -> None:
+        """
+        Writes the part `part` at its offset. The part is only
+        recorded in the manifest if it was received completely
+        """
+        offset, length = self.part_range(part)
+        written = 0
+        with self.lock(shared=True):
+            async with aiofiles.open(self.data_path, 'r+b') as f:
+                await f.seek(offset)
+                async for chunk in chunks:
+                    if written + len(chunk) > length:
+                        raise ValueError(f"Part {part} is larger than {length} bytes")
+                    await f.write(chunk)
+                    written += len(chunk)
+        if written != length:
+            raise ValueError(f"Part {part} is incomplete: received {written} of {length} bytes")
+        #Other parts of this upload may hold a shared lock in this event loop
+        await asyncio.to_thread(self._record_part, part)
+
+    def _record_part(self, part: int) -> None:
+        with self.lock():
+            #Reload the manifest to include the parts written concurrently
+            current = UploadManifest.parse_file(self.manifest_path)
+            current.received_parts = sorted(set(current.received_parts) | {part})
+            self.manifest = current
+            self.save()
+
+    def complete(self) -> pl.Path:
+        """
+        Moves the uploaded data to its final name once all parts are received
+        """
+        with self.lock():
+            self.manifest = UploadManifest.parse_file(self.manifest_path)
+            if missing := self.missing():
+                raise ValueError(f"Upload {self.upload_id} is missing parts {missing}")
+            out_path = self.directory / self.manifest.filename
+            os.replace(self.data_path, out_path)
+            self.manifest_path.unlink(missing_ok=True)
+        return out_path
+
+    def abort(self) -> None:
+        """
+        Removes the data and the manifest of this upload
+        """
+        self.data_path.unlink(missing_ok=True)
+        self.manifest_path.unlink(missing_ok=True)
+
+
+def expire_uploads(directory: pl.Path, ttl: float) -> List[str]:
+    """
+    Aborts the uploads in `directory` whose manifest was
+    not modified for `ttl` seconds. Returns their ids
+    """
+    expired = []
+    limit = time.time() - ttl
+    for path in directory.glob(f".*.manifest{PARTIAL_SUFFIX}"):
+        if not (match := _MANIFEST_PATTERN.fullmatch(path.name)):
+            continue
+        try:
+            if path.stat().st_mtime >= limit:
+                continue
+        except FileNotFoundError:
+            continue
+        upload_id = match.group(1)
+        (directory / f".{upload_id}{PARTIAL_SUFFIX}").unlink(missing_ok=True)
+        path.unlink(missing_ok=True)
+        expired.append(upload_id)
+    return expired
+
+
+class MultipartFileReader:
+    """
+    Streams the content of the file field `field` of a multipart/form-data body
+    while the body is received, instead of spooling it to a temporary file first.
+    Only the first file sent as `field` is read, the other fields are skipped
+    :param content_type: the Content-Type header of the request, with the boundary
+    :param field: the name of the file field
+    :param chunk_size: the size of the chunks returned, except the last one
+    """
+
+    def __init__(self, content_type: str, field: str = 'file', chunk_size: int = 1024 * 1024) -> None:
+        _, params = parse_options_header(content_type)
+        if b'boundary' not in params:
+            raise ValueError("The request body is not a multipart form")
+        self.field = field
+        self.chunk_size = chunk_size
+        self.filename: str | None = None
+        self._in_file = False
+        self._finished = False
+        self._header_name = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._pending: Deque[bytes] = deque()
+        self._parser = multipart.MultipartParser(params[b'boundary'], {
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished})
+
+    def _on_part_begin(self) -> None:
+        self._disposition = b""
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._in_file:
+            self._pending.append(data[start:end])
+
+    def _on_part_end(self) -> None:
+        if self._in_file:
+            self._in_file = False
+            self._finished = True
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_name += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        if self._header_name.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._disposition)
+        if self.filename is None and options.get(b"name") == self.field.encode() and b"filename" in options:
+            self.filename = pl.PurePath(options[b"filename"].decode()).name
+            self._in_file = True
+
+    async def open(self, stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """
+        Reads `stream` until the headers of the file field are parsed, so that
+        :obj:`filename` is known, and returns an iterator over the content of the file
+        """
+        self._stream = stream.__aiter__()
+        while self.filename is None:
+            try:
+                self._parser.write(await self._stream.__anext__())
+            except StopAsyncIteration:
+                raise ValueError(f"The request has no file field {self.field}")
+        return self._content()
+
+    async def _content(self) -> AsyncIterator[bytes]:
+        buffer = bytearray()
+        exhausted = False
+        while True:
+            while self._pending:
+                buffer += self._pending.popleft()
+                while len(buffer) >= self.chunk_size:
+                    yield bytes(buffer[:self.chunk_size])
+                    del buffer[:self.chunk_size]
+            if self._finished:
+                break
+            if exhausted:
+                raise ValueError(f"The request ended before the end of the file {self.filename}")
+            try:
+                self._parser.write(await self._stream.__anext__())
+            except StopAsyncIteration:
+                self._parser.finalize()
+                exhausted = True
+        if buffer:
+            yield bytes(buffer)
@@ -1,32 +1,171 @@
-from http import server
+"""
+Supervisor of a pool of rq workers.
+The supervisor forks `--n-workers` processes, each running one rq worker
+on the given queues, restarts the workers which die and forwards
+SIGTERM/SIGINT to them so that they finish their current job before exiting
+(a second signal makes rq abort the jobs).
+The number of jobs running against the same openBIS server is limited
+by :obj:`datastore.utils.semaphore.openbis_semaphore`, not by the pool size.
+Workers take jobs from the queues in the given order, except the first
+`--reversed-workers` ones, which use the reverse order so that the
+last (large transfer) queue progresses even when the first ones are busy.
+Before taking a job, workers move the pending transfers to the rq queues
+(see :obj:`datastore.services.scheduler`).
+Jobs run in the worker process instead of a forked work-horse, so that the
+openBIS connections cached by :obj:`datastore.services.openbis.get_openbis_connection`
+are shared by the jobs of a worker. A worker killed while running a job is restarted
+by the supervisor, rq then fails the abandoned job when cleaning its registries.
+"""
+import argparse
 import logging
-from sqlite3 import connect
+import os
+import signal
+import threading
+import time
+from typing import Callable, Dict, List
 
-import utils
-import argparse
-from typing import Callable, List, Any
-from logging import getLogger
-from rq import Connection, Worker
-from redis import Redis
+from redis import Redis, RedisError
+from rq import SimpleWorker, Worker
+
+from datastore.services import scheduler
+from datastore.utils import rq
 
-from datastore.utils import rq, redis
+logger = logging.getLogger(__name__)
 
 
+class TransferWorker(SimpleWorker):
+    """
+    rq worker running the jobs in its own process and refilling the transfer
+    queues before every dequeue, so that the pending transfers do not stall
+    when a job ends without callback
+    """
+
+    def dequeue_job_and_maintain_ttl(self, timeout, max_idle_time=None):
+        try:
+            scheduler.dispatch_all(self.connection, self.serializer)
+        except RedisError as e:
+            logger.warning(f"Cannot dispatch the pending transfers: {e}")
+        return super().dequeue_job_and_maintain_ttl(timeout, max_idle_time)
 
 
 def create_app(connection: Redis, queue: List[str]) -> Worker:
-    worker = Worker(queue, connection=redis_conn)
+    worker = TransferWorker(queue, connection=connection, serializer=rq.get_serializer(rq.get_rq_settings().task_serialiser))
     return worker
 
 
+def get_connection() -> Redis:
+    settings = rq.get_rq_settings()
+    return Redis(settings.redis_host, settings.redis_port, settings.redis_db, settings.redis_password)
+
+
+def worker_queues(queue: List[str], slot: int, reversed_workers: int) -> List[str]:
+    """
+    Returns the queues of the worker `slot`, by decreasing priority
+    """
+    return queue[::-1] if slot < reversed_workers else list(queue)
+
+
+def run_worker(queue: List[str]) -> None:
+    #Every process needs its own connection, sockets cannot be shared across a fork
+    create_app(get_connection(), queue).work()
+
+
+class WorkerSupervisor:
+    """
+    Keeps `n_workers` child processes running `target(slot)`.
+    A child which exits while the supervisor is running is restarted,
+    after a delay doubling with every crash of a child living less than
+    `stable_after` seconds.
+    """
+
+    def __init__(self, n_workers: int, target: Callable[[int], None], restart_delay: float = 1.0, max_restart_delay: float = 60.0, stable_after: float = 60.0) -> None:
+        self.n_workers = n_workers
+        self.target = target
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stable_after = stable_after
+        self.children: Dict[int, int] = {}
+        self.started: Dict[int, float] = {}
+        self.failures: Dict[int, int] = {}
+        self.restarts = 0
+        self.stopping = False
+
+    def spawn(self, slot: int) -> int:
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                self.target(slot)
+                code = 0
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                logger.exception(f"Worker {slot} failed")
+            finally:
+                os._exit(code)
+        self.children[pid] = slot
+        self.started[slot] = time.monotonic()
+        logger.info(f"Started worker {slot} with pid {pid}")
+        return pid
+
+    def shutdown(self, signum: int = signal.SIGTERM, frame=None) -> None:
+        """
+        Stops restarting workers and forwards `signum` to all of them
+        """
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _wait(self, delay: float) -> None:
+        deadline = time.monotonic() + delay
+        while not self.stopping and time.monotonic() < deadline:
+            time.sleep(min(0.1, delay))
+
+    def _restart(self, slot: int, code: int) -> None:
+        lifetime = time.monotonic() - self.started[slot]
+        self.failures[slot] = 0 if lifetime >= self.stable_after else self.failures.get(slot, 0) + 1
+        delay = min(self.max_restart_delay, self.restart_delay * 2 ** max(0, self.failures[slot] - 1)) if self.failures[slot] else 0.0
+        logger.warning(f"Worker {slot} exited with code {code} after {lifetime:.1f} s, restarting in {delay:.1f} s")
+        self._wait(delay)
+        if not self.stopping:
+            self.restarts += 1
+            self.spawn(slot)
+
+    def run(self) -> None:
+        """
+        Starts the workers and supervises them until all have exited after :obj:`shutdown`
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.shutdown)
+            signal.signal(signal.SIGINT, self.shutdown)
+        for slot in range(self.n_workers):
+            self.spawn(slot)
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            if (slot := self.children.pop(pid, None)) is None:
+                continue
+            if not self.stopping:
+                self._restart(slot, os.waitstatus_to_exitcode(status))
+        logger.info("All workers stopped")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Pool of RQ workers")
+    parser.add_argument("queue", type=str, nargs='+')
+    parser.add_argument("--n-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--reversed-workers", type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    WorkerSupervisor(args.n_workers, lambda slot: run_worker(worker_queues(args.queue, slot, args.reversed_workers))).run()
 
 
-    
-parser = argparse.ArgumentParser(description="Simple RQ worker")
-parser.add_argument("queue", type=str, nargs='+')
-parser.add_argument("--n-workers", type=int)
-args = parser.parse_args()
-settings = rq.get_rq_settings()
-redis_conn = Redis(settings.redis_host, settings.redis_port, settings.redis_db, settings.redis_password)
-worker = create_app(redis_conn, args.queue)
-worker.work()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -8,8 +8,8 @@ class RqSettings(BaseSettings):
     redis_port:int = 6379
     redis_db:int = 0
     redis_password:str = ''
-    task_serialiser:str = 'pickle'
-    accept_content:List[str] = ['pickle']
+    task_serialiser:str = 'json'
+    accept_content:List[str] = ['json']
     class Config:
         env_file = ".env"
 
@@ -0,0 +1,73 @@
+"""
+Micro-benchmark of the conversion of the `get_samples` dataframe to
+`OpenbisSample` objects, as done by `OpenbisSample.get_all_objects`.
+Compares the previous row-wise conversion (one `itertuples` row,
+`utils.prop_dict` and a validated model per sample) with the column-wise
+`OpenbisSample.iter_from_frame`.
+
+Run with `python tests/profile_get_all_objects.py [max_samples]`
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from instance_creator import utils
+from instance_creator.models import OpenbisSample
+
+N_PROPS = 20
+
+
+def sample_frame(n: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        'identifier': [f"/S{i % 10}/P{i % 7}/O{i}" for i in range(n)],
+        'permId': [f"2022-{i}" for i in range(n)],
+        'code': [f"O{i}" for i in range(n)],
+        'registrator': 'admin',
+        'space': [f"S{i % 10}" for i in range(n)],
+        'project': [f"/S{i % 10}/P{i % 7}" for i in range(n)],
+        'experiment': [f"/S{i % 10}/P{i % 7}/C" if i % 3 else 'None' for i in range(n)],
+    })
+    for j in range(N_PROPS):
+        values = pd.Series([f"value {j}"] * n, dtype=object)
+        df[f"PROP_{j}"] = values.where(rng.random(n) > 0.3, None)
+    return df
+
+
+def rowwise(df: pd.DataFrame, prop_names) -> list:
+    return [
+        OpenbisSample(code=samp.code,
+            identifier=samp.identifier,
+            perm_id=samp.permId,
+            type='SAMPLE',
+            registrator=samp.registrator,
+            space=utils.none_if(samp.space, 'None'),
+            project=utils.none_if(samp.project, 'None'),
+            collection=utils.none_if(samp.experiment, 'None'),
+            parent_id=list(utils.split_path(samp.identifier))[:-1],
+            properties=utils.prop_dict(samp, prop_names)) for samp in df.itertuples()]
+
+
+def columnar(df: pd.DataFrame, prop_names) -> list:
+    return list(OpenbisSample.iter_from_frame(df, 'SAMPLE', prop_names))
+
+
+def timed(fun, *args) -> tuple[float, list]:
+    start = time.perf_counter()
+    result = fun(*args)
+    return time.perf_counter() - start, result
+
+
+if __name__ == '__main__':
+    max_samples = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    sizes = [n for n in (1_000, 10_000, 100_000) if n <= max_samples]
+    prop_names = [f"PROP_{j}" for j in range(N_PROPS)]
+    print(f"{'samples':>10} {'rows [s]':>10} {'columns [s]':>12} {'speedup':>8}")
+    for n in sizes:
+        df = sample_frame(n)
+        row_time, rows = timed(rowwise, df, prop_names)
+        col_time, cols = timed(columnar, df, prop_names)
+        assert [r.dict() for r in rows[:100]] == [c.dict() for c in cols[:100]]
+        print(f"{n:>10} {row_time:>10.3f} {col_time:>12.3f} {row_time / col_time:>8.1f}")
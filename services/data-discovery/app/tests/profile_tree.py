@@ -0,0 +1,86 @@
+"""
+Benchmark of the openBIS tree models on synthetic instances.
+Builds the sample tree with `views.build_sample_tree_from_list` and
+attaches samples to an `OpenbisInstance` like `OpenbisInstance.reflect` does,
+for instances of growing size. With the node indices both should scale linearly.
+
+Run with `python tests/profile_tree.py [max_objects]`
+"""
+import sys
+import time
+from types import SimpleNamespace
+
+import pandas as pd
+
+from instance_creator import views
+from instance_creator.models import OpenbisInstance, OpenbisSpace, OpenbisProject, OpenbisCollection, OpenbisSample
+
+
+SPACES = 10
+PROJECTS_PER_SPACE = 10
+COLLECTIONS_PER_PROJECT = 5
+
+
+class SyntheticOpenbis:
+    """
+    Replies to the search calls used to build the tree with `n_objects`
+    objects evenly spread over the projects and collections
+    """
+
+    def __init__(self, n_objects: int) -> None:
+        self.spaces = [f"S{i}" for i in range(SPACES)]
+        self.projects = [(sp, f"/{sp}/P{j}") for sp in self.spaces for j in range(PROJECTS_PER_SPACE)]
+        self.collections = pd.DataFrame([
+            dict(identifier=f"{proj}/C{k}", permId=f"{proj}/C{k}", code=f"C{k}", project=proj, space=sp, type='COLLECTION')
+            for sp, proj in self.projects for k in range(COLLECTIONS_PER_PROJECT)])
+        colls = self.collections.to_dict('records')
+        self.objects = pd.DataFrame([
+            dict(identifier=f"{c['project']}/O{i}", permId=f"O{i}", code=f"O{i}", project=c['project'], space=c['space'],
+                experiment=c['identifier'], type='SAMPLE', parents=[], children=[])
+            for i in range(n_objects) for c in [colls[i % len(colls)]]])
+
+    def get_spaces(self):
+        return SimpleNamespace(df=pd.DataFrame({'code': self.spaces}))
+
+    def get_projects(self):
+        return [SimpleNamespace(identifier=proj, code=proj.split('/')[-1], permId=proj, space=SimpleNamespace(code=sp)) for sp, proj in self.projects]
+
+    def get_collections(self, **kwargs):
+        return SimpleNamespace(df=self.collections)
+
+    def get_objects(self, **kwargs):
+        return SimpleNamespace(df=self.objects)
+
+
+def time_build_tree(ob: SyntheticOpenbis) -> float:
+    start = time.perf_counter()
+    tree = views.build_sample_tree_from_list(ob)
+    elapsed = time.perf_counter() - start
+    assert tree.find(ob.objects.identifier.iloc[-1]) is not None
+    return elapsed
+
+
+def time_attach_samples(ob: SyntheticOpenbis) -> float:
+    spaces = [OpenbisSpace(code=sp, projects=[
+        OpenbisProject(code=proj.split('/')[-1], identifier=proj, collections=[
+            OpenbisCollection(code=c.code, identifier=c.identifier, type=c.type) for c in ob.collections[ob.collections.project == proj].itertuples()])
+        for s, proj in ob.projects if s == sp]) for sp in ob.spaces]
+    inst = OpenbisInstance(spaces=spaces)
+    samples = [OpenbisSample(code=o.code, identifier=o.identifier, type=o.type, collection=o.experiment) for o in ob.objects.itertuples()]
+    start = time.perf_counter()
+    for samp in samples:
+        inst.find(samp.collection).add_child(samp)
+    elapsed = time.perf_counter() - start
+    assert inst.find(samples[-1].identifier) is samples[-1]
+    return elapsed
+
+
+if __name__ == '__main__':
+    max_objects = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    sizes = [n for n in (1_000, 10_000, 100_000, 1_000_000) if n <= max_objects]
+    print(f"{'objects':>10} {'tree [s]':>10} {'us/object':>10} {'attach [s]':>10} {'us/object':>10}")
+    for n in sizes:
+        ob = SyntheticOpenbis(n)
+        tree_time = time_build_tree(ob)
+        attach_time = time_attach_samples(ob)
+        print(f"{n:>10} {tree_time:>10.3f} {tree_time / n * 1e6:>10.1f} {attach_time:>10.3f} {attach_time / n * 1e6:>10.1f}")
@@ -7,12 +7,12 @@ from fastapi import FastAPI
 from fastapi.testclient import TestClient
 from datastore.routers import login, data, openbis, tasks
 from datastore.utils import settings, redis as redis_utils, rq as rq_utils
-from datastore.utils import files
+from datastore.utils import files, uploads
 from datastore.services.ldap import ldap
 from datastore.services.parsers.interfaces import OpenbisDatasetParser
 from datastore.services import openbis as openbis_service
 
-from datastore.models import openbis as openbis_models
+from datastore.models import datasets, openbis as openbis_models
 
 import os
 from typing import Callable, Dict, Any, Type, Generator
@@ -28,6 +28,9 @@ import tempfile as tf
 
 import textwrap
 
+import asyncio
+import time
+
 from datastore.app import create_app
 
 from rq import SimpleWorker, Queue, Worker
@@ -314,4 +317,1163 @@ def test_run_parser(temp_client, login_data):
         tc = temp_client(td)
     response = tc.post("/authorize/openbis/token", data=login_data("all"))
     tok = response.json()
-    pass
\ No newline at end of file
+    pass
+
+def test_catalog_get_file(test_instance: files.InstanceDataStore):
+    fn = test_instance.path / 'data.csv'
+    fn.write_text('a,b')
+    assert test_instance.get_file('data.csv') == [fn]
+    with pytest.raises(FileNotFoundError):
+        test_instance.get_file('missing.csv')
+
+
+def test_catalog_incremental(test_instance: files.InstanceDataStore):
+    (test_instance.path / 'first.csv').write_text('a')
+    assert [e.name for e in test_instance.list_entries('*.csv')] == ['first.csv']
+    (test_instance.path / 'second.csv').write_text('ab')
+    (test_instance.path / 'first.csv').unlink()
+    entries = test_instance.list_entries('*.csv')
+    assert [(e.name, e.size) for e in entries] == [('second.csv', 2)]
+
+
+def test_catalog_hides_partial_uploads(test_instance: files.InstanceDataStore):
+    (test_instance.path / f'.data.csv{files.PARTIAL_SUFFIX}').write_text('a')
+    assert [e.name for e in test_instance.list_entries('*')] == ['parsers']
+
+
+@pytest.fixture
+def instance_client(test_instance: files.InstanceDataStore) -> TestClient:
+    app = create_app()
+    app.dependency_overrides[data.get_user_instance] = lambda: test_instance
+    return TestClient(app)
+
+
+def test_write_stream(test_instance: files.InstanceDataStore):
+    async def chunks():
+        for i in range(4):
+            yield bytes([i]) * 10
+    result = asyncio.run(test_instance.write_stream('stream.bin', chunks()))
+    assert result.size == 40
+    assert (test_instance.path / 'stream.bin').read_bytes()[10:20] == b'\x01' * 10
+    assert not list(test_instance.path.glob(f'*{files.PARTIAL_SUFFIX}'))
+
+
+def test_delete_removes_derived_files(instance_client: TestClient, test_instance: files.InstanceDataStore):
+    (test_instance.path / 'run.xlsx').write_bytes(b'data')
+    (test_instance.path / 'result.cache.npz').write_bytes(b'user data')
+    derived = [test_instance.path / f'.run.xlsx.1-4{files.CACHE_SUFFIX}', test_instance.path / f'.run.xlsx.0123456789abcdef.gpc{files.PREVIEW_SUFFIX}']
+    for path in derived:
+        path.write_bytes(b'derived')
+    other = test_instance.path / f'.run.xlsx2.1-4{files.CACHE_SUFFIX}'
+    other.write_bytes(b'derived')
+    test_instance.catalog.refresh()
+    #Only the generated files are hidden
+    assert sorted(f['name'] for f in instance_client.get("/datasets/").json()['files']) == ['parsers', 'result.cache.npz', 'run.xlsx']
+    instance_client.delete("/datasets/", params={'name': 'run.xlsx'})
+    assert not any(path.exists() for path in derived) and other.exists()
+    assert (test_instance.path / 'result.cache.npz').exists()
+
+
+def test_upload_chunked(instance_client: TestClient, test_instance: files.InstanceDataStore):
+    payload = os.urandom(3 * 1024 * 1024 + 17)
+    resp = instance_client.post("/datasets/", files={'file': ('upload.bin', payload, "application/octet-stream")})
+    assert resp.status_code == 200 and resp.json()['size'] == len(payload)
+    assert (test_instance.path / 'upload.bin').read_bytes() == payload
+    listed = instance_client.get("/datasets/").json()
+    assert 'upload.bin' in [f['name'] for f in listed['files']]
+    assert instance_client.post("/datasets/", data={'comment': 'no file'}).status_code == 400
+    #Names which are empty or would overwrite the internal files are rejected
+    manifest = uploads.ResumableUpload.create(test_instance.path, 'big.bin', 10, 10).manifest_path
+    for name in ['', '.', '..', manifest.name, f'.upload.bin.{"0" * 32}{files.PARTIAL_SUFFIX}']:
+        resp = instance_client.post("/datasets/", files={'file': (name, b'x', "application/octet-stream")})
+        assert resp.status_code == 400
+        assert instance_client.post("/datasets/uploads", json={'filename': name, 'size': 1}).status_code == 400
+    assert uploads.UploadManifest.parse_file(manifest).filename == 'big.bin'
+
+
+def test_multipart_file_reader():
+    payload = os.urandom(10_000)
+    boundary = 'xyz'
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="comment"\r\n\r\nhello\r\n'
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="../dir/run.zip"\r\n'
+        'Content-Type: application/octet-stream\r\n\r\n').encode() + payload + f'\r\n--{boundary}--\r\n'.encode()
+    async def stream(size):
+        for i in range(0, len(body), size):
+            yield body[i:i + size]
+    async def read(size):
+        reader = uploads.MultipartFileReader(f'multipart/form-data; boundary={boundary}', chunk_size=4096)
+        content = await reader.open(stream(size))
+        return reader.filename, [chunk async for chunk in content]
+    #The boundaries can be split across the received chunks
+    for size in [7, 1000, len(body)]:
+        name, chunks = asyncio.run(read(size))
+        assert name == 'run.zip' and b''.join(chunks) == payload and all(len(c) == 4096 for c in chunks[:-1])
+    with pytest.raises(ValueError):
+        asyncio.run(uploads.MultipartFileReader(f'multipart/form-data; boundary={boundary}', field='other').open(stream(100)))
+    with pytest.raises(ValueError):
+        uploads.MultipartFileReader('application/json')
+
+
+def test_resumable_upload(instance_client: TestClient, test_instance: files.InstanceDataStore):
+    part_size = datasets.MIN_UPLOAD_PART_SIZE
+    payload = os.urandom(10 * part_size + 5)
+    start = instance_client.post("/datasets/uploads", json={'filename': 'big.zip', 'size': len(payload), 'part_size': part_size})
+    assert start.status_code == 201
+    status = start.json()
+    assert status['parts'] == 11 and status['missing'] == list(range(11))
+    uid = status['upload_id']
+    #Send the parts out of order and leave a gap
+    for part in [10, 0, 1, 5, 3, 2]:
+        resp = instance_client.put(f"/datasets/uploads/{uid}/{part}", content=payload[part * part_size:(part + 1) * part_size])
+        assert resp.status_code == 200
+    status = instance_client.get(f"/datasets/uploads/{uid}").json()
+    assert status['missing'] == [4, 6, 7, 8, 9]
+    assert status['received'] == [[0, 4 * part_size], [5 * part_size, 6 * part_size], [10 * part_size, len(payload)]]
+    assert instance_client.post(f"/datasets/uploads/{uid}/complete").status_code == 409
+    for part in status['missing']:
+        instance_client.put(f"/datasets/uploads/{uid}/{part}", content=payload[part * part_size:(part + 1) * part_size])
+    assert instance_client.post(f"/datasets/uploads/{uid}/complete").status_code == 200
+    assert (test_instance.path / 'big.zip').read_bytes() == payload
+    assert instance_client.get(f"/datasets/uploads/{uid}").status_code == 404
+
+
+def test_resumable_upload_rejects_short_part(instance_client: TestClient):
+    part_size = datasets.MIN_UPLOAD_PART_SIZE
+    uid = instance_client.post("/datasets/uploads", json={'filename': 'a.bin', 'size': 2 * part_size, 'part_size': part_size}).json()['upload_id']
+    resp = instance_client.put(f"/datasets/uploads/{uid}/0", content=b'x' * 10)
+    assert resp.status_code == 400
+    assert instance_client.get(f"/datasets/uploads/{uid}").json()['missing'] == [0, 1]
+
+
+def test_resumable_upload_completed_concurrently(tmp_path):
+    upload = uploads.ResumableUpload.create(tmp_path, 'a.bin', 10, 10)
+    async def part():
+        yield b'x' * 10
+    asyncio.run(upload.write_part(0, part()))
+    other = uploads.ResumableUpload.load(tmp_path, upload.upload_id)
+    assert upload.complete() == tmp_path / 'a.bin'
+    #The loser of two concurrent requests does not touch the completed file
+    with pytest.raises(FileNotFoundError):
+        other.complete()
+    with pytest.raises(FileNotFoundError):
+        asyncio.run(other.write_part(0, part()))
+    assert (tmp_path / 'a.bin').read_bytes() == b'x' * 10
+
+def test_resumable_upload_limits(instance_client: TestClient, test_instance: files.InstanceDataStore):
+    too_large = settings.get_settings().max_upload_size + 1
+    resp = instance_client.post("/datasets/uploads", json={'filename': 'huge.bin', 'size': too_large})
+    assert resp.status_code == 413
+    assert not list(test_instance.path.glob(f'.*{files.PARTIAL_SUFFIX}'))
+    stale = uploads.ResumableUpload.create(test_instance.path, 'stale.bin', 10, 5)
+    old = time.time() - settings.get_settings().upload_ttl - 1
+    os.utime(stale.manifest_path, (old, old))
+    fresh = instance_client.post("/datasets/uploads", json={'filename': 'fresh.bin', 'size': 10}).json()['upload_id']
+    assert not stale.data_path.exists() and not stale.manifest_path.exists()
+    assert instance_client.get(f"/datasets/uploads/{fresh}").status_code == 200
+    #Parts too small would make the number of parts unbounded
+    for part_size in [1, datasets.MIN_UPLOAD_PART_SIZE - 1, datasets.MAX_UPLOAD_PART_SIZE + 1]:
+        resp = instance_client.post("/datasets/uploads", json={'filename': 'parts.bin', 'size': too_large - 1, 'part_size': part_size})
+        assert resp.status_code == 422
+
+
+def test_parsers_loaded_once(test_parser_file: pl.Path, test_instance: files.InstanceDataStore):
+    file_path = test_instance.parser_path / 'cached.py'
+    file_path.write_text(test_parser_file.read_text())
+    first = test_instance.find_parsers()['TestParser']
+    #Touching the file without changing it does not execute it again
+    os.utime(file_path, ns=(time.time_ns(), time.time_ns() + 10**9))
+    assert test_instance.find_parsers()['TestParser'] is first
+    #Changing the content does
+    file_path.write_text(test_parser_file.read_text() + "\n# changed\n")
+    os.utime(file_path, ns=(time.time_ns(), time.time_ns() + 2 * 10**9))
+    assert test_instance.find_parsers()['TestParser'] is not first
+
+
+def test_instance_store_registry(test_parser_file: pl.Path):
+    with tf.TemporaryDirectory() as td:
+        base = pl.Path(td)
+        ds = files.get_instance_store(base, 'group')
+        assert files.get_instance_store(base, 'group') is ds
+        (ds.parser_path / 'new.py').write_text(test_parser_file.read_text())
+        assert 'TestParser' in files.get_instance_store(base, 'group').parsers
+
+
+def test_ldap_pool_reuses_connections():
+    from fastapi import HTTPException
+    from ldap3 import Server, Connection, MOCK_SYNC
+    from datastore.services.ldap import session as ldap_session
+    import functools
+    server = Server('mock')
+    created = []
+    def factory():
+        con = Connection(server, client_strategy=MOCK_SYNC)
+        #Operations return (status, result, response, request) as with SAFE_SYNC
+        con.strategy.thread_safe = True
+        con.strategy.add_entry('dc=example,dc=com', {'objectClass': 'domain'})
+        con.bind()
+        created.append(con)
+        return con
+    check = functools.partial(ldap_session.check_connection, base='dc=example,dc=com')
+    pool = ldap_session.LdapConnectionPool(factory, size=2, health_interval=0.0, check=check)
+    for _ in range(10):
+        with pool.connection() as con:
+            assert con.bound
+    assert len(created) == 1
+    #A connection which dropped is replaced after the health check
+    created[0].unbind()
+    with pool.connection() as con:
+        assert con is created[1]
+    assert len(created) == 2
+    #A failed search makes the connection unhealthy
+    assert not check(created[1], base='dc=missing,dc=com')
+    #Errors of the caller return the connection to the pool
+    with pytest.raises(HTTPException):
+        with pool.connection() as con:
+            raise HTTPException(status_code=401)
+    with pool.connection() as con:
+        assert con is created[1]
+    assert len(created) == 2
+
+
+def test_ldap_principal_bind_failure(monkeypatch):
+    from ldap3 import Server, Connection, MOCK_SYNC
+    from ldap3.core.exceptions import LDAPException
+    from datastore.services.ldap import session as ldap_session
+    def connection(server, user, password, client_strategy):
+        con = Connection(server, user, password, client_strategy=MOCK_SYNC)
+        con.strategy.thread_safe = True
+        return con
+    monkeypatch.setattr(ldap_session, 'get_server', lambda: Server('mock'))
+    monkeypatch.setattr(ldap_session, 'Connection', connection)
+    #The principal is not known to the mock server, the bind is refused
+    with pytest.raises(LDAPException):
+        ldap_session.get_ldap_connection()
+
+
+def test_ldap_pool_limits_size():
+    from ldap3 import Server, Connection, MOCK_SYNC
+    from ldap3.core.exceptions import LDAPException
+    from datastore.services.ldap import session as ldap_session
+    server = Server('mock')
+    pool = ldap_session.LdapConnectionPool(lambda: Connection(server, client_strategy=MOCK_SYNC, auto_bind=True), size=1, timeout=0.1)
+    with pool.connection():
+        with pytest.raises(LDAPException):
+            with pool.connection():
+                pass
+
+
+def test_ttl_cache_expiry_and_eviction():
+    from datastore.utils.cache import TTLCache
+    now = [0.0]
+    c = TTLCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    c.set('a', 1)
+    c.set('b', 2)
+    assert c.get('a') == 1
+    c.set('c', 3)
+    #'b' is the least recently used entry
+    assert c.get('b') is None
+    assert c.get('a') == 1
+    now[0] = 11
+    assert c.get('a') is None
+    assert c.get_or_load('a', lambda: 4) == 4
+    c.invalidate('a')
+    assert c.get('a') is None
+
+
+def test_ttl_cache_single_flight():
+    from concurrent.futures import ThreadPoolExecutor
+    from datastore.utils.cache import TTLCache
+    c = TTLCache()
+    calls = []
+    def loader():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'user'
+    with ThreadPoolExecutor(8) as ex:
+        results = list(ex.map(lambda _: c.get_or_load('uid', loader), range(8)))
+    assert results == ['user'] * 8
+    assert len(calls) == 1
+    assert c.get_or_load('uid', loader) == 'user'
+    assert len(calls) == 1
+
+
+def test_slow_openbis_does_not_block_datasets(test_instance: files.InstanceDataStore, monkeypatch):
+    """
+    While several slow `/openbis/tree` requests are running,
+    the latency of `/datasets/` should stay flat
+    """
+    import httpx
+    from datastore.routers import login as login_router
+    from datastore.services import tree as tree_service
+    tree_time = 1.0
+    build = tree_service.build_snapshot
+    def slow_build(ob):
+        time.sleep(tree_time)
+        return build(ob)
+    monkeypatch.setattr(tree_service, 'build_snapshot', slow_build)
+    app = create_app()
+    app.dependency_overrides[data.get_user_instance] = lambda: test_instance
+    app.dependency_overrides[login_router.get_openbis] = FakeOpenbis
+    app.dependency_overrides[tree_service.get_tree_cache] = lambda: tree_service.TreeCache(refresh_interval=float('inf'))
+    async def timed(client, url):
+        start = time.perf_counter()
+        resp = await client.get(url)
+        assert resp.status_code == 200
+        return time.perf_counter() - start
+    async def run():
+        async with httpx.AsyncClient(app=app, base_url='http://test') as client:
+            slow = [asyncio.create_task(timed(client, '/openbis/tree')) for _ in range(4)]
+            await asyncio.sleep(0.05)
+            fast = []
+            for _ in range(10):
+                fast += await asyncio.gather(*[timed(client, '/datasets/') for _ in range(10)])
+            return await asyncio.gather(*slow), sorted(fast)
+    slow, fast = asyncio.run(run())
+    p99 = fast[int(0.99 * (len(fast) - 1))]
+    assert min(slow) >= tree_time
+    assert p99 < tree_time / 4
+
+
+class FakeThings:
+    def __init__(self, df, start_with=None, count=None):
+        self.totalCount = len(df)
+        start = start_with or 0
+        self.df = df.iloc[start:(start + count if count is not None else None)]
+
+
+class FakeOpenbis:
+    """
+    In-memory stand-in for the openBIS search calls used to build the sample tree
+    """
+    def __init__(self, token: str = 'fake-token'):
+        import pandas as pd
+        self.token = token
+        self.spaces = pd.DataFrame({'code': ['S1', 'S2']})
+        self.projects = pd.DataFrame({'identifier': ['/S1/P1', '/S2/P2'], 'permId': ['p1', 'p2']})
+        self.collections = pd.DataFrame({'identifier': ['/S1/P1/C1'], 'permId': ['c1'], 'code': ['C1'], 'project': ['/S1/P1'], 'space': ['S1'], 'type': ['COLLECTION'], 'modificationDate': ['2022-01-01 10:00:00']})
+        self.objects = pd.DataFrame({'identifier': ['/S1/P1/O1', '/S2/P2/O2'], 'permId': ['o1', 'o2'], 'code': ['O1', 'O2'], 'project': ['/S1/P1', '/S2/P2'], 'space': ['S1', 'S2'],
+            'experiment': ['/S1/P1/C1', ''], 'type': ['SAMPLE', 'SAMPLE'], 'parents': [[], []], 'children': [[], []], 'modificationDate': ['2022-01-01 10:00:00', '2022-01-02 10:00:00']})
+        self.calls = []
+
+    def _filter(self, df, modificationDate=None, start_with=None, count=None, attrs=None, **filters):
+        if modificationDate is not None:
+            df = df[df.modificationDate.str[:10] >= modificationDate.lstrip('>=')]
+        for column, value in filters.items():
+            df = df[df[column] == value]
+        return FakeThings(df, start_with, count)
+
+    def get_spaces(self, **kwargs):
+        return self._filter(self.spaces, **kwargs)
+
+    def get_projects(self, space=None, **kwargs):
+        df = self.projects if space is None else self.projects[self.projects.identifier.str.startswith(f'/{space}/')]
+        return self._filter(df, **kwargs)
+
+    def get_collections(self, **kwargs):
+        self.calls.append(('collections', kwargs))
+        return self._filter(self.collections, **kwargs)
+
+    def get_objects(self, collection=None, **kwargs):
+        self.calls.append(('objects', kwargs))
+        if collection is not None:
+            kwargs['experiment'] = collection
+        return self._filter(self.objects, **kwargs)
+
+
+def test_tree_snapshot_incremental():
+    import pandas as pd
+    from datastore.services import tree as tree_service
+    ob = FakeOpenbis()
+    snapshot = tree_service.build_snapshot(ob)
+    assert snapshot.find('/S1/P1/O1').collection == '/S1/P1/C1'
+    assert snapshot.find('/S2/P2/O2').parent().identifier == '/S2/P2'
+    _, etag = snapshot.serialised
+    assert tree_service.refresh_snapshot(ob, snapshot) == 0
+    assert ob.calls[-1] == ('objects', {'attrs': tree_service.OBJECT_ATTRS, 'modificationDate': '>=2022-01-02'})
+    assert snapshot.serialised[1] == etag
+    #A new object and a moved object
+    ob.objects = pd.concat([ob.objects, pd.DataFrame({'identifier': ['/S2/P2/O3'], 'permId': ['o3'], 'code': ['O3'], 'project': ['/S2/P2'], 'space': ['S2'],
+            'experiment': [''], 'type': ['SAMPLE'], 'parents': [[]], 'children': [[]], 'modificationDate': ['2022-01-03 10:00:00']})], ignore_index=True)
+    ob.objects.loc[0, ['project', 'modificationDate']] = ['/S2/P2', '2022-01-03 11:00:00']
+    assert tree_service.refresh_snapshot(ob, snapshot) == 2
+    assert snapshot.serialised[1] != etag
+    assert snapshot.find('/S2/P2').children_ids() == ['/S2/P2/O2', '/S1/P1/O1', '/S2/P2/O3']
+    assert snapshot.find('/S1/P1').children_ids() == ['/S1/P1/C1']
+    snapshot.detach('/S2/P2')
+    assert snapshot.find('/S2/P2/O3') is None
+
+
+def test_openbis_tree_etag():
+    from datastore.routers import login as login_router
+    from datastore.services import tree as tree_service
+    app = create_app()
+    ob = FakeOpenbis()
+    cache = tree_service.TreeCache()
+    app.dependency_overrides[login_router.get_openbis] = lambda: ob
+    app.dependency_overrides[tree_service.get_tree_cache] = lambda: cache
+    client = TestClient(app)
+    resp = client.get('/openbis/tree')
+    assert resp.status_code == 200 and [c['identifier'] for c in resp.json()['children']] == ['S1', 'S2']
+    cached = client.get('/openbis/tree', headers={'If-None-Match': resp.headers['etag']})
+    assert cached.status_code == 304
+    assert len([c for c in ob.calls if c[0] == 'objects']) == 1
+    #Weak tags and lists of tags match too
+    assert client.get('/openbis/tree', headers={'If-None-Match': f'"other", W/{resp.headers["etag"]}'}).status_code == 304
+    #A failed refresh serves the cached tree
+    cache.refresh_interval = -1
+    def fail(*args, **kwargs):
+        raise ConnectionError('openBIS is down')
+    ob.get_objects = fail
+    stale = client.get('/openbis/tree')
+    assert stale.status_code == 200 and stale.headers['etag'] == resp.headers['etag']
+
+
+def test_tree_element_index():
+    from instance_creator.views import TreeElement
+    root = TreeElement(identifier='/')
+    space = TreeElement(identifier='S', children=[TreeElement(identifier='/S/P1')])
+    root.push(space)
+    space.get('/S/P1').push(TreeElement(identifier='/S/P1/O1'))
+    assert root.find('/S/P1/O1').parent() is space.get('/S/P1')
+    root.push(TreeElement(identifier='S'))
+    assert root.children_ids() == ['S']
+    space.remove('/S/P1')
+    assert root.find('/S/P1/O1') is None and root.find('/S/P1') is None
+    space.children = [TreeElement(identifier='/S/P2')]
+    assert root.find('/S/P2').parent() is space
+
+
+def test_openbis_tree_object_index():
+    from instance_creator.models import OpenbisInstance, OpenbisSpace, OpenbisProject, OpenbisSample
+    inst = OpenbisInstance(spaces=[OpenbisSpace(code='S', projects=[OpenbisProject(code='P', identifier='/S/P')])])
+    project = inst.find('/S/P')
+    assert project is inst.find('P')
+    samp = OpenbisSample(code='O1', identifier='/S/P/O1', type='SAMPLE')
+    project.add_child(samp)
+    assert inst.find('/S/P/O1') is samp and inst.find('S').find('O1') is samp
+
+
+def test_openbis_children_pages():
+    import pandas as pd
+    from datastore.routers import login as login_router
+    app = create_app()
+    ob = FakeOpenbis()
+    ob.objects = pd.concat([ob.objects] + [pd.DataFrame({'identifier': [f'/S1/P1/X{i}'], 'permId': [f'x{i}'], 'code': [f'X{i}'], 'project': ['/S1/P1'], 'space': ['S1'],
+            'experiment': [''], 'type': ['SAMPLE'], 'parents': [[]], 'children': [[]], 'modificationDate': ['2022-01-01 10:00:00']}) for i in range(4)], ignore_index=True)
+    app.dependency_overrides[login_router.get_openbis] = lambda: ob
+    client = TestClient(app)
+    spaces = client.get('/openbis/children', params={'depth': 2}).json()
+    assert [s['identifier'] for s in spaces['items']] == ['S1', 'S2'] and spaces['next_cursor'] is None
+    assert [p['identifier'] for p in spaces['items'][0]['children']] == ['/S1/P1']
+    cursor, ids = 0, []
+    while cursor is not None:
+        page = client.get('/openbis/children', params={'identifier': '/S1/P1', 'type': 'PROJECT', 'cursor': cursor, 'limit': 2}).json()
+        assert page['total'] == 6
+        ids += [c['identifier'] for c in page['items']]
+        cursor = page['next_cursor']
+    assert ids == ['/S1/P1/C1', '/S1/P1/O1', *[f'/S1/P1/X{i}' for i in range(4)]]
+    coll = client.get('/openbis/children', params={'identifier': '/S1/P1/C1', 'type': 'COLLECTION'}).json()
+    assert [c['identifier'] for c in coll['items']] == ['/S1/P1/O1']
+    #Deep pages are limited to a bounded number of nested requests
+    assert client.get('/openbis/children', params={'depth': 3, 'limit': 1000}).status_code == 400
+    assert client.get('/openbis/children', params={'depth': 3, 'limit': 9}).status_code == 200
+
+
+class RecordingOpenbis:
+    """
+    Records the v3 create calls and fails the creations with a code in `failing`
+    """
+    def __init__(self, failing=()):
+        import pandas as pd
+        self.token = 'fake-token'
+        self.as_v3 = '/openbis/openbis/rmi-application-server-v3.json'
+        self.failing = set(failing)
+        self.requests = []
+        self.empty = FakeThings(pd.DataFrame({'code': [], 'identifier': []}))
+        self.spaces = FakeThings(pd.DataFrame({'code': ['EXISTING']}))
+
+    def _post_request(self, resource, request):
+        self.requests.append((request['method'], [c.get('code') for c in request['params'][1]]))
+        if any(c.get('code') in self.failing for c in request['params'][1]):
+            raise ValueError('Creation failed')
+
+    def get_spaces(self, **kwargs):
+        return self.spaces
+
+    def __getattr__(self, name):
+        return lambda **kwargs: self.empty
+
+
+def test_batch_create_instance():
+    from instance_creator.models import OpenbisInstance, OpenbisSpace, OpenbisProject, OpenbisCollection, OpenbisSample, OpenbisObjectType, OpenbisProperty, BatchCreator, format_report
+    samples = [OpenbisSample(code=f'O{i}', type='SAMPLE') for i in range(10)]
+    inst = OpenbisInstance(
+        properties=[OpenbisProperty(code='P', label='P', description='A property', data_type='VARCHAR')],
+        object_types=[OpenbisObjectType(code='SAMPLE', prefix='S', properties={'General': ['P']})],
+        spaces=[OpenbisSpace(code='EXISTING'), OpenbisSpace(code='S', projects=[OpenbisProject(code='P', collections=[OpenbisCollection(code='C', type='COLLECTION', samples=samples)])])])
+    ob = RecordingOpenbis(failing={'O3'})
+    creator = BatchCreator(ob, batch_size=4)
+    reports = {r.level: r for r in creator.create(inst)}
+    assert [m for m, _ in ob.requests[:5]] == ['createPropertyTypes', 'createSampleTypes', 'createSpaces', 'createProjects', 'createExperiments']
+    assert ob.requests[2] == ('createSpaces', ['S'])
+    assert reports['spaces'].skipped == 1
+    #The failing sample is isolated by splitting its batch
+    assert (reports['samples'].created, reports['samples'].failed) == (9, 1)
+    assert reports['samples'].requests == 3 + 4
+    assert [c.key for c, _ in creator.errors] == ['/S/O3']
+    assert 'samples' in format_report(list(reports.values()))
+
+
+class ReflectedThings:
+    def __init__(self, df, objects=()):
+        self.df = df
+        self.response = {'objects': list(objects)}
+
+
+class ListingOpenbis:
+    """
+    Replies to the list calls used to reflect an instance and counts them
+    """
+    def __init__(self):
+        import pandas as pd
+        self.calls = []
+        assignment = {'section': 'General', 'ordinal': 1, 'propertyType': {'code': 'NAME'}}
+        self.listings = {
+            'get_property_types': ReflectedThings(pd.DataFrame({'code': ['NAME', 'SYS'], 'label': ['Name', 'Sys'], 'dataType': ['VARCHAR', 'VARCHAR'], 'description': ['A name', 'System'], 'registrator': ['admin', 'system']})),
+            'get_object_types': ReflectedThings(None, [{'code': 'SAMPLE', 'generatedCodePrefix': 'S', 'autoGeneratedCode': True, 'propertyAssignments': [assignment]}, {'code': 'UNKNOWN'}]),
+            'get_collection_types': ReflectedThings(None, [{'code': 'MEASUREMENTS', 'description': 'Measurements', 'propertyAssignments': [assignment]}]),
+            'get_spaces': ReflectedThings(pd.DataFrame({'code': ['S1', 'STORAGE'], 'registrator': ['admin', 'admin']})),
+            'get_projects': ReflectedThings(None, [{'code': 'P1', 'identifier': {'identifier': '/S1/P1'}, 'permId': {'permId': 'p1'}, 'description': 'A project', 'leader': None, 'registrator': {'userId': 'admin'}}]),
+            'get_collections': ReflectedThings(pd.DataFrame({'code': ['C1'], 'identifier': ['/S1/P1/C1'], 'permId': ['c1'], 'type': ['MEASUREMENTS'], 'registrator': ['admin'], 'project': ['/S1/P1'], 'NAME': ['Run']})),
+            'get_users': ReflectedThings(pd.DataFrame({'permId': ['admin'], 'firstName': ['A'], 'lastName': ['B']})),
+            'get_role_assignments': ReflectedThings(pd.DataFrame({'techId': ['1'], 'role': ['ADMIN'], 'roleLevel': ['SPACE'], 'user': ['admin'], 'group': [''], 'space': ['S1'], 'project': ['']})),
+            'get_samples': ReflectedThings(pd.DataFrame({'code': ['O1'], 'identifier': ['/S1/P1/O1'], 'permId': ['o1'], 'registrator': ['admin'], 'space': ['S1'], 'project': ['/S1/P1'], 'experiment': ['/S1/P1/C1'], 'NAME': ['Sample']}))}
+
+    def __getattr__(self, name):
+        def listing(*args, **kwargs):
+            self.calls.append(name)
+            return self.listings[name]
+        return listing
+
+
+def test_reflect_instance_bulk():
+    from instance_creator.models import OpenbisInstance
+    ob = ListingOpenbis()
+    inst = OpenbisInstance.reflect(ob, workers=4)
+    assert sorted(ob.calls) == sorted([*ob.listings])
+    assert [p.code for p in inst.properties] == ['NAME']
+    assert [ot.code for ot in inst.object_types] == ['SAMPLE'] and inst.object_types[0].properties == {'General': ['NAME']}
+    assert inst.collection_types[0].properties == ['NAME']
+    assert [sp.code for sp in inst.children] == ['S1']
+    coll = inst.find('/S1/P1/C1')
+    assert coll.properties == {'NAME': 'Run'} and inst.find('/S1/P1').description == 'A project'
+    assert [c.identifier for c in coll.children] == ['/S1/P1/O1'] and coll.children[0].properties == {'NAME': 'Sample'}
+    assert inst.roles[0].space == 'S1' and inst.roles[0].project is None
+
+
+def test_ndjson_export_import(tmp_path: pl.Path):
+    from instance_creator.models import OpenbisInstance, OpenbisSpace, OpenbisProject, OpenbisCollection, OpenbisSample, OpenbisProperty, OpenbisObjectType, BatchCreator, read_records
+    inst = OpenbisInstance(
+        properties=[OpenbisProperty(code='NAME', label='Name', description='A name', data_type='VARCHAR')],
+        object_types=[OpenbisObjectType(code='SAMPLE', prefix='S', properties={'General': ['NAME']})],
+        spaces=[OpenbisSpace(code='S', projects=[OpenbisProject(code='P', collections=[
+            OpenbisCollection(code='C', type='COLLECTION', samples=[OpenbisSample(code=f'O{i}', type='SAMPLE', properties={'NAME': f'{i}'}) for i in range(5)])])])])
+    path = tmp_path / 'instance.ndjson'
+    inst.export(path)
+    lines = path.read_text().splitlines()
+    assert len(lines) == 1 + 1 + 1 + 1 + 1 + 5
+    records = list(read_records(path))
+    assert [r.kind for r in records[:5]] == ['property', 'object_type', 'space', 'project', 'collection']
+    assert records[-1].parent == '/S/P/C' and records[-1].entity.properties == {'NAME': '4'}
+    ob = RecordingOpenbis()
+    reports = {r.level: r for r in BatchCreator(ob, batch_size=2).create_records(read_records(path))}
+    assert reports['samples'].created == 5 and reports['samples'].requests == 3
+    assert [m for m, _ in ob.requests] == ['createPropertyTypes', 'createSampleTypes', 'createSpaces', 'createProjects', 'createExperiments', *['createSamples'] * 3]
+    path.write_text(lines[0] + '\n{"kind": "space", "entity": {}}\n')
+    with pytest.raises(ValueError, match='line 2'):
+        list(read_records(path))
+
+
+def test_sync_plan():
+    from instance_creator.models import OpenbisInstance, OpenbisSpace, OpenbisProject, OpenbisCollection, OpenbisSample, OpenbisProperty, iter_records
+    from instance_creator import sync
+    def instance(samples, props, spaces=()):
+        return OpenbisInstance(
+            properties=[OpenbisProperty(code='NAME', label='Name', description=props, data_type='VARCHAR')],
+            spaces=[OpenbisSpace(code='S', projects=[OpenbisProject(code='P', collections=[
+                OpenbisCollection(code='C', type='COLLECTION', samples=[OpenbisSample(code=code, identifier=f'/S/P/{code}', type='SAMPLE', properties={'NAME': name}) for code, name in samples])])]),
+                *[OpenbisSpace(code=sp) for sp in spaces]])
+    live = instance([('O1', 'a'), ('O2', 'b'), ('O3', 'c')], 'A name', spaces=['OLD'])
+    desired = instance([('O1', 'a'), ('O2', 'changed'), ('O4', 'd')], 'A new name')
+    operations = sync.diff(iter_records(live), iter_records(desired))
+    assert [(op.action, op.record.kind, op.key) for op in operations] == [('update', 'property', 'NAME'), ('update', 'sample', '/S/O2'), ('create', 'sample', '/S/O4')]
+    assert operations[1].changes == {'NAME': ('b', 'changed')}
+    pruned = sync.diff(iter_records(live), iter_records(desired), prune=True)
+    assert {(op.record.kind, op.key) for op in pruned if op.action == 'delete'} == {('space', 'OLD'), ('sample', '/S/O3')}
+    assert 'Plan: 1 to create, 2 to update, 2 to delete' in sync.format_plan(pruned)
+    ob = RecordingOpenbis()
+    reports = {r.level: r for r in sync.apply(ob, pruned)}
+    assert (reports['samples'].created, reports['updates'].created, reports['deletions'].created) == (1, 2, 2)
+    methods = [m for m, _ in ob.requests]
+    assert methods == ['createSamples', 'updatePropertyTypes', 'updateSamples', 'deleteSamples', 'deleteSpaces']
+
+
+def test_samples_from_frame():
+    import pandas as pd
+    from instance_creator.models import OpenbisSample
+    df = pd.DataFrame({'identifier': ['/S/P/O1', '/O2'], 'permId': ['o1', 'o2'], 'code': ['O1', 'O2'], 'registrator': ['admin', 'admin'],
+        'space': ['S', 'None'], 'project': ['/S/P', None], 'experiment': ['None', None], 'NAME': ['a', None], 'OTHER': ['x', 'y']})
+    first, second = OpenbisSample.iter_from_frame(df, 'SAMPLE', ['NAME'], chunk_size=1)
+    assert (first.space, first.project, first.collection, first.parent_id) == ('S', '/S/P', None, ['/', 'S', 'P'])
+    assert first.properties == {'NAME': 'a'} and second.properties == {}
+    assert (second.space, second.parent_id) == (None, ['/'])
+    assert first.dict() == OpenbisSample(**first.dict()).dict()
+
+
+class FakeRedis:
+    """
+    In-memory stand-in for the redis commands used by the progress messages and the job ledger.
+    Pipelines run their commands immediately
+    """
+    def __init__(self):
+        self.values, self.published, self.hashes, self.streams, self.zsets = {}, [], {}, {}, {}
+        self.results = []
+
+    def pipeline(self, transaction=True):
+        self.results = []
+        return self
+
+    def execute(self):
+        results, self.results = self.results, []
+        return results
+
+    def _result(self, value):
+        self.results.append(value)
+        return value
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def publish(self, channel, value):
+        self.published.append((channel, value))
+
+    def expire(self, key, ttl):
+        pass
+
+    def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update(mapping)
+
+    def hgetall(self, key):
+        return self._result(dict(self.hashes.get(key, {})))
+
+    def xadd(self, key, fields, maxlen=None, approximate=True):
+        stream = self.streams.setdefault(key, [])
+        stream.append((f"{len(stream)}-0", dict(fields)))
+
+    def xrange(self, key, min='-', count=None):
+        entries = [e for e in self.streams.get(key, []) if min == '-' or int(e[0].split('-')[0]) >= int(min.split('-')[0])]
+        return entries[:count]
+
+    def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    def zremrangebyrank(self, key, start, end):
+        ranked = sorted(self.zsets.get(key, {}).items(), key=lambda kv: kv[1])
+        end = len(ranked) + end if end < 0 else end
+        for member, _ in ranked[start:end + 1]:
+            del self.zsets[key][member]
+
+    def zrevrange(self, key, start, end):
+        ranked = sorted(self.zsets.get(key, {}), key=self.zsets.get(key, {}).get, reverse=True)
+        return ranked[start:end + 1]
+
+
+def test_progress_reporter_throttles():
+    from datastore.models.messages import ProgressMessage, ProgressStage
+    from datastore.services import messages as message_service
+    now = [0.0]
+    connection = FakeRedis()
+    reporter = message_service.ProgressReporter(connection, 'job', min_interval=1.0, clock=lambda: now[0])
+    assert reporter.update(ProgressStage.STARTED, bytes_total=200, bytes_processed=0)
+    assert not reporter.update(bytes_processed=50)
+    now[0] = 2.0
+    assert reporter.update(bytes_processed=100)
+    assert reporter.update(ProgressStage.FINISHED, bytes_processed=200)
+    messages = [ProgressMessage.parse_raw(body) for _, body in connection.published]
+    assert [(m.stage, m.percent) for m in messages] == [(ProgressStage.STARTED, 0.0), (ProgressStage.STARTED, 50.0), (ProgressStage.FINISHED, 100.0)]
+    assert {channel for channel, _ in connection.published} == {'progress:job'}
+    assert ProgressMessage.parse_raw(connection.values['progress-last:job']).stage.terminal
+
+
+class FakeAsyncRedis:
+    def __init__(self, values=None):
+        self.values = values or {}
+
+    async def get(self, key):
+        return self.values.get(key)
+
+
+def idle_broker(connection):
+    """
+    Returns a progress broker which is fed by the test instead of redis
+    """
+    from datastore.services import messages as message_service
+    broker = message_service.ProgressBroker(connection)
+    async def start():
+        pass
+    broker.start = start
+    return broker
+
+
+def test_progress_mailbox_coalesces():
+    from datastore.models.messages import ProgressMessage, ProgressStage
+    from datastore.services import messages as message_service
+    async def run():
+        last = ProgressMessage(job_id='job', stage=ProgressStage.STARTED, time=1.0)
+        broker = idle_broker(FakeAsyncRedis({'progress-last:job': last.json()}))
+        async with broker.subscribe('job') as mailbox:
+            assert (await mailbox.get()).stage == ProgressStage.STARTED
+            for i in range(100):
+                broker.dispatch({'type': 'pmessage', 'channel': b'progress:job', 'data': ProgressMessage(job_id='job', stage=ProgressStage.PARSING, items_processed=i, time=2.0 + i).json()})
+            broker.dispatch({'type': 'pmessage', 'channel': b'progress:other', 'data': b'not parsed'})
+            message = await mailbox.get()
+            assert message.items_processed == 99 and mailbox.coalesced == 99
+            #An older message does not replace a newer one
+            mailbox.put(last)
+            assert mailbox._message is None
+        assert broker.mailboxes == {}
+    asyncio.run(run())
+
+
+def test_progress_websocket():
+    from datastore.models.messages import ProgressMessage, ProgressStage
+    from datastore.routers import tasks as tasks_router
+    app = create_app()
+    broker = idle_broker(FakeAsyncRedis({'progress-last:job': ProgressMessage(job_id='job', stage=ProgressStage.PARSING).json()}))
+    app.dependency_overrides[tasks_router.get_progress_broker] = lambda: broker
+    client = TestClient(app)
+    with client.websocket_connect('/tasks/tasks/log?id=job') as ws:
+        assert ProgressMessage.parse_raw(ws.receive_text()).stage == ProgressStage.PARSING
+        broker.dispatch({'type': 'pmessage', 'channel': 'progress:job', 'data': ProgressMessage(job_id='job', stage=ProgressStage.FINISHED).json()})
+        assert ProgressMessage.parse_raw(ws.receive_text()).stage == ProgressStage.FINISHED
+
+    #A message of the client ends the subscription
+    with client.websocket_connect('/tasks/tasks/log?id=job') as ws:
+        ws.receive_text()
+        ws.send_text('stop')
+    assert broker.mailboxes == {}
+
+
+def test_progress_broker_restarts():
+    from datastore.models.messages import ProgressMessage, ProgressStage
+    from datastore.services import messages as message_service
+    class FakePubSub:
+        def __init__(self, fail):
+            self.fail = fail
+        async def psubscribe(self, pattern):
+            if self.fail:
+                raise RuntimeError('unexpected')
+        async def listen(self):
+            #Leaves the time to register the mailbox
+            await asyncio.sleep(0.05)
+            yield {'type': 'pmessage', 'channel': b'progress:job', 'data': ProgressMessage(job_id='job', stage=ProgressStage.FINISHED).json()}
+            await asyncio.Event().wait()
+        async def close(self):
+            pass
+    class FailingOnce(FakeAsyncRedis):
+        calls = 0
+        def pubsub(self, **kwargs):
+            self.calls += 1
+            return FakePubSub(self.calls == 1)
+    async def run():
+        connection = FailingOnce()
+        broker = message_service.ProgressBroker(connection, retry_interval=0.01)
+        async with broker.subscribe('job') as mailbox:
+            message = await asyncio.wait_for(mailbox.get(), 5)
+        assert message.stage == ProgressStage.FINISHED and connection.calls == 2
+        broker._task.cancel()
+    asyncio.run(run())
+
+
+def test_job_ledger():
+    from datetime import datetime, timedelta
+    from types import SimpleNamespace
+    from datastore.models.jobs import JobEvent
+    from datastore.models.messages import ProgressStage
+    from datastore.services import jobs as job_service, messages as message_service
+    connection = FakeRedis()
+    ledger = job_service.JobLedger(connection, ttl=60, user_limit=2, max_events=100)
+    start = datetime(2022, 1, 1)
+    for i in range(3):
+        job = SimpleNamespace(id=f'job{i}', meta={'user': 'alice'}, func_name='tasks.process', description='process', enqueued_at=start + timedelta(minutes=i), started_at=None, ended_at=None)
+        ledger.enqueued(job)
+    assert [j.id for j in ledger.user_jobs('alice')] == ['job2', 'job1']
+    reporter = message_service.ProgressReporter(connection, 'job2', min_interval=0)
+    reporter.update(ProgressStage.STARTED, items_total=4, items_processed=0)
+    reporter.update(ProgressStage.PARSING, items_processed=2)
+    assert ledger.get('job2').status == JobEvent.STARTED and ledger.get('job2').percent == 50.0
+    job.started_at, job.ended_at = start + timedelta(minutes=3), start + timedelta(minutes=5)
+    job_service.on_job_failure(job, connection, ValueError, ValueError('Processing failed'), None)
+    record = ledger.get('job2')
+    assert (record.status, record.queued_seconds, record.run_seconds) == (JobEvent.FAILED, 60.0, 120.0)
+    assert record.detail == 'ValueError: Processing failed'
+    events = ledger.events('job2')
+    assert [e.event for e in events] == [JobEvent.ENQUEUED, JobEvent.STARTED, JobEvent.PROGRESS, JobEvent.FAILED]
+    assert events[2].fields['items_processed'] == '2'
+    assert [e.event for e in ledger.events('job2', start=events[2].id)] == [JobEvent.PROGRESS, JobEvent.FAILED]
+
+
+def test_task_list_endpoint():
+    from types import SimpleNamespace
+    from datastore.routers import data as data_router
+    from datastore.services import jobs as job_service
+    connection = FakeRedis()
+    ledger = job_service.JobLedger(connection, ttl=60, user_limit=10, max_events=100)
+    ledger.enqueued(SimpleNamespace(id='job', meta={'user': 'alice'}, func_name='f', description='f', enqueued_at=None))
+    ledger.enqueued(SimpleNamespace(id='other', meta={'user': 'bob'}, func_name='f', description='f', enqueued_at=None))
+    app = create_app()
+    app.dependency_overrides[job_service.get_job_ledger] = lambda: ledger
+    app.dependency_overrides[data_router.get_ldap_user] = lambda: SimpleNamespace(username='alice')
+    client = TestClient(app)
+    assert [j['id'] for j in client.get('/tasks/task_list').json()] == ['job']
+    assert [e['event'] for e in client.get('/tasks/history', params={'id': 'job'}).json()] == ['enqueued']
+    assert client.get('/tasks/history', params={'id': 'other'}).status_code == 404
+
+
+def test_worker_supervisor(tmp_path):
+    import signal
+    import threading
+    from datastore.worker.main import WorkerSupervisor
+    def target(slot: int):
+        marker = tmp_path / f"runs-{slot}"
+        runs = int(marker.read_text()) if marker.exists() else 0
+        marker.write_text(str(runs + 1))
+        #The first worker crashes once
+        if slot == 0 and runs == 0:
+            raise RuntimeError("Worker crashed")
+        signal.pause()
+    supervisor = WorkerSupervisor(2, target, restart_delay=0.01)
+    thread = threading.Thread(target=supervisor.run)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and not ((tmp_path / 'runs-0').exists() and (tmp_path / 'runs-0').read_text() == '2' and (tmp_path / 'runs-1').exists()):
+        time.sleep(0.01)
+    supervisor.shutdown()
+    thread.join(10)
+    assert not thread.is_alive() and not supervisor.children
+    assert supervisor.restarts == 1 and (tmp_path / 'runs-1').read_text() == '1'
+
+
+def test_transfer_job_payload(tmp_path, monkeypatch):
+    from types import SimpleNamespace
+    from rq.serializers import JSONSerializer
+    from datastore.models.openbis import OpenbisConnection
+    from datastore.models.parser import TransferJob
+    from datastore.services import openbis as openbis_service
+    from datastore.services.parsers import icp_ms, registry as parser_registry
+    from datastore.tasks import openbis as ob_tasks
+    from datastore.utils import rq as rq_utils
+    from instance_creator.views import OpenbisHierarcy
+    ds = files.InstanceDataStore(tmp_path, 'inst')
+    (ds.path / 'data.zip').write_bytes(b'')
+    monkeypatch.setattr(parser_registry, 'get_instance_store', lambda instance: ds)
+    ds.register_parser('icp_ms', icp_ms.ICPMsParser)
+    calls = []
+    monkeypatch.setattr(ob_tasks, 'process', lambda *args: calls.append(args))
+    descriptor = TransferJob(connection=OpenbisConnection(openbis='https://openbis.example.com', token='admin-123'), instance='inst', files=['data.zip'], identifier='/S/P/C', type=OpenbisHierarcy.COLLECTION, parser='icp_ms', parameters={'sample_type': 'ICP'})
+    job = rq_utils.create_job(FakeRedis(), SimpleNamespace(username='alice'), ob_tasks.transfer, [rq_utils.job_payload(descriptor)], serializer=JSONSerializer)
+    #The job only holds JSON data
+    assert len(job.data) < 1000
+    func, _, args, kwargs = JSONSerializer.loads(job.data)
+    assert func == 'datastore.tasks.openbis.transfer' and TransferJob.parse_obj(args[0]) == descriptor
+    ob_tasks.transfer(*args)
+    ob, data, identifier, type, parser, parameters = calls[0]
+    assert ob is openbis_service.get_openbis_connection('https://openbis.example.com', 'admin-123') and ob.token == 'admin-123'
+    assert data == [ds.path / 'data.zip'] and (identifier, type, parameters) == ('/S/P/C', 'COLLECTION', {'sample_type': 'ICP'})
+    assert isinstance(parser, icp_ms.ICPMsParser)
+    with pytest.raises(ValueError):
+        ob_tasks.transfer({**args[0], 'files': ['../outside.zip']})
+    with pytest.raises(ValueError):
+        ob_tasks.transfer({**args[0], 'parser': 'unknown'})
+
+
+def test_transfer_classes(monkeypatch):
+    from datastore.models.jobs import SizeClass
+    from datastore.services import scheduler as scheduler_service
+    from datastore.worker.main import worker_queues
+    monkeypatch.setenv('TRANSFER_SMALL_LIMIT', '100')
+    monkeypatch.setenv('TRANSFER_LARGE_LIMIT', '1000')
+    monkeypatch.setenv('TRANSFER_PARSER_CLASSES', '{"gpc": "medium"}')
+    assert [scheduler_service.classify(size, 'icp_ms') for size in (10, 100, 999, 1000)] == [SizeClass.SMALL, SizeClass.MEDIUM, SizeClass.MEDIUM, SizeClass.LARGE]
+    #A parser only raises the class of its transfers
+    assert scheduler_service.classify(10, 'gpc') == SizeClass.MEDIUM and scheduler_service.classify(5000, 'gpc') == SizeClass.LARGE
+    queues = [c.queue for c in SizeClass]
+    assert worker_queues(queues, 0, 1) == ['transfers-large', 'transfers-medium', 'transfers-small']
+    assert worker_queues(queues, 1, 1) == queues
+
+
+def test_pending_transfers_do_not_stall(monkeypatch):
+    from rq import Worker
+    from datastore.models.jobs import SizeClass
+    from datastore.services import scheduler as scheduler_service
+    from datastore.worker.main import TransferWorker
+    dispatched = []
+    class FakeScheduler:
+        def __init__(self, connection, serializer=None):
+            pass
+        def dispatch(self, size_class):
+            dispatched.append(size_class)
+            return 0
+    monkeypatch.setattr(scheduler_service, 'TransferScheduler', FakeScheduler)
+    #Workers refill all classes before taking a job
+    monkeypatch.setattr(Worker, 'dequeue_job_and_maintain_ttl', lambda self, timeout, max_idle_time=None: 'job')
+    worker = object.__new__(TransferWorker)
+    worker.connection, worker.serializer = None, None
+    assert worker.dequeue_job_and_maintain_ttl(1) == 'job' and dispatched == list(SizeClass)
+
+
+def test_worker_jobs_share_connections():
+    from datastore.worker.main import create_app
+    #Jobs run in the worker process, the connection cached by the first job is used by the second
+    openbis_service.get_openbis_connection.cache_clear()
+    con = redis_utils.get_redis()
+    worker = create_app(con, ['test-shared-connection'])
+    queue = Queue('test-shared-connection', connection=con, serializer=worker.serializer)
+    jobs = [queue.enqueue(openbis_service.get_openbis_connection, 'https://localhost', 'token') for _ in range(2)]
+    worker.work(burst=True)
+    assert all(job.get_status(refresh=True) == 'finished' for job in jobs)
+    info = openbis_service.get_openbis_connection.cache_info()
+    assert info.misses == 1 and info.hits == 1
+
+def test_icp_ms_streams_archive(tmp_path, monkeypatch):
+    import zipfile
+    from types import SimpleNamespace
+    from datastore.services.parsers import icp_ms
+    archive = tmp_path / 'run.zip'
+    log = "Sample Name,Acq. Date-Time,Sample Type,Acquisition Result,Operator,File Name\n" + \
+        "s1,2022-01-01,Sample,Pass,me,C:\\data\\001SMPL.d\n" + \
+        "s2,2022-01-01,Blank,Skip,me,C:\\data\\002SMPL.d\n"
+    with zipfile.ZipFile(archive, 'w') as zf:
+        zf.writestr('run/BatchLog.csv', log.encode(icp_ms.ICPMsParser.encoding))
+        zf.writestr('run/001SMPL.d/AcqData/data.bin', b'1' * 10)
+        zf.writestr('run/002SMPL.d/AcqData/data.bin', b'2' * 10)
+    monkeypatch.setattr(zipfile.ZipFile, 'extractall', lambda *args, **kwargs: pytest.fail("The archive must not be extracted"))
+    with zipfile.ZipFile(archive) as zf:
+        batch_log = icp_ms.read_batch_log(zf, icp_ms.ICPMsParser.encoding)
+        assert list(batch_log.samplename) == ['s1', 's2']
+        folders = icp_ms.index_folders(zf)
+        extracted = icp_ms.extract_members(zf, folders['001SMPL.d'], tmp_path / 'out')
+        assert [f.relative_to(tmp_path / 'out').as_posix() for f in extracted] == ['run/001SMPL.d/AcqData/data.bin']
+        assert not (tmp_path / 'out' / 'run' / '002SMPL.d').exists()
+    project = SimpleNamespace(identifier='/S/P')
+    dataset = SimpleNamespace(sample=SimpleNamespace(experiment=SimpleNamespace(identifier='/S/P/C'), project=project), file_list=[archive])
+    requests = []
+    def post(resource, request):
+        requests.append(request)
+        if request['method'] == 'searchSamples':
+            return {'objects': []}
+        return [{'permId': c['code']} for c in request['params'][1]]
+    ob = SimpleNamespace(token='token', as_v3='/v3', _post_request=post)
+    transaction = SimpleNamespace(add=pytest.fail)
+    icp_ms.ICPMsParser().process(ob, transaction, dataset, 'loader', 'description')
+    assert [r['method'] for r in requests] == ['searchSamples', 'createSamples']
+    [creation] = requests[1]['params'][1]
+    with zipfile.ZipFile(archive) as zf:
+        digest = icp_ms.batch_log_digest(zf)
+    assert (creation['code'], creation['experimentId']['identifier']) == (f'ICPMS-RUN-{digest}-0001', '/S/P/ICP_MS_MEASUREMENTS')
+    assert creation['properties'] == {'ICPMS.SAMPLE_NAME': 's1', 'ICPMS.ACQ_TIMESTAMP': '2022-01-01', 'ICPMS.SAMPLE_TYPE': 'Sample', 'ICPMS.ACQUISTION_RESULT': 'Pass', 'ICPMS.OPERATOR': 'me'}
+    #The samples are sent in chunks
+    parser = icp_ms.ICPMsParser()
+    parser.chunk_size = 2
+    requests.clear()
+    codes = [f"ICPMS-RUN-{i:04d}" for i in range(5)]
+    assert parser.create_samples(ob, [{'ICPMS.SAMPLE_NAME': f"s{i}"} for i in range(5)], codes, '/S/P/C') == codes
+    assert [len(r['params'][1]) for r in requests if r['method'] == 'createSamples'] == [2, 2, 1]
+    empty = tmp_path / 'empty.zip'
+    zipfile.ZipFile(empty, 'w').close()
+    with zipfile.ZipFile(empty) as zf, pytest.raises(ValueError):
+        icp_ms.read_batch_log(zf, icp_ms.ICPMsParser.encoding)
+    #Another run uploaded under the same name gets other codes
+    other = tmp_path / 'other' / 'run.zip'
+    other.parent.mkdir()
+    with zipfile.ZipFile(other, 'w') as zf:
+        zf.writestr('run/BatchLog.csv', log.replace('2022-01-01', '2023-01-01').encode(icp_ms.ICPMsParser.encoding))
+    with zipfile.ZipFile(other) as zf:
+        assert icp_ms.batch_log_digest(zf) != digest
+
+
+def test_icp_ms_samples_idempotent():
+    from types import SimpleNamespace
+    from datastore.services.parsers import icp_ms
+    parser = icp_ms.ICPMsParser()
+    parser.chunk_size = 2
+    codes = [f'ICPMS-RUN-{i:04d}' for i in range(1, 6)]
+    props = [{'ICPMS.SAMPLE_NAME': code} for code in codes]
+    requests = []
+    def post(resource, request):
+        requests.append(request)
+        match request['method']:
+            case 'searchSamples':
+                #The first sample exists from an earlier attempt
+                return {'objects': [{'code': c, 'permId': {'permId': 'old'}} for c in request['params'][1]['criteria'][0]['fieldValue'] if c == codes[0]]}
+            case 'createSamples':
+                if len([r for r in requests if r['method'] == 'createSamples']) == 2:
+                    raise ValueError('Server error')
+                return [{'permId': c['code'].lower()} for c in request['params'][1]]
+            case 'deleteSamples':
+                return {'techId': 1}
+    ob = SimpleNamespace(token='token', as_v3='/v3', _post_request=post)
+    with pytest.raises(ValueError):
+        parser.create_samples(ob, props, codes, '/S/P/C')
+    created = [c['code'] for r in requests if r['method'] == 'createSamples' for c in r['params'][1]]
+    assert created[:2] == codes[1:3]
+    #Only the samples created by the failed attempt are removed
+    [deletion] = [r for r in requests if r['method'] == 'deleteSamples']
+    assert [i['permId'] for i in deletion['params'][1]] == [c.lower() for c in codes[1:3]]
+    assert requests[-1]['method'] == 'confirmDeletions'
+    requests.clear()
+    ob._post_request = lambda resource, request: post(resource, request) if request['method'] != 'createSamples' else [{'permId': c['code'].lower()} for c in request['params'][1]]
+    assert parser.create_samples(ob, props, codes, '/S/P/C') == ['old', *[c.lower() for c in codes[1:]]]
+
+def test_gpc_import_cache(tmp_path, monkeypatch):
+    import numpy as np
+    import pandas as pd
+    openpyxl = pytest.importorskip('openpyxl')
+    from datastore.services.parsers import gpc
+    wb = openpyxl.Workbook()
+    wb.create_sheet('Data')
+    ws = wb.worksheets[1]
+    for row in [['Sample', 'x'], [None], [gpc.CHANNELS_HEADER], ['Channel', 'Name'], [1, 'RI'], [2, 'UV'], [None], [gpc.RAW_DATA_HEADER], ['Time', 'RI', 'UV'], *[[i * 0.1, i, None if i == 2 else 2 * i] for i in range(5)], [None], ['Trailer', 'ignored']]:
+        ws.append(row)
+    source = tmp_path / 'run.xlsx'
+    wb.save(source)
+    data = gpc.import_gcp_data(source)
+    assert list(data.columns) == ['RT', 'RI', 'UV'] and len(data) == 5 and np.isnan(data.UV[2])
+    cached = gpc.cache_path(source)
+    assert cached.exists() and not files.is_internal_file(source.name) and files.is_internal_file(cached.name)
+    #The cache is used instead of the workbook until the workbook changes
+    reads = []
+    read_rows = gpc.iter_sheet_rows
+    monkeypatch.setattr(gpc, 'iter_sheet_rows', lambda path: reads.append(path) or read_rows(path))
+    pd.testing.assert_frame_equal(gpc.import_gcp_data(source), data)
+    assert reads == []
+    os.utime(source, ns=(source.stat().st_atime_ns, source.stat().st_mtime_ns + 10**9))
+    pd.testing.assert_frame_equal(gpc.import_gcp_data(source), data)
+    assert reads == [source] and not cached.exists() and gpc.cache_path(source).exists()
+
+
+def test_previews(tmp_path):
+    import numpy as np
+    from types import SimpleNamespace
+    from datastore.services.parsers import previews
+    x = np.arange(100_000, dtype=float)
+    y = np.sin(x / 1000)
+    y[12_345] = 10.0
+    y[50_000:50_010] = np.nan
+    xs, ys = previews.minmax_downsample(x, y, 500)
+    #The peaks are kept, in order
+    assert len(xs) <= 1000 and np.all(np.diff(xs) > 0)
+    assert 12_345 in xs and np.nanmax(ys) == 10.0 and np.nanmin(ys) == np.nanmin(y)
+    assert len(previews.minmax_downsample(x[:10], y[:10], 500)[0]) == 10
+    source = tmp_path / 'run.xlsx'
+    source.write_bytes(b'data')
+    preview = previews.preview_path(source, 'gpc')
+    assert files.is_internal_file(preview.name) and preview.parent == tmp_path
+    preview.write_bytes(b'png')
+    staging = tmp_path / 'staging'
+    staging.mkdir()
+    dataset = SimpleNamespace(is_new=True, files=[str(source)], permId=None)
+    staged = previews.attach_preview(dataset, preview, staging)
+    previews.attach_preview(dataset, preview, staging)
+    assert staged == staging / 'run.xlsx.gpc.preview.png' and staged.read_bytes() == b'png'
+    assert dataset.files == [str(source), str(staged)]
+    with pytest.raises(ValueError):
+        previews.attach_preview(SimpleNamespace(is_new=False, permId='1'), preview, staging)
+    preview.unlink()
+    pytest.importorskip('matplotlib')
+    draws = []
+    drawn = previews.cached_preview(source, lambda fig: draws.append(fig.add_subplot().plot(xs, ys)), 'gpc')
+    assert drawn == preview and previews.cached_preview(source, draws.append, 'gpc') == preview and len(draws) == 1
+    source.write_bytes(b'other data')
+    assert previews.cached_preview(source, lambda fig: None, 'gpc') != preview and not preview.exists()
+
+
+def test_previews_are_best_effort():
+    from types import SimpleNamespace
+    class BrokenPreviews(OpenbisDatasetParser):
+        def process(self, ob: Openbis, transaction: Transaction, dataset: DataSet) -> Transaction:
+            return transaction
+        def previews(self, dataset):
+            raise ImportError("No module named 'matplotlib'")
+    commits = []
+    ob = SimpleNamespace(new_transaction=lambda: SimpleNamespace(commit=lambda: commits.append(True)))
+    dataset = SimpleNamespace(is_new=True, files=['run.xlsx'], permId=None, save=lambda: commits.append('saved'))
+    BrokenPreviews().run(ob, dataset)
+    assert commits == [True, 'saved'] and dataset.files == ['run.xlsx']
+
+
+def test_previews_are_saved(tmp_path):
+    from types import SimpleNamespace
+    from datastore.services.parsers import previews
+    source = tmp_path / 'run.xlsx'
+    source.write_bytes(b'data')
+    preview = previews.preview_path(source, 'gpc')
+    preview.write_bytes(b'png')
+    class WithPreviews(OpenbisDatasetParser):
+        def process(self, ob: Openbis, transaction: Transaction, dataset: DataSet) -> Transaction:
+            return transaction
+        def previews(self, dataset):
+            return [preview]
+    saved = {}
+    class NewDataSet(SimpleNamespace):
+        def save(self):
+            #The staged previews must still exist when the files are uploaded
+            saved.update({pl.Path(f).name: pl.Path(f).read_bytes() for f in self.files})
+            self.is_new = False
+    ob = SimpleNamespace(new_transaction=lambda: SimpleNamespace(commit=lambda: None))
+    dataset = NewDataSet(is_new=True, files=[str(source)], permId=None)
+    WithPreviews().run(ob, dataset)
+    assert saved == {'run.xlsx': b'data', 'run.xlsx.gpc.preview.png': b'png'}
+    #The error of a failed job is reported with its cause
+    class Failing(WithPreviews):
+        def process(self, ob: Openbis, transaction: Transaction, dataset: DataSet) -> Transaction:
+            raise KeyError('SAMPLE_CODE')
+    with pytest.raises(ValueError, match="Processing failed: 'SAMPLE_CODE'") as e:
+        Failing().run(ob, NewDataSet(is_new=True, files=[str(source)], permId=None))
+    assert isinstance(e.value.__cause__, KeyError)
+
+
+def test_parser_schema_cache(tmp_path):
+    from types import SimpleNamespace
+    from datastore.models.parser import FunctionParameters
+    from datastore.routers import data as data_router
+    from datastore.services.parsers.interfaces import parser_schema
+    from datastore.services import jobs as job_service, scheduler as scheduler_service
+    class CountingParser(OpenbisDatasetParser):
+        """
+        Counts things
+        """
+        def process(self, ob, transaction, dataset, count: int, label: str = 'x'):
+            return transaction
+    doc = FunctionParameters.__doc__
+    inst = files.InstanceDataStore(tmp_path, 'inst')
+    inst.register_parser('counting', CountingParser)
+    (inst.path / 'data.csv').write_text('1')
+    schema = parser_schema(CountingParser)
+    assert CountingParser()._generate_basemodel() is schema.model and FunctionParameters.__doc__ == doc
+    assert schema.schema['required'] == ['count'] and schema.schema['description'].startswith('Counts things')
+    app = create_app()
+    app.dependency_overrides[data_router.get_user_instance] = lambda: inst
+    app.dependency_overrides[data_router.get_ldap_user] = lambda: SimpleNamespace(username='alice')
+    app.dependency_overrides[data_router.get_openbis] = lambda: SimpleNamespace(url='https://openbis.example.com', token='token')
+    app.dependency_overrides[scheduler_service.get_transfer_scheduler] = lambda: SimpleNamespace(connection=None, serializer=None, submit=lambda *args: pytest.fail("No job must be scheduled"))
+    app.dependency_overrides[job_service.get_job_ledger] = lambda: None
+    client = TestClient(app)
+    resp = client.get('/datasets/parser_info', params={'parser': 'counting'})
+    assert resp.status_code == 200 and resp.json() == schema.schema and resp.headers['etag'] == schema.etag
+    resp = client.get('/datasets/parser_info', params={'parser': 'counting'}, headers={'If-None-Match': f'"other", W/{schema.etag}'})
+    assert resp.status_code == 304 and resp.content == b''
+    assert client.get('/datasets/parser_info', params={'parser': 'unknown'}).status_code == 404
+    body = {'source': 'data.csv', 'identifier': '/S/P/C', 'type': 'COLLECTION', 'parser': 'counting', 'dataset_type': 'RAW_DATA', 'function_parameters': {'count': 'many'}}
+    resp = client.put('/datasets/transfer', json=body)
+    assert resp.status_code == 422 and resp.json()['detail'][0]['loc'] == ['count']
@@ -18,17 +18,32 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import argparse as ap
+import sys
 import pybis
 import pathlib as pl
-from instance_creator.models import OpenbisInstance
+from instance_creator.models import OpenbisInstance, BatchCreator, NDJSON_SUFFIXES, format_report, iter_records, read_records
+from instance_creator import sync
+def report(reports):
+    """
+    Prints the reports with the failed entities and exits with an error if any failed
+    """
+    print(format_report(reports))
+    if any(r.failed for r in reports):
+        sys.exit(1)
+
 def main():
     parser = ap.ArgumentParser(usage="create_test_structure.py your_instance:port admin_user admin_password config_file.json")
     parser.add_argument("url", type=str, help="Url to openbis instance")
     parser.add_argument("username", type=str, help="Username")
     parser.add_argument("password", type=str, help="password")
-    parser.add_argument('what', type=str, choices=['create', 'export'])
-    parser.add_argument("config", type=pl.Path, help="Path to json configuration file")
+    parser.add_argument('what', type=str, choices=['create', 'export', 'sync'])
+    parser.add_argument("config", type=pl.Path, help="Path to json configuration file, use the suffix .ndjson to stream one entity per line")
     parser.add_argument('--wipe', action="store_true", help="If set, wipes the instance clean before creating")
+    parser.add_argument('--batch-size', type=int, default=1000, help="Maximum number of entities created per request. Set to 0 to create the entities one by one")
+    parser.add_argument('--dry-run', action="store_true", help="With sync, only print the planned operations")
+    parser.add_argument('--prune', action="store_true", help="With sync, delete the entities which are not in the configuration")
+    parser.add_argument('--yes', action="store_true", help="With sync, apply the deletions without asking for confirmation")
+    parser.add_argument('--workers', type=int, default=8, help="Number of concurrent requests used to reflect the instance")
     args = parser.parse_args()
 
 
@@ -40,10 +55,35 @@ def main():
     match args.what:
         case 'create':
             if args.wipe:
-                oi = OpenbisInstance.reflect(ob)
+                oi = OpenbisInstance.reflect(ob, args.workers)
                 oi.wipe(ob)
-            oi = OpenbisInstance.parse_file(args.config).create(ob)
+            if args.config.suffix in NDJSON_SUFFIXES:
+                #Records are created while the file is read
+                if args.batch_size <= 0:
+                    parser.error("NDJSON configurations can only be created in batches")
+                report(BatchCreator(ob, args.batch_size).create_records(read_records(args.config)))
+                return
+            oi = OpenbisInstance.parse_file(args.config)
+            if args.batch_size > 0:
+                report(oi.create_batched(ob, args.batch_size))
+            else:
+                oi.create(ob)
+        case 'sync':
+            if args.config.suffix in NDJSON_SUFFIXES:
+                desired = list(read_records(args.config))
+            else:
+                desired = list(iter_records(OpenbisInstance.parse_file(args.config)))
+            live = iter_records(OpenbisInstance.reflect(ob, args.workers))
+            #The roles of the user running the sync are kept so that it does not lock itself out
+            operations = sync.diff(live, desired, prune=args.prune, keep_users=[ob._get_username(), args.username])
+            print(sync.format_plan(operations))
+            if not args.dry_run and operations:
+                deletions = sum(op.action == 'delete' for op in operations)
+                if deletions and not args.yes and input(f"Permanently delete {deletions} entities? [y/N] ").strip().lower() not in ['y', 'yes']:
+                    print("Aborted, nothing was changed")
+                    return
+                report(sync.apply(ob, operations, max(args.batch_size, 1)))
         case 'export':
-            instance_config = OpenbisInstance.reflect(ob).export(args.config)
+            instance_config = OpenbisInstance.reflect(ob, args.workers).export(args.config)
 
 
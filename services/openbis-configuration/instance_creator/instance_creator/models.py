@@ -22,23 +22,30 @@ from ast import Pass
 from dataclasses import field
 from re import S
 from select import select
-from typing import Callable, Any, Dict, List, Literal, NamedTuple, Type, TypeVar, Union, Generator, Optional
+from typing import Callable, Any, Dict, Iterable, List, Literal, NamedTuple, Set, Tuple, Type, TypeVar, Union, Generator, Optional
 from typing_extensions import Self
 import pybis
+import numpy as np
+import pandas as pd
+from pybis.utils import parse_jackson
 from pybis.pybis import PropertyType, Space, SampleType, ExperimentType, Project, OpenBisObject, Experiment, Things, Sample, DataSetType, DataSet, Person, RoleAssignment
 from pydantic.dataclasses import dataclass
-from pydantic import BaseModel, Field, validator, root_validator
+from pydantic import BaseModel, Field, PrivateAttr, validator, root_validator
 import pathlib as pl
 from .validators import children_validator, TreeObject
 from . import utils
 import functools
 import itertools
+import time
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 
 SACRED_SPACES = ['ELN_SETTINGS', 'STORAGE', 'METHODS', 'MATERIALS', 'STOCK_CATALOG', 'STOCK_ORDERS', 'PUBLICATIONS']
 SACRED_USERS = ['etl', 'system']
 SACRED_OBJECT_TYPES = ['UNKNOWN', 'GENERAL_ELN_SETTINGS', 'ENTRY', 'GENERAL_PROTOCOL', 'EXPERIMENTAL_STEP', 'STORAGE', 'STORAGE_POSITION', 'SUPPLIER', 'PRODUCT', 'REQUEST', 'ORDER', 'PUBLICATION', 'SEARCH_QUERY']
 SACRED_COLLECTION_TYPES = ['DEFAULT_EXPERIMENT', 'UNKNOWN', 'COLLECTION']
+NDJSON_SUFFIXES = ['.ndjson', '.jsonl']
 
 class OpenbisGenericObject(ABC, BaseModel, TreeObject):
     """
@@ -168,6 +175,8 @@ class OpenbisTreeObject(OpenbisGenericObject):
     rel_in: List[str] | List = []
     rel_out: List[str] | List = []
     properties: Dict[str, Any] | List['OpenbisProperty'] = None
+    _index: Dict[str, 'OpenbisTreeObject'] | None = PrivateAttr(None)
+    _parent: Optional['OpenbisTreeObject'] = PrivateAttr(None)
      
 
     def path(self) -> str | None:
@@ -182,14 +191,45 @@ class OpenbisTreeObject(OpenbisGenericObject):
             if found:
                 return found[0]
     
+    def _register(self, index: Dict[str, 'OpenbisTreeObject'], root: 'OpenbisTreeObject') -> None:
+        """
+        Adds `root` and its descendants (depth first) to `index` by code and identifier,
+        keeping the first node registered for a key
+        """
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            for key in (node.code, node.identifier):
+                if key is not None:
+                    index.setdefault(key, node)
+            children = node.children or []
+            for child in children:
+                child._parent = node
+            stack.extend(reversed(children))
+
     def find(self, identifier: str) -> Optional['OpenbisTreeObject']:
-        if (self.code == identifier) or (self.identifier == identifier):
-            return self
-        else:
-            if self.children:
-                child = [p for c in self.children if (p:= c.find(identifier))]
-                if len(child) > 0:
-                    return child[0]
+        """
+        Finds a node in this subtree by code or identifier.
+        The index is built on the first call and kept up to date by :meth:`add_child`
+        """
+        if self._index is None:
+            self._index = {}
+            self._register(self._index, self)
+        return self._index.get(identifier)
+
+    def add_child(self, child: 'OpenbisTreeObject') -> None:
+        """
+        Appends `child` to the children, updating the index of this node and its ancestors
+        """
+        if self.children is None:
+            self.children = []
+        self.children.append(child)
+        child._parent = self
+        node = self
+        while node is not None:
+            if node._index is not None:
+                self._register(node._index, child)
+            node = node._parent
 
     
     def wipe(self, ob: pybis.Openbis):
@@ -256,26 +296,49 @@ class OpenbisSample(OpenbisTreeObject):
         return obj
 
     @classmethod
-    def get_all_objects(cls, ob: pybis.Openbis, sample_type:str) -> List['OpenbisSample']:
+    def get_all_objects(cls, ob: pybis.Openbis, sample_type:str, prop_names: List[str] | None = None) -> List['OpenbisSample']:
+        """
+        Returns all objects of type `sample_type`. If the names of the
+        properties assigned to the type are not given, they are fetched from openBIS
+        """
         samples =  ob.get_samples(type=sample_type, props='*', attrs=['code','space', 'project', 'experiment'])
-        prop_assigned = ob.get_object_type(sample_type).get_property_assignments()
-        if not prop_assigned.df.empty:
-            prop_names = prop_assigned.df.propertyType.to_list()
-        else:
-            prop_names = []
-        objects = [
-            cls(code=samp.code, 
-            identifier=samp.identifier, 
-            perm_id=samp.permId, 
-            type=sample_type, 
-            registrator=samp.registrator, 
-            space=utils.none_if(samp.space, 'None'), 
-            project=utils.none_if(samp.project, 'None'),
-            collection=utils.none_if(samp.experiment, 'None'),
-            parent_id = list(utils.split_path(samp.identifier))[:-1],
-            properties=utils.prop_dict(samp, prop_names)) for samp in samples.df.itertuples()
-            ]
-        return objects
+        if prop_names is None:
+            prop_assigned = ob.get_object_type(sample_type).get_property_assignments()
+            if not prop_assigned.df.empty:
+                prop_names = prop_assigned.df.propertyType.to_list()
+            else:
+                prop_names = []
+        return list(cls.iter_from_frame(samples.df, sample_type, prop_names))
+
+    @classmethod
+    def iter_from_frame(cls, df: pd.DataFrame, sample_type: str, prop_names: List[str], chunk_size: int = 10000) -> Generator['OpenbisSample', None, None]:
+        """
+        Lazily converts a dataframe of samples (as returned by `get_samples`) to objects.
+        The attributes and the non-null properties are extracted column-wise,
+        `chunk_size` rows at the time. The rows come from openBIS,
+        so the objects are built without validation
+        """
+        prop_cols = [c for c in df.columns if c in prop_names]
+        for start in range(0, len(df), chunk_size):
+            chunk = df.iloc[start:start + chunk_size]
+            attrs = {name: chunk[col].astype(object).where(chunk[col].notna() & (chunk[col] != 'None'), None).to_list()
+                for name, col in [('space', 'space'), ('project', 'project'), ('collection', 'experiment')]}
+            values = chunk[prop_cols].to_numpy(dtype=object)
+            present = chunk[prop_cols].notna().to_numpy()
+            columns = np.array(prop_cols, dtype=object)
+            props = [dict(zip(columns[mask], row[mask])) for row, mask in zip(values, present)]
+            parents = [['/', *parts[:-1]] for parts in chunk['identifier'].str.strip('/').str.split('/')]
+            for i, (code, identifier, perm_id, registrator) in enumerate(zip(chunk['code'].to_list(), chunk['identifier'].to_list(), chunk['permId'].to_list(), chunk['registrator'].to_list())):
+                yield cls.construct(code=code,
+                    identifier=identifier,
+                    perm_id=perm_id,
+                    type=sample_type,
+                    registrator=registrator,
+                    space=attrs['space'][i],
+                    project=attrs['project'][i],
+                    collection=attrs['collection'][i],
+                    parent_id=parents[i],
+                    properties=props[i])
 
     def get_ob_object(self, ob: pybis.Openbis) -> Sample:
         return ob.get_object(self.path(), props='*')
@@ -605,6 +668,13 @@ class OpenbisInstance(OpenbisTreeObject, OpenbisGenericObject):
             for sp in self.roles:
                 sp.create(ob)
     
+    def create_batched(self, ob: pybis.Openbis, batch_size: int = 1000) -> List['LevelReport']:
+        """
+        Creates the instance with batched v3 calls, see :obj:`BatchCreator`.
+        Returns the timing report of every dependency level
+        """
+        return BatchCreator(ob, batch_size).create(self)
+
     def wipe(self, ob: pybis.Openbis):
         for sp in self.samples:
             sp.wipe(ob)
@@ -623,41 +693,80 @@ class OpenbisInstance(OpenbisTreeObject, OpenbisGenericObject):
 
     def export(self, path: pl.Path):
         """
-        Export this object to a JSON file
+        Export this object to a JSON file. If the file has the
+        suffix `.ndjson` or `.jsonl`, the instance is written incrementally
+        with one entity per line (see :obj:`write_records`)
         """
+        if pl.Path(path).suffix in NDJSON_SUFFIXES:
+            write_records(iter_records(self), path)
+            return
         txt = self.json(indent=2, by_alias=True, exclude_unset=True)
         with open(path, 'w') as of:
             of.write(txt)
         
     @classmethod
-    def reflect(cls, ob: pybis.Openbis) -> 'OpenbisInstance':
+    def reflect(cls, ob: pybis.Openbis, workers: int = 8) -> 'OpenbisInstance':
         """
         Given an openbis connection, try
-        to reflect it as a object of type OpenbisInstance
+        to reflect it as a object of type OpenbisInstance.
+        Every kind of entity is listed with a single call and the tree is assembled locally,
+        the calls are made concurrently on a pool of `workers` threads
         """
-        #Get all property types
-        property_types = [OpenbisProperty(code=p.code, label=p.label, data_type=p.dataType, description=p.description) for p in get_non_system_entities(ob, "property_types")]
-        #Get all Object types
-        object_types = [OpenbisObjectType(code=ot.code, prefix=ot.generatedCodePrefix).reflect(ob) for ot in get_non_system_entities(ob, "object_types")]
-
-        #Get all collection types
-        collection_types = [OpenbisCollectionType(code=p.code, description=p.description) for p in get_non_system_entities(ob, "collection_types")]
-        #Get all the tree
-        spaces = [OpenbisSpace.from_openbis(ob, code=sp.code)  for sp in ob.get_spaces().df.itertuples() if sp.code not in SACRED_SPACES]
-        #Get all samples
-        samples  = [*(OpenbisSample.get_all_objects(ob, st.code) for st in object_types)]
-        #Reflect users
-        users = [OpenbisUser(userid=ui.permId, first_name=ui.firstName, last_name=ui.lastName) for ui in ob.get_users().df.itertuples()]
-        #Reflect role assignments
-        roles = [OpenbisRoleAssignment(techid=ui.techId, role=ui.role, level=ui.roleLevel, user=ui.user, space=ui.space).reflect(ob) for ui in ob.get_role_assignments().df.itertuples()]
-        #Create Instance
-        inst = OpenbisInstance(spaces = spaces, object_types = object_types, collection_types = collection_types, properties = property_types, users=users, roles=roles)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            listed = {kind: pool.submit(getter) for kind, getter in {
+                'property_types': ob.get_property_types,
+                'object_types': ob.get_object_types,
+                'collection_types': ob.get_collection_types,
+                'spaces': ob.get_spaces,
+                'projects': ob.get_projects,
+                'collections': lambda: ob.get_collections(props='*', attrs=['code', 'project']),
+                'users': ob.get_users,
+                'roles': ob.get_role_assignments}.items()}
+            listed = {kind: future.result() for kind, future in listed.items()}
+            #Get all property types
+            props_df = listed['property_types'].df
+            property_types = [OpenbisProperty(code=p.code, label=p.label, data_type=p.dataType, description=p.description) for p in props_df[props_df.registrator != 'system'].itertuples()]
+            #Get all object types with their property assignments
+            object_types = [OpenbisObjectType(code=ot['code'], perm_id=ot['code'], prefix=ot.get('generatedCodePrefix'), autogenerate_code=ot.get('autoGeneratedCode', True), properties=assigned_properties(ot))
+                for ot in v3_objects(listed['object_types']) if ot['code'] not in SACRED_OBJECT_TYPES]
+            #Get all collection types
+            collection_types = [OpenbisCollectionType(code=ct['code'], description=ct.get('description') or '', properties=list(itertools.chain(*assigned_properties(ct).values())))
+                for ct in v3_objects(listed['collection_types']) if ct['code'] not in SACRED_COLLECTION_TYPES]
+            #Get all samples, one search per object type
+            prop_names = {ot.code: list(itertools.chain(*ot.properties.values())) for ot in object_types}
+            samples = pool.map(lambda st: OpenbisSample.get_all_objects(ob, st, prop_names[st]), prop_names)
+            #Assemble the tree
+            coll_props = {ct.code: ct.properties for ct in collection_types}
+            collections = {}
+            for coll in listed['collections'].df.itertuples():
+                collections.setdefault(coll.project, []).append(OpenbisCollection(
+                    code=coll.code, identifier=coll.identifier, perm_id=coll.permId, type=coll.type, registrator=coll.registrator,
+                    samples=[], properties=utils.prop_dict(coll, coll_props.get(coll.type, []))))
+            projects = {}
+            for pr in v3_objects(listed['projects']):
+                identifier = pr['identifier']['identifier']
+                space = utils.split_identifier(identifier)[0]
+                projects.setdefault(space, []).append(OpenbisProject(
+                    code=pr['code'], perm_id=pr['permId']['permId'], identifier=identifier, space=space, description=pr.get('description'),
+                    registrator=(pr.get('registrator') or {}).get('userId'), collections=collections.get(identifier, []),
+                    properties={'leader': (pr.get('leader') or {}).get('userId'), 'description': pr.get('description')}))
+            spaces_df = listed['spaces'].df
+            spaces = [OpenbisSpace(code=sp.code, perm_id=sp.code, identifier=sp.code, registrator=sp.registrator, projects=projects.get(sp.code))
+                for sp in spaces_df.itertuples() if sp.code not in SACRED_SPACES]
+            #Reflect users
+            users = [OpenbisUser(userid=ui.permId, first_name=ui.firstName, last_name=ui.lastName) for ui in listed['users'].df.itertuples()]
+            #Reflect role assignments
+            roles = [OpenbisRoleAssignment(code=int(ui.techId), techid=int(ui.techId), role=ui.role, level=ui.roleLevel, user=ui.user, space=utils.none_if(ui.space, ''), project=utils.none_if(ui.project, ''))
+                for ui in listed['roles'].df.itertuples()]
+            #Create Instance
+            inst = OpenbisInstance(spaces = spaces, object_types = object_types, collection_types = collection_types, properties = property_types, users=users, roles=roles)
+            samples = list(samples)
 
         for samp in itertools.chain(*samples):
             key = utils.first_valid([samp.collection, samp.project, samp.space, '/'])
             sp = inst.find(key)
             if sp and key != '':
-                sp.children.append(samp)
+                sp.add_child(samp)
             elif  key == '':
                 inst.samples.append(samp)
             else:
@@ -680,6 +789,24 @@ class OpenbisInstance(OpenbisTreeObject, OpenbisGenericObject):
 
 
 
+def v3_objects(things: Things) -> List[Dict[str, Any]]:
+    """
+    Returns the v3 objects behind the result of a pybis list call,
+    with the JSON references resolved
+    """
+    parse_jackson(things.response)
+    return things.response['objects']
+
+def assigned_properties(entity_type: Dict[str, Any]) -> Dict[str, List[str]]:
+    """
+    Returns the codes of the properties assigned to a v3 entity type, by section
+    """
+    by_section = {}
+    for pa in sorted(entity_type.get('propertyAssignments') or [], key=lambda pa: pa['ordinal']):
+        by_section.setdefault(pa.get('section') or '', []).append(pa['propertyType']['code'])
+    return by_section
+
+
 def get_non_system_entities(ob: pybis.Openbis, type:str) -> List[SampleType | ExperimentType | PropertyType]:
     def df_selector(entities: Things, attribute: str, filter_registrator: bool, exclude_codes: List[str] | None = None) -> List[str]:
         if filter_registrator:
@@ -729,4 +856,378 @@ def get_non_system_entities(ob: pybis.Openbis, type:str) -> List[SampleType | Ex
     non_system_entities =  filter_fun(entities, attribute, filter_registrator, exclude_codes)
     return [constructor(e) for e in non_system_entities]
 
-        
\ No newline at end of file
+        
+
+def _entity_type_id(code: str, kind: str) -> Dict[str, str]:
+    return {"@type": "as.dto.entitytype.id.EntityTypePermId", "permId": code, "entityKind": kind}
+
+def _property_assignments(props: Dict[str, List[str | OpenbisProperty]] | List[str | OpenbisProperty] | None) -> List[Dict[str, Any]]:
+    """
+    Returns the v3 property assignment creations for a list of properties
+    or a dictionary of properties by section
+    """
+    match props:
+        case dict():
+            by_section = props.items()
+        case list():
+            by_section = [(None, props)]
+        case _:
+            by_section = []
+    assignments = []
+    for section, section_props in by_section:
+        for prop in section_props:
+            code = prop.code if isinstance(prop, OpenbisProperty) else prop
+            assignments.append({
+                "@type": "as.dto.property.create.PropertyAssignmentCreation",
+                "section": section or None,
+                "ordinal": len(assignments) + 1,
+                "propertyTypeId": {"@type": "as.dto.property.id.PropertyTypePermId", "permId": code.upper()}
+            })
+    return assignments
+
+
+class InstanceRecord(NamedTuple):
+    """
+    One entity of an instance configuration, without its children
+    :param kind: the kind of entity, a key of `RECORD_KINDS`
+    :param parent: the identifier of the space, project or collection containing the entity
+    :param entity: the entity
+    """
+    kind: str
+    parent: str | None
+    entity: OpenbisGenericObject
+
+
+RECORD_KINDS: Dict[str, Type[OpenbisGenericObject]] = {
+    'property': OpenbisProperty,
+    'object_type': OpenbisObjectType,
+    'collection_type': OpenbisCollectionType,
+    'dataset_type': OpenbisDatasetType,
+    'space': OpenbisSpace,
+    'project': OpenbisProject,
+    'collection': OpenbisCollection,
+    'sample': OpenbisSample,
+    'user': OpenbisUser,
+    'role': OpenbisRoleAssignment,
+}
+
+#Fields holding the children, which are written as separate records
+CHILDREN_FIELDS = {'children', 'samples', 'parent_id'}
+
+
+def iter_records(inst: OpenbisInstance) -> Generator[InstanceRecord, None, None]:
+    """
+    Flattens an instance into records in dependency order:
+    every entity comes after the entities it depends on
+    """
+    for prop in inst.properties or []:
+        yield InstanceRecord('property', None, prop)
+    for et in itertools.chain(inst.object_types or [], inst.collection_types or []):
+        props = itertools.chain(*et.properties.values()) if isinstance(et.properties, dict) else et.properties or []
+        for prop in props:
+            if isinstance(prop, OpenbisProperty):
+                yield InstanceRecord('property', None, prop)
+    for ot in inst.object_types or []:
+        yield InstanceRecord('object_type', None, ot)
+    for ct in inst.collection_types or []:
+        yield InstanceRecord('collection_type', None, ct)
+    for dt in inst.dataset_types or []:
+        yield InstanceRecord('dataset_type', None, dt)
+    spaces = inst.children or []
+    for space in spaces:
+        yield InstanceRecord('space', None, space)
+    projects = [(f"/{space.code}", project) for space in spaces for project in space.children or []]
+    for space_id, project in projects:
+        yield InstanceRecord('project', space_id, project)
+    collections = [(f"{space_id}/{project.code}", coll) for space_id, project in projects for coll in project.children or []]
+    for project_id, coll in collections:
+        yield InstanceRecord('collection', project_id, coll)
+    for samp in inst.samples or []:
+        yield InstanceRecord('sample', f"/{samp.space}" if samp.space else None, samp)
+    for space in spaces:
+        for samp in space.samples or []:
+            yield InstanceRecord('sample', f"/{space.code}", samp)
+    for space_id, project in projects:
+        for samp in project.samples or []:
+            yield InstanceRecord('sample', f"{space_id}/{project.code}", samp)
+    for project_id, coll in collections:
+        #Reflected instances attach the samples as children of the collection
+        for samp in itertools.chain(coll.samples or [], coll.children or []):
+            if isinstance(samp, OpenbisSample):
+                yield InstanceRecord('sample', f"{project_id}/{coll.code}", samp)
+    for user in inst.users or []:
+        yield InstanceRecord('user', None, user)
+    for role in inst.roles or []:
+        yield InstanceRecord('role', None, role)
+
+
+def write_records(records: Iterable[InstanceRecord], path: pl.Path) -> int:
+    """
+    Writes records to an NDJSON file, one record per line.
+    Returns the number of records written
+    """
+    written = 0
+    with open(path, 'w') as of:
+        for record in records:
+            entity = record.entity.dict(by_alias=True, exclude_unset=True, exclude=CHILDREN_FIELDS)
+            of.write(json.dumps({'kind': record.kind, 'parent': record.parent, 'entity': entity}, default=str))
+            of.write('\n')
+            written += 1
+    return written
+
+
+def read_records(path: pl.Path) -> Generator[InstanceRecord, None, None]:
+    """
+    Reads the records of an NDJSON file one line at the time,
+    validating every record on its own
+    """
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                raw = json.loads(line)
+                cls = RECORD_KINDS[raw['kind']]
+                yield InstanceRecord(raw['kind'], raw.get('parent'), cls.parse_obj(raw['entity']))
+            except (ValueError, KeyError) as e:
+                raise ValueError(f"Invalid record on line {number} of {path}: {e}") from e
+
+
+@dataclass
+class Creation:
+    """
+    A single entity to create with a v3 API `method`
+    :param key: the code or identifier used to check if the entity exists
+    :param method: the v3 API method (e.g. createSamples)
+    :param creation: the v3 creation object
+    """
+    key: str | None
+    method: str
+    creation: Dict[str, Any]
+
+
+@dataclass
+class LevelReport:
+    """
+    Timing report of the creation of one dependency level,
+    with the failed creations and their error messages
+    """
+    level: str
+    created: int = 0
+    skipped: int = 0
+    failed: int = 0
+    requests: int = 0
+    seconds: float = 0.0
+    errors: List[Tuple[Creation, str]] = field(default_factory=list)
+
+
+class BatchCreator:
+    """
+    Creates the entities of an :obj:`OpenbisInstance` using batched
+    v3 API calls instead of saving every entity on its own.
+    The entities are grouped by dependency level (property types, entity types,
+    spaces, projects, collections, samples, role assignments) and every level
+    is sent in requests of at most `batch_size` creations per method.
+    Entities that already exist are skipped. If a batch fails, it is split
+    in halves until the failing entities are isolated.
+    """
+    LEVELS = ['property_types', 'entity_types', 'spaces', 'projects', 'collections', 'samples', 'roles']
+    KIND_LEVELS = {
+        'property': 'property_types',
+        'object_type': 'entity_types',
+        'collection_type': 'entity_types',
+        'dataset_type': 'entity_types',
+        'space': 'spaces',
+        'project': 'projects',
+        'collection': 'collections',
+        'sample': 'samples',
+        'role': 'roles',
+    }
+
+    def __init__(self, ob: pybis.Openbis, batch_size: int = 1000) -> None:
+        self.ob = ob
+        self.batch_size = batch_size
+        self.errors: List[Tuple[Creation, str]] = []
+
+    def creation(self, record: InstanceRecord) -> Creation | None:
+        """
+        Returns the v3 creation of a record, or None if the record is not created in batches
+        """
+        match record:
+            case InstanceRecord('property', _, OpenbisProperty() as prop):
+                return Creation(prop.code.upper(), "createPropertyTypes", {
+                    "@type": "as.dto.property.create.PropertyTypeCreation",
+                    "code": prop.code, "label": prop.label, "description": prop.description, "dataType": prop.data_type, "managedInternally": False})
+            case InstanceRecord('object_type', _, OpenbisObjectType() as ot):
+                return Creation(ot.code.upper(), "createSampleTypes", {
+                    "@type": "as.dto.sample.create.SampleTypeCreation",
+                    "code": ot.code, "generatedCodePrefix": ot.prefix, "autoGeneratedCode": ot.autogenerate_code,
+                    "propertyAssignments": _property_assignments(ot.properties)})
+            case InstanceRecord('collection_type', _, OpenbisCollectionType() as ct):
+                return Creation(ct.code.upper(), "createExperimentTypes", {
+                    "@type": "as.dto.experiment.create.ExperimentTypeCreation",
+                    "code": ct.code, "description": ct.description,
+                    "propertyAssignments": _property_assignments(ct.properties)})
+            case InstanceRecord('dataset_type', _, OpenbisDatasetType() as dt):
+                return Creation(dt.code.upper(), "createDataSetTypes", {
+                    "@type": "as.dto.dataset.create.DataSetTypeCreation",
+                    "code": dt.code, "description": dt.description, "mainDataSetPattern": dt.pattern, "mainDataSetPath": dt.path,
+                    "propertyAssignments": _property_assignments(dt.properties)})
+            case InstanceRecord('space', _, OpenbisSpace() as space):
+                return Creation(space.code.upper(), "createSpaces", {"@type": "as.dto.space.create.SpaceCreation", "code": space.code})
+            case InstanceRecord('project', str(space_id), OpenbisProject() as project):
+                return Creation(f"{space_id}/{project.code}".upper(), "createProjects", {
+                    "@type": "as.dto.project.create.ProjectCreation",
+                    "code": project.code, "description": project.description,
+                    "spaceId": {"@type": "as.dto.space.id.SpacePermId", "permId": space_id.strip('/')}})
+            case InstanceRecord('collection', str(project_id), OpenbisCollection() as coll):
+                return Creation(f"{project_id}/{coll.code}".upper(), "createExperiments", {
+                    "@type": "as.dto.experiment.create.ExperimentCreation",
+                    "code": coll.code, "typeId": _entity_type_id(coll.type, "EXPERIMENT"),
+                    "projectId": {"@type": "as.dto.project.id.ProjectIdentifier", "identifier": project_id},
+                    "properties": coll.properties or {}})
+            case InstanceRecord('sample', parent, OpenbisSample() as samp):
+                return self._sample_creation(samp, utils.split_identifier(parent) if parent else [])
+            case InstanceRecord('role', _, OpenbisRoleAssignment() as role):
+                creation = {
+                    "@type": "as.dto.roleassignment.create.RoleAssignmentCreation",
+                    "role": role.role}
+                if role.group:
+                    creation["authorizationGroupId"] = {"@type": "as.dto.authorizationgroup.id.AuthorizationGroupPermId", "permId": role.group}
+                else:
+                    creation["userId"] = {"@type": "as.dto.person.id.PersonPermId", "permId": role.user}
+                if role.level == "SPACE":
+                    creation["spaceId"] = {"@type": "as.dto.space.id.SpacePermId", "permId": role.space}
+                elif role.level == "PROJECT":
+                    creation["projectId"] = {"@type": "as.dto.project.id.ProjectIdentifier", "identifier": f"/{role.space}/{role.project}"}
+                return Creation(f"{role.group or role.user}:{role.role}:{role.space or ''}:{role.project or ''}".upper(), "createRoleAssignments", creation)
+        return None
+
+    @staticmethod
+    def _sample_creation(samp: OpenbisSample, parent: List[str]) -> Creation:
+        creation = {
+            "@type": "as.dto.sample.create.SampleCreation",
+            "code": samp.code,
+            "autoGeneratedCode": samp.code is None,
+            "typeId": _entity_type_id(samp.type, "SAMPLE"),
+            "properties": samp.properties or {}}
+        space = parent[0] if parent else None
+        if space:
+            creation["spaceId"] = {"@type": "as.dto.space.id.SpacePermId", "permId": space}
+        if len(parent) > 1:
+            creation["projectId"] = {"@type": "as.dto.project.id.ProjectIdentifier", "identifier": f"/{parent[0]}/{parent[1]}"}
+        if len(parent) > 2:
+            creation["experimentId"] = {"@type": "as.dto.experiment.id.ExperimentIdentifier", "identifier": "/" + "/".join(parent[:3])}
+        key = "/".join(["", *([space] if space else []), samp.code]).upper() if samp.code else None
+        return Creation(key, "createSamples", creation)
+
+    def existing(self, level: str) -> Set[str]:
+        """
+        Returns the keys of the entities of `level` which already exist,
+        using one list call per entity kind
+        """
+        def codes(things: Things, column: str = 'code') -> Set[str]:
+            return set() if things.df.empty else {str(c).upper() for c in things.df[column]}
+        match level:
+            case 'property_types':
+                return codes(self.ob.get_property_types())
+            case 'entity_types':
+                return codes(self.ob.get_object_types()) | codes(self.ob.get_collection_types()) | codes(self.ob.get_dataset_types())
+            case 'spaces':
+                return codes(self.ob.get_spaces())
+            case 'projects':
+                return codes(self.ob.get_projects(), 'identifier')
+            case 'collections':
+                return codes(self.ob.get_collections(), 'identifier')
+            case 'samples':
+                samples = self.ob.get_samples(attrs=['code', 'space'])
+                return set() if samples.df.empty else {"/".join(["", *([r.space] if r.space else []), r.code]).upper() for r in samples.df.fillna('').itertuples()}
+            case 'roles':
+                roles = self.ob.get_role_assignments()
+                return set() if roles.df.empty else {f"{r.group or r.user}:{r.role}:{r.space or ''}:{r.project or ''}".upper() for r in roles.df.fillna('').itertuples()}
+        return set()
+
+    def submit(self, method: str, batch: List[Creation], report: LevelReport) -> None:
+        """
+        Sends one request creating `batch`, splitting it if the request fails
+        """
+        request = {"method": method, "params": [self.ob.token, [c.creation for c in batch]]}
+        report.requests += 1
+        try:
+            self.ob._post_request(self.ob.as_v3, request)
+            report.created += len(batch)
+        except ValueError as e:
+            if len(batch) == 1:
+                report.failed += 1
+                report.errors.append((batch[0], str(e)))
+                self.errors.append((batch[0], str(e)))
+            else:
+                half = len(batch) // 2
+                self.submit(method, batch[:half], report)
+                self.submit(method, batch[half:], report)
+
+    def create(self, inst: OpenbisInstance) -> List[LevelReport]:
+        """
+        Creates all entities of `inst`, level by level, and returns a report per level
+        """
+        return self.create_records(iter_records(inst))
+
+    def create_records(self, records: Iterable[InstanceRecord]) -> List[LevelReport]:
+        """
+        Creates the entities of a stream of records in dependency order
+        (see :obj:`iter_records` and :obj:`read_records`).
+        A batch is sent as soon as it is full, so at most `batch_size` creations
+        per method are kept in memory. All batches of a level are sent before
+        the first entity of the next level.
+        """
+        reports = {level: LevelReport(level) for level in self.LEVELS}
+        existing: Dict[str, Set[str]] = {}
+        pending: Dict[str, List[Creation]] = {}
+        current = None
+
+        def flush(method: str) -> None:
+            if batch := pending.pop(method, None):
+                start = time.perf_counter()
+                self.submit(method, batch, reports[current])
+                reports[current].seconds += time.perf_counter() - start
+
+        for record in records:
+            level = self.KIND_LEVELS.get(record.kind)
+            creation = self.creation(record) if level else None
+            if creation is None:
+                continue
+            if level != current:
+                for method in list(pending):
+                    flush(method)
+                current = level
+                if level not in existing:
+                    start = time.perf_counter()
+                    existing[level] = self.existing(level)
+                    reports[level].seconds += time.perf_counter() - start
+            if creation.key is not None and creation.key in existing[level]:
+                reports[level].skipped += 1
+                continue
+            if creation.key is not None:
+                existing[level].add(creation.key)
+            batch = pending.setdefault(creation.method, [])
+            batch.append(creation)
+            if len(batch) >= self.batch_size:
+                flush(creation.method)
+        for method in list(pending):
+            flush(method)
+        return list(reports.values())
+
+
+def format_report(reports: List[LevelReport]) -> str:
+    """
+    Formats the creation reports as a table
+    """
+    lines = [f"{'level':<16}{'created':>9}{'skipped':>9}{'failed':>8}{'requests':>10}{'seconds':>10}"]
+    for r in reports:
+        lines.append(f"{r.level:<16}{r.created:>9}{r.skipped:>9}{r.failed:>8}{r.requests:>10}{r.seconds:>10.2f}")
+    lines.append(f"{'total':<16}{sum(r.created for r in reports):>9}{sum(r.skipped for r in reports):>9}{sum(r.failed for r in reports):>8}{sum(r.requests for r in reports):>10}{sum(r.seconds for r in reports):>10.2f}")
+    errors = [(r.level, creation, message) for r in reports for creation, message in r.errors]
+    if errors:
+        lines.append(f"{len(errors)} failed:")
+        lines.extend(f"  {level} {creation.key or creation.method}: {message}" for level, creation, message in errors)
+    return "\n".join(lines)
@@ -0,0 +1,304 @@
+"""
+Synchronisation of an openBIS instance with a configuration.
+The live instance and the configuration are flattened into records
+(see :obj:`models.iter_records`), matched by code or identifier and compared.
+Samples configured without code are matched by parent, type and properties
+(see :obj:`match_uncoded`), as openBIS generates their code.
+Only the entities which are missing, changed or (optionally) not configured
+are created, updated or deleted.
+"""
+import itertools
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Literal, Tuple
+
+import pybis
+
+from . import utils
+from .models import (SACRED_USERS, BatchCreator, Creation, InstanceRecord, LevelReport, OpenbisProperty, _entity_type_id, _property_assignments)
+
+#Kinds in dependency order, deletions are applied in the reverse order
+KIND_ORDER = ['property', 'object_type', 'collection_type', 'dataset_type', 'space', 'project', 'collection', 'sample', 'role']
+
+ENTITY_KINDS = {'object_type': 'SAMPLE', 'collection_type': 'EXPERIMENT', 'dataset_type': 'DATA_SET'}
+
+
+@dataclass
+class SyncOperation:
+    """
+    One change needed to bring the instance in line with the configuration
+    :param action: create, update or delete
+    :param record: the configured record (create, update) or the live record (delete)
+    :param key: the code or identifier of the entity
+    :param changes: the changed fields with their live and configured values
+    :param live: the live record of an updated entity
+    """
+    action: Literal['create', 'update', 'delete']
+    record: InstanceRecord
+    key: str
+    changes: Dict[str, Tuple[Any, Any]] = field(default_factory=dict)
+    live: InstanceRecord | None = None
+
+
+def record_key(record: InstanceRecord) -> str | None:
+    """
+    Returns the key identifying a record across instances,
+    or None if the record cannot be matched
+    """
+    match record:
+        case InstanceRecord('user', _, _):
+            return None
+        case InstanceRecord('project' | 'collection', str(parent), entity):
+            return f"{parent}/{entity.code}".upper()
+        case InstanceRecord('sample', parent, entity):
+            if not entity.code:
+                return None
+            space = utils.split_identifier(parent)[:1] if parent else []
+            return "/".join(["", *space, entity.code]).upper()
+        case InstanceRecord('role', _, role):
+            return f"{role.group or role.user}:{role.role}:{role.space or ''}:{role.project or ''}".upper()
+        case InstanceRecord(_, _, entity):
+            return entity.code.upper()
+
+
+def _properties(props: Dict[str, Any] | None) -> Dict[str, str]:
+    return {k.upper(): str(v) for k, v in (props or {}).items() if v is not None}
+
+
+def _uncoded_group(record: InstanceRecord) -> Tuple[str, str]:
+    return ((record.parent or '').upper(), record.entity.type.upper())
+
+
+def match_uncoded(live: Iterable[InstanceRecord], desired: Iterable[InstanceRecord]) -> Dict[int, Tuple[str, InstanceRecord]]:
+    """
+    Matches the `desired` samples without code to live samples with the same parent and type
+    having all their configured properties, each live sample being matched at most once.
+    Live samples configured with their code are never matched.
+    Returns the key and the live record of the matched samples by index in `desired`
+    """
+    configured = {record_key(r) for r in desired if r.kind == 'sample'}
+    candidates: Dict[Tuple[str, str], List[Tuple[str, InstanceRecord]]] = {}
+    for record in live:
+        if record.kind == 'sample' and (key := record_key(record)) is not None and key not in configured:
+            candidates.setdefault(_uncoded_group(record), []).append((key, record))
+    matches = {}
+    for index, record in enumerate(desired):
+        if record.kind != 'sample' or record_key(record) is not None:
+            continue
+        wanted = _properties(record.entity.properties).items()
+        group = candidates.get(_uncoded_group(record), [])
+        for position, (key, current) in enumerate(group):
+            if wanted <= _properties(current.entity.properties).items():
+                matches[index] = group.pop(position)
+                break
+    return matches
+
+
+def _assigned(props: Dict[str, List[str | OpenbisProperty]] | List[str | OpenbisProperty] | None) -> List[str]:
+    props = itertools.chain(*props.values()) if isinstance(props, dict) else props or []
+    return [(p.code if isinstance(p, OpenbisProperty) else p).upper() for p in props]
+
+
+def compare(live: InstanceRecord, desired: InstanceRecord) -> Dict[str, Tuple[Any, Any]]:
+    """
+    Returns the configured fields which differ from the live entity.
+    Only the fields which can be updated in place are compared
+    """
+    changes = {}
+    match desired.kind:
+        case 'property':
+            for name in ['label', 'description']:
+                if getattr(live.entity, name) != getattr(desired.entity, name):
+                    changes[name] = (getattr(live.entity, name), getattr(desired.entity, name))
+        case 'project':
+            if 'description' in desired.entity.__fields_set__ and live.entity.description != desired.entity.description:
+                changes['description'] = (live.entity.description, desired.entity.description)
+        case 'collection' | 'sample':
+            live_props = _properties(live.entity.properties)
+            for name, value in _properties(desired.entity.properties).items():
+                if live_props.get(name) != value:
+                    changes[name] = (live_props.get(name), value)
+        case 'object_type' | 'collection_type' | 'dataset_type':
+            missing = [p for p in _assigned(desired.entity.properties) if p not in _assigned(live.entity.properties)]
+            if missing:
+                changes['properties'] = (None, missing)
+    return changes
+
+
+def protected(record: InstanceRecord, keep_users: Iterable[str] = ()) -> bool:
+    """
+    Returns True if the live `record` must never be deleted by a sync:
+    the role assignments of the system users and of the users in `keep_users`
+    """
+    match record:
+        case InstanceRecord('role', _, role):
+            return role.user is not None and role.user.lower() in {u.lower() for u in [*SACRED_USERS, *keep_users]}
+    return False
+
+
+def diff(live: Iterable[InstanceRecord], desired: Iterable[InstanceRecord], prune: bool = False, keep_users: Iterable[str] = ()) -> List[SyncOperation]:
+    """
+    Computes the operations turning the `live` records into the `desired` ones.
+    Live entities which are not configured are only deleted if `prune` is set,
+    except the ones which are :obj:`protected`
+    """
+    keep_users = list(keep_users)
+    live, desired = list(live), list(desired)
+    live_by_key = {(r.kind, key): r for r in live if (key := record_key(r)) is not None}
+    uncoded = match_uncoded(live, desired)
+    operations = []
+    seen = set()
+    for index, record in enumerate(desired):
+        key = record_key(record)
+        if key is None:
+            if record.kind != 'sample':
+                continue
+            if index not in uncoded:
+                operations.append(SyncOperation('create', record, f"{record.parent or ''}/<new {record.entity.type}>"))
+                continue
+            key, _ = uncoded[index]
+        if (record.kind, key) in seen:
+            continue
+        seen.add((record.kind, key))
+        match live_by_key.get((record.kind, key)):
+            case None:
+                operations.append(SyncOperation('create', record, key))
+            case InstanceRecord() as current:
+                if changes := compare(current, record):
+                    operations.append(SyncOperation('update', record, key, changes, current))
+    if prune:
+        for (kind, key), record in live_by_key.items():
+            if (kind, key) not in seen and not protected(record, keep_users):
+                operations.append(SyncOperation('delete', record, key))
+    return sorted(operations, key=lambda op: KIND_ORDER.index(op.record.kind))
+
+
+def format_plan(operations: List[SyncOperation]) -> str:
+    """
+    Formats the operations as a plan, one line per operation
+    """
+    symbols = {'create': '+', 'update': '~', 'delete': '-'}
+    lines = []
+    for op in operations:
+        lines.append(f"{symbols[op.action]} {op.record.kind} {op.key}")
+        for name, (old, new) in op.changes.items():
+            lines.append(f"    {name}: {old!r} -> {new!r}")
+    counts = {action: sum(op.action == action for op in operations) for action in symbols}
+    lines.append(f"Plan: {counts['create']} to create, {counts['update']} to update, {counts['delete']} to delete")
+    return "\n".join(lines)
+
+
+def _field_update(value: Any) -> Dict[str, Any]:
+    return {"@type": "as.dto.common.update.FieldUpdateValue", "isModified": True, "value": value}
+
+
+def update_request(op: SyncOperation) -> Creation:
+    """
+    Returns the v3 update of an update operation
+    """
+    new = {name: value for name, (_, value) in op.changes.items()}
+    match op.record.kind:
+        case 'property':
+            return Creation(op.key, "updatePropertyTypes", {
+                "@type": "as.dto.property.update.PropertyTypeUpdate",
+                "typeId": {"@type": "as.dto.property.id.PropertyTypePermId", "permId": op.key},
+                **{name: _field_update(value) for name, value in new.items()}})
+        case 'project':
+            return Creation(op.key, "updateProjects", {
+                "@type": "as.dto.project.update.ProjectUpdate",
+                "projectId": {"@type": "as.dto.project.id.ProjectIdentifier", "identifier": op.key},
+                "description": _field_update(new['description'])})
+        case 'collection':
+            return Creation(op.key, "updateExperiments", {
+                "@type": "as.dto.experiment.update.ExperimentUpdate",
+                "experimentId": {"@type": "as.dto.experiment.id.ExperimentIdentifier", "identifier": op.live.entity.identifier or op.key},
+                "properties": new})
+        case 'sample':
+            return Creation(op.key, "updateSamples", {
+                "@type": "as.dto.sample.update.SampleUpdate",
+                "sampleId": {"@type": "as.dto.sample.id.SampleIdentifier", "identifier": op.live.entity.identifier or op.key},
+                "properties": new})
+        case 'object_type' | 'collection_type' | 'dataset_type' as kind:
+            entity = {'object_type': 'sample', 'collection_type': 'experiment', 'dataset_type': 'dataset'}[kind]
+            name = {'object_type': 'Sample', 'collection_type': 'Experiment', 'dataset_type': 'DataSet'}[kind]
+            added = set(new['properties'])
+            assignments = [pa for pa in _property_assignments(op.record.entity.properties) if pa['propertyTypeId']['permId'] in added]
+            return Creation(op.key, f"update{name}Types", {
+                "@type": f"as.dto.{entity}.update.{name}TypeUpdate",
+                "typeId": _entity_type_id(op.key, ENTITY_KINDS[kind]),
+                "propertyAssignments": {
+                    "@type": "as.dto.entitytype.update.PropertyAssignmentListUpdateValue",
+                    "actions": [{"@type": "as.dto.common.update.ListUpdateActionAdd", "items": assignments}]}})
+
+
+def delete_request(op: SyncOperation) -> Tuple[str, Dict[str, Any], Dict[str, Any]]:
+    """
+    Returns the v3 method, the entity id and the deletion options of a delete operation
+    """
+    entity = op.record.entity
+    match op.record.kind:
+        case 'property':
+            return "deletePropertyTypes", {"@type": "as.dto.property.id.PropertyTypePermId", "permId": op.key}, {"@type": "as.dto.property.delete.PropertyTypeDeletionOptions"}
+        case 'object_type':
+            return "deleteSampleTypes", _entity_type_id(op.key, 'SAMPLE'), {"@type": "as.dto.sample.delete.SampleTypeDeletionOptions"}
+        case 'collection_type':
+            return "deleteExperimentTypes", _entity_type_id(op.key, 'EXPERIMENT'), {"@type": "as.dto.experiment.delete.ExperimentTypeDeletionOptions"}
+        case 'dataset_type':
+            return "deleteDataSetTypes", _entity_type_id(op.key, 'DATA_SET'), {"@type": "as.dto.dataset.delete.DataSetTypeDeletionOptions"}
+        case 'space':
+            return "deleteSpaces", {"@type": "as.dto.space.id.SpacePermId", "permId": entity.code}, {"@type": "as.dto.space.delete.SpaceDeletionOptions"}
+        case 'project':
+            return "deleteProjects", {"@type": "as.dto.project.id.ProjectIdentifier", "identifier": entity.identifier or op.key}, {"@type": "as.dto.project.delete.ProjectDeletionOptions"}
+        case 'collection':
+            return "deleteExperiments", {"@type": "as.dto.experiment.id.ExperimentIdentifier", "identifier": entity.identifier or op.key}, {"@type": "as.dto.experiment.delete.ExperimentDeletionOptions"}
+        case 'sample':
+            return "deleteSamples", {"@type": "as.dto.sample.id.SampleIdentifier", "identifier": entity.identifier or op.key}, {"@type": "as.dto.sample.delete.SampleDeletionOptions"}
+        case 'role':
+            return "deleteRoleAssignments", {"@type": "as.dto.roleassignment.id.RoleAssignmentTechId", "techId": entity.techid}, {"@type": "as.dto.roleassignment.delete.RoleAssignmentDeletionOptions"}
+
+
+def delete(ob: pybis.Openbis, method: str, batch: List[Tuple[SyncOperation, str, Dict[str, Any], Dict[str, Any]]], report: LevelReport, errors: List[Tuple[Creation, str]]) -> None:
+    """
+    Deletes a batch of entities in one request. If the request fails,
+    the entities are deleted one by one
+    """
+    options = {**batch[0][3], "reason": "Removed by instance sync"}
+    report.requests += 1
+    try:
+        ob._post_request(ob.as_v3, {"method": method, "params": [ob.token, [entity_id for _, _, entity_id, _ in batch], options]})
+        report.created += len(batch)
+    except ValueError as e:
+        if len(batch) == 1:
+            report.failed += 1
+            report.errors.append((Creation(batch[0][0].key, method, batch[0][2]), str(e)))
+            errors.append(report.errors[-1])
+        else:
+            for item in batch:
+                delete(ob, method, [item], report, errors)
+
+
+def apply(ob: pybis.Openbis, operations: List[SyncOperation], batch_size: int = 1000) -> List[LevelReport]:
+    """
+    Applies the operations: creations through a :obj:`BatchCreator`,
+    then the updates and finally the deletions in reverse dependency order.
+    Returns a report per creation level, one for the updates and one for the deletions
+    """
+    creator = BatchCreator(ob, batch_size)
+    reports = creator.create_records(op.record for op in operations if op.action == 'create')
+    updates = LevelReport('updates')
+    start = time.perf_counter()
+    requests = sorted((update_request(op) for op in operations if op.action == 'update'), key=lambda c: c.method)
+    for method, group in itertools.groupby(requests, key=lambda c: c.method):
+        group = list(group)
+        for i in range(0, len(group), batch_size):
+            creator.submit(method, group[i:i + batch_size], updates)
+    updates.seconds = time.perf_counter() - start
+    deletions = LevelReport('deletions')
+    start = time.perf_counter()
+    deletes = [(op, *delete_request(op)) for op in sorted((op for op in operations if op.action == 'delete'), key=lambda op: -KIND_ORDER.index(op.record.kind))]
+    for method, group in itertools.groupby(deletes, key=lambda d: d[1]):
+        group = list(group)
+        for i in range(0, len(group), batch_size):
+            delete(ob, method, group[i:i + batch_size], deletions, creator.errors)
+    deletions.seconds = time.perf_counter() - start
+    return [*reports, updates, deletions]
@@ -2,9 +2,9 @@
 from ast import Str
 from re import S
 import pybis
-from typing import List, Generator, Dict, Optional, Any
+from typing import List, Generator, Dict, Optional, Any, Tuple
 
-from pydantic import BaseModel, fields
+from pydantic import BaseModel, PrivateAttr, fields
 from dataclasses import dataclass
 import enum
 
@@ -28,7 +28,10 @@ class OpenbisHierarcy(enum.Enum):
 
 class TreeElement(BaseModel):
     """
-    A class to (recursively) represent a tree element
+    A class to (recursively) represent a tree element.
+    Every element keeps an index of its children and of all its
+    descendants by identifier, which is updated by :meth:`push` and :meth:`remove`,
+    so that :meth:`get` and :meth:`find` do not need to scan the tree
     """
     identifier: str
     code: str | None = None
@@ -39,32 +42,78 @@ class TreeElement(BaseModel):
     openbis_type: str | None = None
     ancestors: List[str] | None = []
     descendants: List[str] | None = []
+    _children_index: Dict[str, 'TreeElement'] = PrivateAttr(default_factory=dict)
+    _descendants_index: Dict[str, 'TreeElement'] = PrivateAttr(default_factory=dict)
+    _parent: Optional['TreeElement'] = PrivateAttr(None)
+
+    class Config:
+        #Keep the children instances, otherwise their parent links would point to the originals
+        copy_on_model_validation = 'none'
+
+    def __init__(self, **data: Any) -> None:
+        super().__init__(**data)
+        self._reindex()
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        super().__setattr__(name, value)
+        if name == 'children':
+            node = self
+            while node is not None:
+                node._reindex()
+                node = node._parent
+
+    def _reindex(self) -> None:
+        self._children_index = {}
+        self._descendants_index = {}
+        for child in self.children:
+            child._parent = self
+            self._children_index.setdefault(child.identifier, child)
+            self._descendants_index.setdefault(child.identifier, child)
+            for key, el in child._descendants_index.items():
+                self._descendants_index.setdefault(key, el)
+
+    def parent(self) -> Optional['TreeElement']:
+        return self._parent
 
     def children_ids(self) -> List[str]:
         return [el.identifier for el in self.children] 
     
     def get(self, id: str) -> Optional['TreeElement']:
-        if id in self.children_ids():
-            return self.children[self.children_ids().index(id)]
-        else:
-            pass
+        return self._children_index.get(id)
 
     def push(self, el: 'TreeElement'):
-        if el.identifier not in self.children_ids():
+        if el.identifier not in self._children_index:
             self.children.append(el)
-        else:
-            pass
+            self._children_index[el.identifier] = el
+            el._parent = self
+            added = {el.identifier: el, **el._descendants_index}
+            node = self
+            while node is not None:
+                for key, new in added.items():
+                    node._descendants_index.setdefault(key, new)
+                node = node._parent
+
+    def remove(self, id: str) -> Optional['TreeElement']:
+        """
+        Removes the child `id` (with all its descendants) and returns it
+        """
+        el = self._children_index.pop(id, None)
+        if el is None:
+            return None
+        super().__setattr__('children', [c for c in self.children if c is not el])
+        el._parent = None
+        removed = [id, *el._descendants_index]
+        node = self
+        while node is not None:
+            for key in removed:
+                node._descendants_index.pop(key, None)
+            node = node._parent
+        return el
     
     def find(self, id: str) -> Optional['TreeElement']:
-        result = []
-        def inner_search(start: TreeElement, id: Str):
-            if start.identifier == id:
-                return start
-            else:
-                els =  [x for x in [inner_search(child, id) for child in start.children] if x is not None]
-                if len(els) > 0:
-                    return els[0]
-        return inner_search(self, id)
+        if self.identifier == id:
+            return self
+        return self._descendants_index.get(id)
 
 
 class TreeElementObject(TreeElement):
@@ -156,14 +205,109 @@ def build_sample_tree_from_list(ob: pybis.Openbis) -> TreeElement:
     for proj in ob.get_projects():
         base_tree.get(id=proj.space.code).push(TreeElement(identifier=proj.identifier, code=proj.code, permid=proj.permId, type=OpenbisHierarcy.PROJECT))
     #Add collections
-    for coll in ob.get_collections(attrs=['project', 'space', 'code', 'type']).df.itertuples():
-        base_tree.get(coll.space).get(coll.project).push(TreeElement(identifier=coll.identifier, code=coll.code, permid=coll.permId, type=OpenbisHierarcy.COLLECTION, openbis_type=coll.type))
+    for coll in ob.get_collections(attrs=COLLECTION_ATTRS).df.itertuples():
+        base_tree.get(coll.space).get(coll.project).push(collection_element(coll))
     #Add objects
-    for samp in ob.get_objects(attrs=['project', 'space', 'code', 'experiment', 'type', "children", 'parents']).df.itertuples():
+    for samp in ob.get_objects(attrs=OBJECT_ATTRS).df.itertuples():
         proj = base_tree.find(samp.project)
         if proj:
-            proj.push(TreeElementObject(identifier=samp.identifier, code=samp.code, permid=samp.permId, 
-            collection=samp.experiment, type=OpenbisHierarcy.OBJECT, openbis_type=samp.type, ancestors=samp.parents, descendants=samp.children))
+            proj.push(object_element(samp))
     return base_tree
 
 
+
+
+class TreePage(BaseModel):
+    """
+    A page of the children of a tree element
+    :ivar identifier: the identifier of the parent element
+    :ivar items: the children in this page
+    :ivar total: the total number of children
+    :ivar cursor: the offset of the first child in this page
+    :ivar next_cursor: the offset of the next page, None on the last page
+    """
+    identifier: str
+    items: List[TreeElement]
+    total: int
+    cursor: int
+    next_cursor: int | None = None
+
+
+COLLECTION_ATTRS = ['project', 'space', 'code', 'type']
+OBJECT_ATTRS = ['project', 'space', 'code', 'experiment', 'type', "children", 'parents']
+
+
+def space_element(space) -> TreeElement:
+    return TreeElement(identifier=space.code, code=space.code, permid=space.code, type=OpenbisHierarcy.SPACE)
+
+def project_element(proj) -> TreeElement:
+    return TreeElement(identifier=proj.identifier, code=utils.split_identifier(proj.identifier)[-1], permid=proj.permId, type=OpenbisHierarcy.PROJECT)
+
+def collection_element(coll) -> TreeElement:
+    return TreeElement(identifier=coll.identifier, code=coll.code, permid=coll.permId, type=OpenbisHierarcy.COLLECTION, openbis_type=coll.type)
+
+def object_element(samp) -> TreeElementObject:
+    return TreeElementObject(identifier=samp.identifier, code=samp.code, permid=samp.permId, 
+            collection=samp.experiment, type=OpenbisHierarcy.OBJECT, openbis_type=samp.type, ancestors=samp.parents, descendants=samp.children)
+
+
+def _things_page(things, make_element) -> Tuple[List[TreeElement], int]:
+    total = things.totalCount if things.totalCount is not None else len(things.df)
+    return [make_element(row) for row in things.df.itertuples()], total
+
+
+def list_children(ob: pybis.Openbis, identifier: str, type: OpenbisHierarcy, start: int = 0, count: int = 100) -> Tuple[List[TreeElement], int]:
+    """
+    Returns one page of the children of the element `identifier` (of type `type`) 
+    in the same hierarchy as :func:`build_sample_tree_from_list`, together with the 
+    total number of children. Only the requested page is fetched from openBIS.
+    The children of a project are its collections followed by its objects.
+    """
+    match type:
+        case OpenbisHierarcy.INSTANCE:
+            return _things_page(ob.get_spaces(start_with=start, count=count), space_element)
+        case OpenbisHierarcy.SPACE:
+            return _things_page(ob.get_projects(space=identifier, start_with=start, count=count), project_element)
+        case OpenbisHierarcy.PROJECT:
+            items, n_coll = _things_page(ob.get_collections(project=identifier, attrs=COLLECTION_ATTRS, start_with=start, count=count), collection_element)
+            #Fill the rest of the page with objects, but always query them to get their count
+            obj_start = max(start - n_coll, 0)
+            obj_count = max(count - len(items), 1)
+            objects, n_obj = _things_page(ob.get_objects(project=identifier, attrs=OBJECT_ATTRS, start_with=obj_start, count=obj_count), object_element)
+            return items + objects[:count - len(items)], n_coll + n_obj
+        case OpenbisHierarcy.COLLECTION:
+            return _things_page(ob.get_objects(collection=identifier, attrs=OBJECT_ATTRS, start_with=start, count=count), object_element)
+        case OpenbisHierarcy.OBJECT:
+            return _things_page(ob.get_objects(withParents=identifier, attrs=OBJECT_ATTRS, start_with=start, count=count), object_element)
+        case _:
+            raise ValueError(f"Cannot list the children of {identifier} of type {type}")
+
+
+#Largest number of nested `list_children` calls of one :func:`get_children_page`
+MAX_NESTED_FETCHES = 100
+
+
+def nested_fetches(limit: int, depth: int) -> int:
+    """
+    Returns the largest number of nested `list_children` calls
+    made by :func:`get_children_page` with `limit` and `depth`
+    """
+    return sum(limit ** level for level in range(1, depth))
+
+
+def get_children_page(ob: pybis.Openbis, identifier: str, type: OpenbisHierarcy, cursor: int = 0, limit: int = 100, depth: int = 1) -> TreePage:
+    """
+    Returns a :obj:`TreePage` with the children of `identifier`.
+    If `depth` is larger than one, the first `limit` children of every
+    child are included as well, down to `depth` levels.
+    Raises a ValueError if this could take more than `MAX_NESTED_FETCHES` nested requests
+    """
+    if (fetches := nested_fetches(limit, depth)) > MAX_NESTED_FETCHES:
+        raise ValueError(f"A depth of {depth} with a limit of {limit} needs up to {fetches} requests, at most {MAX_NESTED_FETCHES} are allowed")
+    items, total = list_children(ob, identifier, type, cursor, limit)
+    if depth > 1:
+        for item in items:
+            for child in get_children_page(ob, item.identifier, item.type, 0, limit, depth - 1).items:
+                item.push(child)
+    next_cursor = cursor + len(items) if cursor + len(items) < total and items else None
+    return TreePage(identifier=identifier, items=items, total=total, cursor=cursor, next_cursor=next_cursor)